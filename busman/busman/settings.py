@@ -10,6 +10,8 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import sys
+import tempfile
 from pathlib import Path
 
 # from psycopg2cffi import compat
@@ -27,6 +29,8 @@ SECRET_KEY = "django-insecure-0+o$qi#0we(9*5+qe(#w#27@bd_!rly#8yw^$on#2wn564hlr#
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = True
 
+TESTING = sys.argv[1:2] == ["test"]
+
 ALLOWED_HOSTS = ["127.0.0.1", "localhost"]
 
 
@@ -88,6 +92,15 @@ DATABASES = {
     }
 }
 
+# The tests run on SQLite
+if TESTING:
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": BASE_DIR / "db.sqlite3",
+        }
+    }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -130,6 +143,30 @@ STATIC_URL = "static/"
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+
+# Shared by the processes serving busman on a host, so that a change invalidates
+# the cached responses in all of them. Several hosts need a cache they share, such
+# as Redis or Memcached.
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": Path(tempfile.gettempdir()) / "busman-cache",
+    }
+}
+
+# The tests clear the cache, keep theirs away from the one busman is using
+if TESTING:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        }
+    }
+
+# Seconds the v1 API responses stay cached, changes invalidate them right away
+API_CACHE_TIMEOUT = 60
+
 INTERNAL_IPS = [
     "127.0.0.1",
 ]
@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class DeviceConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "device"
+
+    def ready(self):
+        # Connects the signal receivers recording route changes and invalidating
+        # cached responses
+        from device import cache, changes  # noqa: F401
@@ -0,0 +1,76 @@
+import hashlib
+import json
+from typing import Callable
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils.http import parse_etags, quote_etag
+from rest_framework import status
+from rest_framework.response import Response
+
+from device.models import Device, Route
+
+ROUTES = "routes"
+DEVICES = "devices"
+
+
+def version_key(name: str) -> str:
+    return f"api:{name}:version"
+
+
+def invalidate(name: str):
+    """
+    Drop the cached responses of name once the surrounding transaction commits.
+
+    Responses are cached under a version that is replaced here, so a response
+    built from data read before the commit is stored where it is never found.
+    """
+    transaction.on_commit(lambda: cache.set(version_key(name), uuid4().hex, None))
+
+
+def cached_response(
+    request, name: str, key: str, build: Callable[[], tuple[object, dict]]
+) -> Response:
+    """
+    Respond with the data and headers build() returns, cached until name is
+    invalidated. The response has an ETag, a matching If-None-Match is answered
+    with a 304 without building the response again.
+    """
+    version = cache.get_or_set(version_key(name), lambda: uuid4().hex, None)
+    entry_key = f"api:{name}:{version}:{key}"
+    entry = cache.get(entry_key)
+    if entry is None:
+        data, headers = build()
+        content = json.dumps(data, sort_keys=True, default=str).encode()
+        etag = quote_etag(hashlib.md5(content).hexdigest())
+        entry = (etag, data, headers)
+        cache.set(entry_key, entry, settings.API_CACHE_TIMEOUT)
+
+    etag, data, headers = entry
+    # If-None-Match compares weakly
+    etags = [
+        match.removeprefix("W/")
+        for match in parse_etags(request.headers.get("If-None-Match", ""))
+    ]
+    if etag in etags or "*" in etags:
+        return Response(status=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    return Response(data, headers={"ETag": etag, **headers})
+
+
+# The bulk edit view creates routes without signals and invalidates them itself
+
+
+@receiver(post_save, sender=Route)
+@receiver(post_delete, sender=Route)
+def route_changed(sender, **kwargs):
+    invalidate(ROUTES)
+
+
+@receiver(post_save, sender=Device)
+@receiver(post_delete, sender=Device)
+def device_changed(sender, **kwargs):
+    invalidate(DEVICES)
@@ -0,0 +1,94 @@
+import threading
+import time
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from device.models import Route, RouteChange, RouteRevision
+
+# How often a long poll looks for changes committed by other processes, changes
+# made in this process wake it right away
+POLL_INTERVAL = 0.5
+
+changed = threading.Condition()
+
+
+def notify():
+    with changed:
+        changed.notify_all()
+
+
+def current_revision() -> int:
+    revision = RouteRevision.objects.values_list("revision", flat=True).first()
+    return revision or 0
+
+
+def record_route_changes(changes: list[tuple[str, str, str]]):
+    """
+    Record (action, source, sink) changes to the routes, each under the next
+    revision.
+
+    The revision row stays locked until the surrounding transaction commits, so a
+    change with a higher revision is never visible before a lower one.
+    """
+    if not changes:
+        return
+    with transaction.atomic():
+        counter, _ = RouteRevision.objects.select_for_update().get_or_create(pk=1)
+        revision = counter.revision
+        route_changes = []
+        for action, source, sink in changes:
+            revision += 1
+            route_changes.append(
+                RouteChange(revision=revision, action=action, source=source, sink=sink)
+            )
+        RouteChange.objects.bulk_create(route_changes)
+        counter.revision = revision
+        counter.save(update_fields=["revision"])
+        transaction.on_commit(notify)
+
+
+def wait_for_route_changes(since: int, timeout: float, limit: int):
+    """
+    Return up to limit changes after revision since, waiting up to timeout seconds
+    for one if there are none yet.
+    """
+    deadline = time.monotonic() + timeout
+    while 1:
+        changes = list(RouteChange.objects.filter(revision__gt=since)[:limit])
+        remaining = deadline - time.monotonic()
+        if changes or remaining <= 0:
+            return changes
+        with changed:
+            changed.wait(min(remaining, POLL_INTERVAL))
+
+
+# Route.objects.update() and bulk_create() bypass these, callers record those
+# changes themselves
+
+
+@receiver(pre_save, sender=Route)
+def remember_route(sender, instance, **kwargs):
+    instance._saved_route = (
+        Route.objects.filter(pk=instance.pk).values_list("source", "sink").first()
+        if instance.pk is not None
+        else None
+    )
+
+
+@receiver(post_save, sender=Route)
+def route_saved(sender, instance, **kwargs):
+    saved = instance._saved_route
+    route = (instance.source, instance.sink)
+    if saved == route:
+        return
+    changes = [(RouteChange.ADDED, *route)]
+    if saved is not None:
+        changes.insert(0, (RouteChange.REMOVED, *saved))
+    record_route_changes(changes)
+
+
+@receiver(post_delete, sender=Route)
+def route_deleted(sender, instance, **kwargs):
+    record_route_changes([(RouteChange.REMOVED, instance.source, instance.sink)])
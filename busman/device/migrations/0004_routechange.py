@@ -0,0 +1,67 @@
+# Generated by Django 4.2.7 on 2026-10-18 13:36
+
+from django.db import migrations, models
+
+
+def record_existing_routes(apps, schema_editor):
+    Route = apps.get_model("device", "Route")
+    RouteChange = apps.get_model("device", "RouteChange")
+    RouteRevision = apps.get_model("device", "RouteRevision")
+    routes = Route.objects.order_by("pk").values_list("source", "sink")
+    RouteChange.objects.bulk_create(
+        RouteChange(revision=revision, action="added", source=source, sink=sink)
+        for revision, (source, sink) in enumerate(routes, start=1)
+    )
+    RouteRevision.objects.create(pk=1, revision=RouteChange.objects.count())
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("device", "0003_twimodule_device_twi_modules"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="RouteChange",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("revision", models.BigIntegerField(unique=True)),
+                (
+                    "action",
+                    models.TextField(
+                        choices=[("added", "Added"), ("removed", "Removed")]
+                    ),
+                ),
+                ("source", models.TextField()),
+                ("sink", models.TextField()),
+                ("created", models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                "ordering": ("revision",),
+            },
+        ),
+        migrations.CreateModel(
+            name="RouteRevision",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("revision", models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(record_existing_routes, migrations.RunPython.noop),
+    ]
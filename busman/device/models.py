@@ -1,5 +1,12 @@
 from django.core.validators import MaxValueValidator, MinValueValidator
-from django.db.models import Model, TextField, IntegerField, ManyToManyField
+from django.db.models import (
+    BigIntegerField,
+    DateTimeField,
+    IntegerField,
+    ManyToManyField,
+    Model,
+    TextField,
+)
 from netfields import InetAddressField, MACAddressField
 
 
@@ -33,3 +40,36 @@ class Route(Model):
 
     def __str__(self):
         return f"Route: [{self.source}] → [{self.sink}]"
+
+
+class RouteRevision(Model):
+    """
+    The revision of the routes, a single row that is locked while changes are
+    recorded so revisions commit in order.
+    """
+
+    revision = BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"RouteRevision: {self.revision}"
+
+
+class RouteChange(Model):
+    ADDED = "added"
+    REMOVED = "removed"
+    ACTIONS = ((ADDED, "Added"), (REMOVED, "Removed"))
+
+    revision = BigIntegerField(unique=True)
+    action = TextField(choices=ACTIONS)
+    source = TextField(null=False, blank=False)
+    sink = TextField(null=False, blank=False)
+    created = DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ("revision",)
+
+    def __str__(self):
+        return (
+            f"RouteChange: {self.revision} {self.action} "
+            f"[{self.source}] → [{self.sink}]"
+        )
@@ -1,3 +1,196 @@
+from unittest import mock
+
+from django.core.cache import cache
+from django.db.models.signals import post_save
 from django.test import TestCase
 
-# Create your tests here.
+from device.models import Device, Route, RouteChange
+
+
+def changes(since=0):
+    return list(
+        RouteChange.objects.filter(revision__gt=since).values_list(
+            "revision", "action", "source", "sink"
+        )
+    )
+
+
+class RouteChangesTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_signals_record_changes(self):
+        route = Route.objects.create(source="a", sink="b")
+        route.sink = "c"
+        route.save()
+        route.save()
+        route.delete()
+
+        self.assertEqual(
+            changes(),
+            [
+                (1, RouteChange.ADDED, "a", "b"),
+                (2, RouteChange.REMOVED, "a", "b"),
+                (3, RouteChange.ADDED, "a", "c"),
+                (4, RouteChange.REMOVED, "a", "c"),
+            ],
+        )
+
+    def test_bulk_edit_records_difference(self):
+        Route.objects.create(source="a", sink="b")
+        Route.objects.create(source="c", sink="d")
+
+        response = self.client.post("/routes/bulk_edit/", {"routes": "c   d\ne f\ne f"})
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(
+            set(Route.objects.values_list("source", "sink")), {("c", "d"), ("e", "f")}
+        )
+        self.assertEqual(
+            changes(since=2),
+            [
+                (3, RouteChange.REMOVED, "a", "b"),
+                (4, RouteChange.ADDED, "e", "f"),
+            ],
+        )
+
+    def test_list_has_revision(self):
+        Route.objects.create(source="a", sink="b")
+
+        response = self.client.get("/v1/routes/")
+
+        self.assertEqual(response["X-Route-Revision"], "1")
+        self.assertEqual(response.json(), [{"id": 1, "source": "a", "sink": "b"}])
+
+    def test_since(self):
+        Route.objects.create(source="a", sink="b")
+        Route.objects.create(source="c", sink="d")
+
+        response = self.client.get("/v1/routes/", {"since": 1})
+
+        self.assertEqual(
+            response.json(),
+            {
+                "revision": 2,
+                "changes": [
+                    {"revision": 2, "action": "added", "source": "c", "sink": "d"}
+                ],
+            },
+        )
+        response = self.client.get("/v1/routes/", {"since": 2})
+        self.assertEqual(response.json(), {"revision": 2, "changes": []})
+
+    def test_since_ahead_is_gone(self):
+        Route.objects.create(source="a", sink="b")
+
+        response = self.client.get("/v1/routes/", {"since": 2})
+
+        self.assertEqual(response.status_code, 410)
+
+    def test_bad_since_and_wait(self):
+        for params in (
+            {"since": "x"},
+            {"since": 0, "wait": "x"},
+            {"since": 0, "wait": "nan"},
+            {"since": 0, "wait": "inf"},
+        ):
+            response = self.client.get("/v1/routes/", params)
+            self.assertEqual(response.status_code, 400, params)
+
+    def test_long_poll_returns_change(self):
+        def change_while_waiting(timeout):
+            Route.objects.create(source="a", sink="b")
+
+        with mock.patch(
+            "device.changes.changed.wait", side_effect=change_while_waiting
+        ) as wait:
+            response = self.client.get("/v1/routes/", {"since": 0, "wait": 5})
+
+        wait.assert_called_once()
+        self.assertEqual(response.json()["revision"], 1)
+
+    def test_negative_wait_does_not_wait(self):
+        with mock.patch("device.changes.changed.wait") as wait:
+            response = self.client.get("/v1/routes/", {"since": 0, "wait": -5})
+
+        wait.assert_not_called()
+        self.assertEqual(response.json(), {"revision": 0, "changes": []})
+
+
+class ResponseCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        Route.objects.create(source="a", sink="b")
+
+    def test_routes_cached(self):
+        first = self.client.get("/v1/routes/")
+        with self.assertNumQueries(0):
+            second = self.client.get("/v1/routes/")
+
+        self.assertEqual(second.json(), first.json())
+        self.assertEqual(second["ETag"], first["ETag"])
+        self.assertEqual(second["X-Route-Revision"], "1")
+
+    def test_routes_not_modified(self):
+        etag = self.client.get("/v1/routes/")["ETag"]
+
+        for if_none_match in (etag, f"W/{etag}", f'"other", {etag}', "*"):
+            with self.assertNumQueries(0):
+                response = self.client.get(
+                    "/v1/routes/", HTTP_IF_NONE_MATCH=if_none_match
+                )
+            self.assertEqual(response.status_code, 304, if_none_match)
+            self.assertEqual(response["ETag"], etag)
+
+        response = self.client.get("/v1/routes/", HTTP_IF_NONE_MATCH='"other"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_route_change_invalidates(self):
+        etag = self.client.get("/v1/routes/")["ETag"]
+        with self.captureOnCommitCallbacks(execute=True):
+            Route.objects.create(source="c", sink="d")
+
+        response = self.client.get("/v1/routes/", HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertEqual(len(response.json()), 2)
+
+    def test_bulk_edit_invalidates(self):
+        self.client.get("/v1/routes/")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post("/routes/bulk_edit/", {"routes": "a b\nc d"})
+
+        response = self.client.get("/v1/routes/")
+
+        self.assertEqual(len(response.json()), 2)
+        self.assertEqual(response["X-Route-Revision"], "2")
+
+    def test_ubootp(self):
+        mac = "00:11:22:33:44:55"
+        url = f"/v1/ubootp/{mac}/"
+        device = Device(name="d", mac=mac, ip="10.0.0.5")
+
+        with mock.patch.object(Device.objects, "get", return_value=device) as get:
+            response = self.client.get(url)
+            self.assertEqual(response.json(), {"ip": "10.0.0.5"})
+            etag = response["ETag"]
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(get.call_count, 1)
+
+            with self.captureOnCommitCallbacks(execute=True):
+                post_save.send(Device, instance=device, created=False)
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(get.call_count, 2)
+
+    def test_ubootp_unknown_mac_not_cached(self):
+        with mock.patch.object(
+            Device.objects, "get", side_effect=Device.DoesNotExist
+        ) as get:
+            for _ in range(2):
+                response = self.client.get("/v1/ubootp/00:11:22:33:44:55/")
+                self.assertEqual(response.status_code, 400)
+
+        self.assertEqual(get.call_count, 2)
@@ -1,10 +1,13 @@
+import math
 from collections import defaultdict
 
 from django import forms
+from django.db import transaction
 from django.http import HttpResponseRedirect
 from django.shortcuts import render
 from django.urls import reverse_lazy
 from netfields.rest_framework import MACAddressField
+from rest_framework import status
 from rest_framework.exceptions import ValidationError, NotFound
 from rest_framework.fields import CharField
 from rest_framework.generics import get_object_or_404
@@ -14,7 +17,17 @@ from rest_framework.serializers import Serializer, ModelSerializer
 from rest_framework.views import APIView
 from rest_framework.viewsets import ModelViewSet, GenericViewSet
 
-from device.models import Device, Route
+from device.cache import DEVICES, ROUTES, cached_response, invalidate
+from device.changes import (
+    current_revision,
+    record_route_changes,
+    wait_for_route_changes,
+)
+from device.models import Device, Route, RouteChange
+
+# Longest a client may wait for route changes, and the most returned at once
+MAX_WAIT = 30
+MAX_CHANGES = 1000
 
 
 class UbootRequest(Serializer):
@@ -37,9 +50,12 @@ class UbootResponse(Serializer):
 
 class Ubootp(APIView):
     def get(self, request, *, mac):
-        data = UbootRequest(data={"mac": mac})
-        data.is_valid(raise_exception=True)
-        return UbootResponse(data={"ip": data.validated_data["device"].ip})
+        def build():
+            data = UbootRequest(data={"mac": mac})
+            data.is_valid(raise_exception=True)
+            return UbootResponse({"ip": data.validated_data["device"].ip}).data, {}
+
+        return cached_response(request, DEVICES, mac, build)
 
         # get only ip field
         # d = get_object_or_404(Device, mac=mac)
@@ -52,10 +68,60 @@ class RouteSerializer(ModelSerializer):
         fields = "__all__"
 
 
+class RouteChangeSerializer(ModelSerializer):
+    class Meta:
+        model = RouteChange
+        fields = ("revision", "action", "source", "sink")
+
+
 class RouteView(ListModelMixin, GenericViewSet):
+    """
+    Lists the routes, with their revision in the X-Route-Revision header. The list
+    is cached and has an ETag for conditional requests.
+
+    With ?since=<revision> it returns the changes made after that revision
+    instead, and with &wait=<seconds> it waits for a change if there is none yet.
+    A since ahead of the current revision gets a 410, the client should list the
+    routes again.
+    """
+
     queryset = Route.objects.all()
     serializer_class = RouteSerializer
 
+    def list(self, request, *args, **kwargs):
+        if "since" not in request.query_params:
+
+            def build():
+                # Read before the routes, changes after it are replayed harmlessly
+                revision = current_revision()
+                data = self.get_serializer(self.get_queryset(), many=True).data
+                return data, {"X-Route-Revision": str(revision)}
+
+            return cached_response(request, ROUTES, "list", build)
+
+        try:
+            since = int(request.query_params["since"])
+            wait = float(request.query_params.get("wait", 0))
+        except ValueError:
+            raise ValidationError({"since": "Expected a revision and wait seconds"})
+        if not math.isfinite(wait):
+            raise ValidationError({"wait": "Expected a number of seconds"})
+        wait = min(max(wait, 0), MAX_WAIT)
+
+        changes = wait_for_route_changes(since, wait, MAX_CHANGES)
+        if changes:
+            revision = changes[-1].revision
+        elif since > current_revision():
+            return Response(status=status.HTTP_410_GONE)
+        else:
+            revision = since
+        return Response(
+            {
+                "revision": revision,
+                "changes": RouteChangeSerializer(changes, many=True).data,
+            }
+        )
+
 
 class BulkEditRoutesForm(forms.Form):
     routes = forms.CharField(widget=forms.Textarea(attrs={"rows": "40", "cols": "100"}))
@@ -71,14 +137,28 @@ def bulk_edit_routes_view(request):
 
             def to_data(row):
                 source, sink = row.split()
-                return {"source": source, "sink": sink}
-
-            routes_data = (
-                to_data(row) for row in form.cleaned_data["routes"].split("\n")
-            )
-
-            Route.objects.all().delete()
-            Route.objects.bulk_create(Route(**route_data) for route_data in routes_data)
+                return source, sink
+
+            routes = {to_data(row) for row in form.cleaned_data["routes"].split("\n")}
+
+            # Only the routes that differ are changed, and recorded
+            with transaction.atomic():
+                saved = {
+                    (source, sink): pk
+                    for pk, source, sink in Route.objects.values_list(
+                        "pk", "source", "sink"
+                    )
+                }
+                removed = [pk for route, pk in saved.items() if route not in routes]
+                added = sorted(routes.difference(saved))
+                Route.objects.filter(pk__in=removed).delete()
+                Route.objects.bulk_create(
+                    Route(source=source, sink=sink) for source, sink in added
+                )
+                record_route_changes(
+                    [(RouteChange.ADDED, source, sink) for source, sink in added]
+                )
+                invalidate(ROUTES)
 
             return HttpResponseRedirect(reverse_lazy("admin:device_route_changelist"))
 
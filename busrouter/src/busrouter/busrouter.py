@@ -1,183 +1,682 @@
 import asyncio
 import logging
-from asyncio import (
-    CancelledError,
-    IncompleteReadError,
-    Queue,
-    StreamReader,
-    StreamWriter,
-)
-from typing import Optional, Coroutine
+import multiprocessing
+import os
+import sys
+from functools import partial
+from time import perf_counter
+from typing import Optional
 
-from busrouter import settings
+from busrouter import metrics, settings
+from busrouter.cluster import Interest, ipc_path, link_peer
 from busrouter.mapper import mapper
 from busrouter.router import (
-    NokResponse,
-    OkResponse,
+    EXTENDED,
+    Alias,
+    AliasPublishRequest,
+    BatchRequest,
+    CallRequest,
+    HelloRequest,
+    InvalidRequest,
+    Outbox,
+    ParseError,
     PingResponse,
-    PongRequest,
+    PublishBatchRequest,
     PublishRequest,
-    PublishResponse,
+    RegisterRequest,
     Request,
     RequestQueue,
-    Response,
-    ResponseQueue,
+    RouteMap,
+    SessionRequest,
+    Stream,
+    StreamDataRequest,
+    StreamStartRequest,
+    SubscribeBulkRequest,
     SubscribeRequest,
+    UnsubscribeAllRequest,
+    UnsubscribeBulkRequest,
     UnsubscribeRequest,
+    handle_request,
+    read_varint,
     route,
 )
-from busrouter.utils import set_timeout
+from busrouter.sessions import Session, Sessions
+from busrouter.timers import Timer, TimerWheel, get_wheel
 
 logger = logging.getLogger(__name__)
 
+SUBSCRIBE = Request.SUBSCRIBE[0]
+UNSUBSCRIBE = Request.UNSUBSCRIBE[0]
+SUBSCRIBE_BULK = Request.SUBSCRIBE_BULK[0]
+UNSUBSCRIBE_BULK = Request.UNSUBSCRIBE_BULK[0]
+PUBLISH = Request.PUBLISH[0]
+PUBLISH_NOACK = Request.PUBLISH_NOACK[0]
+PUBLISH_BATCH = Request.PUBLISH_BATCH[0]
+REGISTER = Request.REGISTER[0]
+PUBLISH_ALIAS = Request.PUBLISH_ALIAS[0]
+PUBLISH_ALIAS_NOACK = Request.PUBLISH_ALIAS_NOACK[0]
+HELLO = Request.HELLO[0]
+SESSION = Request.SESSION[0]
+PONG = Request.PONG[0]
 
-def str_to_length_prefixed_bytes(s: str) -> bytes:
-    b = s.encode("ascii")
-    return len(b).to_bytes(1) + b
 
+def _read_byte(view: memoryview, offset: int) -> tuple[int, int]:
+    if offset >= len(view):
+        return -1, offset
+    return view[offset], offset + 1
 
-def bytes_to_length_prefixed_bytes(b: bytes) -> bytes:
-    return len(b).to_bytes(1) + b
 
+def _read_length(view: memoryview, offset: int, extended: bool) -> tuple[int, int]:
+    if not extended:
+        return _read_byte(view, offset)
+    length, offset = read_varint(view, offset)
+    if length > settings.STREAM_THRESHOLD:
+        raise ParseError(f"Length {length} is too long to buffer")
+    return length, offset
 
-async def handle_device_response(response_queue: ResponseQueue, writer: StreamWriter):
-    while 1:
-        response = await response_queue.get()
-        match response:
-            case OkResponse():
-                writer.write(Response.OK)
-                await writer.drain()
-            case NokResponse():
-                writer.write(Response.NOK)
-                await writer.drain()
-            case PublishResponse(topic, message):
-                buffer = (
-                    Response.PUBLISH
-                    + str_to_length_prefixed_bytes(topic)
-                    + bytes_to_length_prefixed_bytes(message)
-                )
-                writer.write(buffer)
-                await writer.drain()
-            case PingResponse():
-                writer.write(Response.PING)
-                await writer.drain()
 
+def parse_publish_batch(
+    view: memoryview, offset: int, extended: bool = False
+) -> tuple[Optional[Request], int]:
+    """
+    Parse a batch publish frame, a count followed by that many topic/message pairs.
 
-async def read_length_prefixed_value(reader):
-    length = (await reader.readexactly(1))[0]
-    if length == 0:
-        return b""
-    return await reader.readexactly(length)
-
-
-class CloseConnection(Exception):
-    pass
-
-
-async def ping_task(response_queue: ResponseQueue):
-    await asyncio.sleep(settings.PING_INTERVAL)
-    await response_queue.put(PingResponse())
-
-
-async def handle_device_request(
-    request_queue: RequestQueue,
-    response_queue: ResponseQueue,
-    reader,
-    tg: asyncio.TaskGroup,
-):
-    _ping_task: Optional[asyncio.Task] = None
-    async with asyncio.timeout(settings.TIMEOUT) as timeout:
-        while 1:
-            cmd = await reader.readexactly(1)
-            logging.debug(f"Recv cmd: {cmd}")
-            match cmd:
-                case Request.SUBSCRIBE:
-                    topic = await read_length_prefixed_value(reader)
-                    await request_queue.put(
-                        (response_queue, SubscribeRequest(topic.decode("ascii")))
-                    )
-                case Request.UNSUBSCRIBE:
-                    topic = await read_length_prefixed_value(reader)
-                    await request_queue.put(
-                        (response_queue, UnsubscribeRequest(topic.decode("ascii")))
-                    )
-                case Request.PUBLISH:
-                    topic = await read_length_prefixed_value(reader)
-                    message = await read_length_prefixed_value(reader)
-                    await request_queue.put(
-                        (
-                            response_queue,
-                            PublishRequest(topic.decode("ascii"), message),
-                        )
+    offset points past the command. Returns the request and the offset past the
+    frame, or None if the frame is incomplete.
+    """
+    size = len(view)
+    if offset >= size:
+        return None, offset
+    count = view[offset]
+    offset += 1
+    messages = []
+    valid = True
+    for _ in range(count):
+        length, start = _read_length(view, offset, extended)
+        if length < 0:
+            return None, offset
+        end = start + length
+        if end > size:
+            return None, offset
+        try:
+            topic = str(view[start:end], "ascii")
+        except UnicodeDecodeError:
+            valid = False
+        length, start = _read_length(view, end, extended)
+        if length < 0:
+            return None, offset
+        end = start + length
+        if end > size:
+            return None, offset
+        if valid:
+            messages.append((topic, bytes(view[start:end])))
+        offset = end
+
+    if not valid:
+        return InvalidRequest("Topic is not ASCII"), offset
+    return PublishBatchRequest(messages), offset
+
+
+def parse_bulk(
+    view: memoryview, offset: int, cmd: int, extended: bool = False
+) -> tuple[Optional[Request], int]:
+    """
+    Parse a bulk subscribe or unsubscribe frame, a count followed by that many
+    filters.
+
+    offset points past the command. Returns the request and the offset past the
+    frame, or None if the frame is incomplete. Filters that are not ASCII are
+    passed on as None, to be reported as failed.
+    """
+    size = len(view)
+    if offset >= size:
+        return None, offset
+    count = view[offset]
+    offset += 1
+    topics = []
+    for _ in range(count):
+        length, start = _read_length(view, offset, extended)
+        if length < 0:
+            return None, offset
+        end = start + length
+        if end > size:
+            return None, offset
+        try:
+            topics.append(str(view[start:end], "ascii"))
+        except UnicodeDecodeError:
+            topics.append(None)
+        offset = end
+
+    if cmd == SUBSCRIBE_BULK:
+        return SubscribeBulkRequest(topics), offset
+    return UnsubscribeBulkRequest(topics), offset
+
+
+def _topic_request(
+    cmd: int, topic: Optional[str], aliases: Optional[list[Alias]]
+) -> Request:
+    if topic is None:
+        return InvalidRequest("Topic is not ASCII")
+    if cmd == SUBSCRIBE:
+        return SubscribeRequest(topic)
+    if cmd == UNSUBSCRIBE:
+        return UnsubscribeRequest(topic)
+    if cmd == SESSION:
+        if not topic:
+            return InvalidRequest("Empty session token")
+        return SessionRequest(topic)
+    if aliases is None or len(aliases) >= settings.MAX_ALIASES:
+        return InvalidRequest("Too many aliases")
+    aliases.append(Alias(topic))
+    return RegisterRequest(len(aliases) - 1)
+
+
+def parse_requests(
+    data, aliases: Optional[list[Alias]] = None, extended: bool = False
+) -> tuple[list[Request], int, bool]:
+    """
+    Parse every complete frame in data.
+
+    Returns the parsed requests, the number of bytes consumed and whether a pong was
+    seen. An incomplete frame at the end of data is left for the next call.
+
+    Topics registered as aliases are appended to aliases, their index is the alias
+    id. Without an alias list registering is refused.
+
+    In the extended framing lengths are varints instead of single bytes. A publish
+    longer than STREAM_THRESHOLD is not buffered: parsing stops after its header
+    and returns a stream start request, the caller feeds the payload that follows
+    to the stream. Any other length over the threshold is a parse error.
+
+    Parsing stops after a hello that switches the framing or a session, the frames
+    that follow use the new framing or belong to the session.
+    """
+    requests = []
+    pong = False
+    offset = 0
+    if extended:
+        read_length = read_varint
+        threshold = settings.STREAM_THRESHOLD
+    else:
+        read_length = _read_byte
+        # A single byte length never streams
+        threshold = 0xFF
+    with memoryview(data) as view:
+        size = len(view)
+        while offset < size:
+            cmd = view[offset]
+            if cmd == PONG:
+                pong = True
+                offset += 1
+                continue
+            if cmd == HELLO:
+                if offset + 2 > size:
+                    break
+                version = view[offset + 1]
+                requests.append(HelloRequest(version))
+                offset += 2
+                if (version >= EXTENDED) != extended:
+                    break
+                continue
+            if (
+                cmd != PUBLISH
+                and cmd != PUBLISH_NOACK
+                and cmd != PUBLISH_BATCH
+                and cmd != PUBLISH_ALIAS
+                and cmd != PUBLISH_ALIAS_NOACK
+                and cmd != REGISTER
+                and cmd != SUBSCRIBE
+                and cmd != UNSUBSCRIBE
+                and cmd != SESSION
+                and cmd != SUBSCRIBE_BULK
+                and cmd != UNSUBSCRIBE_BULK
+            ):
+                raise ParseError(f"Bad command: {cmd}")
+            if cmd == PUBLISH_BATCH:
+                request, end = parse_publish_batch(view, offset + 1, extended)
+                if request is None:
+                    break
+                requests.append(request)
+                offset = end
+                continue
+            if cmd == SUBSCRIBE_BULK or cmd == UNSUBSCRIBE_BULK:
+                request, end = parse_bulk(view, offset + 1, cmd, extended)
+                if request is None:
+                    break
+                requests.append(request)
+                offset = end
+                continue
+            if cmd == PUBLISH_ALIAS or cmd == PUBLISH_ALIAS_NOACK:
+                if offset + 3 > size:
+                    break
+                alias_id = view[offset + 1] << 8 | view[offset + 2]
+                length, start = read_length(view, offset + 3)
+                if length < 0:
+                    break
+                alias = None
+                if aliases is not None and alias_id < len(aliases):
+                    alias = aliases[alias_id]
+                if length > threshold:
+                    topic = alias.topic if alias is not None else None
+                    stream = Stream(topic, length, cmd == PUBLISH_ALIAS)
+                    requests.append(StreamStartRequest(stream))
+                    offset = start
+                    break
+                end = start + length
+                if end > size:
+                    break
+                if alias is not None:
+                    request = AliasPublishRequest(
+                        alias, bytes(view[start:end]), cmd == PUBLISH_ALIAS
                     )
-                case b"!":
-                    set_timeout(timeout, settings.TIMEOUT)
-                    if _ping_task is not None and not _ping_task.done():
-                        _ping_task.cancel()
-                    _ping_task = tg.create_task(ping_task(response_queue))
-                    await request_queue.put((response_queue, PongRequest()))
+                else:
+                    request = InvalidRequest(f"Unknown alias: {alias_id}")
+                requests.append(request)
+                offset = end
+                continue
+
+            length, start = read_length(view, offset + 1)
+            if length < 0:
+                break
+            if length > threshold:
+                raise ParseError(f"Length {length} is too long to buffer")
+            end = start + length
+            if end > size:
+                break
+            try:
+                topic = str(view[start:end], "ascii")
+            except UnicodeDecodeError:
+                topic = None
+
+            if cmd == PUBLISH or cmd == PUBLISH_NOACK:
+                length, start = read_length(view, end)
+                if length < 0:
+                    break
+                if length > threshold:
+                    stream = Stream(topic, length, cmd == PUBLISH)
+                    requests.append(StreamStartRequest(stream))
+                    offset = start
+                    break
+                end = start + length
+                if end > size:
+                    break
+                request = PublishRequest(topic, bytes(view[start:end]), cmd == PUBLISH)
+                if topic is None:
+                    request = InvalidRequest("Topic is not ASCII")
+            else:
+                request = _topic_request(cmd, topic, aliases)
+            offset = end
+            requests.append(request)
+            if isinstance(request, SessionRequest):
+                break
+    return requests, offset, pong
+
+
+class DeviceProtocol(asyncio.Protocol):
+    """
+    A single device connection.
+
+    Incoming data is parsed synchronously in data_received and every complete frame
+    in a chunk is handed to the router as one batch. Responses collect in an outbox
+    that is flushed to the transport in a single write on the next loop iteration,
+    and held back while the transport is over its high-water mark. Idle
+    connections hold no tasks or buffers of their own.
+
+    overflow is the policy of the connection's outbox, see ResponseQueue.
+
+    With a route map the requests are routed right away instead of going through
+    the request queue and the router task.
+
+    After a hello the connection may switch to the extended framing. Streamed
+    payloads bypass the buffer, each received chunk is handed on as it is.
+
+    After a session request the requests are made on behalf of the session, which
+    outlives the connection, see busrouter.sessions. A session is meant to be the
+    first request, subscriptions made before it end with the connection.
+    """
+
+    __slots__ = (
+        "request_queue",
+        "route_map",
+        "response_queue",
+        "buffer",
+        "aliases",
+        "extended",
+        "stream",
+        "stream_remaining",
+        "transport",
+        "paused_at",
+        "timers",
+        "timer",
+        "pinged",
+        "sessions",
+        "session",
+    )
+
+    def __init__(
+        self,
+        request_queue: RequestQueue,
+        peer: bool = False,
+        route_map: Optional[RouteMap] = None,
+        sessions: Optional[Sessions] = None,
+        overflow: str = settings.RESPONSE_QUEUE_OVERFLOW,
+    ):
+        self.request_queue = request_queue
+        self.route_map = route_map
+        self.response_queue = Outbox(self.wakeup, overflow=overflow, peer=peer)
+        # Only allocated while holding a partial frame or registered aliases
+        self.buffer: Optional[bytearray] = None
+        self.aliases: Optional[list[Alias]] = None
+        self.extended = False
+        self.stream: Optional[Stream] = None
+        self.stream_remaining = 0
+        self.transport: Optional[asyncio.Transport] = None
+        self.paused_at: Optional[float] = None
+        self.timers: Optional[TimerWheel] = None
+        self.timer = Timer(self.expired)
+        self.pinged = True
+        self.sessions = sessions
+        self.session: Optional[Session] = None
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+        transport.set_write_buffer_limits(high=settings.WRITE_HIGH_WATER)
+        self.timers = get_wheel()
+        self.timers.schedule(self.timer, settings.TIMEOUT)
+        if metrics.ENABLED:
+            metrics.CONNECTIONS.inc()
 
-                case _:
-                    logging.warning("Bad command, disconnect")
-                    raise CloseConnection()
+    def connection_lost(self, exc: Optional[Exception]):
+        logger.info("Closing connection")
+        if metrics.ENABLED:
+            metrics.CONNECTIONS.dec()
+        self.timers.cancel(self.timer)
+        self.response_queue.disconnected = True
+        if self.stream is not None:
+            self.dispatch(StreamDataRequest(self.stream, b""))
+            self.stream = None
+        if self.session is not None:
+            self.sessions.suspend(self.session, self.response_queue)
+            self.session = None
+        self.dispatch(UnsubscribeAllRequest(skip_response=True))
 
+    def data_received(self, data: bytes):
+        while data:
+            data = self.parse_received(data)
 
-def handle_device_factory(request_queue: RequestQueue):
-    async def handle_device(reader: StreamReader, writer: StreamWriter):
-        response_queue: ResponseQueue = Queue()
+    def parse_received(self, data: bytes) -> bytes:
+        """
+        Parse and dispatch the frames in data. Returns the unparsed rest when
+        parsing stopped early to continue with the new framing, stream or session.
+        """
+        if self.stream is not None:
+            data = self.stream_received(data)
+            if not data:
+                return b""
+        buffer = self.buffer
+        if buffer is not None:
+            buffer += data
+            data = buffer
+        aliases = self.aliases
+        if aliases is None:
+            aliases = []
+
+        extended = self.extended
         try:
-            async with asyncio.TaskGroup() as tg:
-                tg.create_task(handle_device_response(response_queue, writer))
+            if metrics.ENABLED:
+                start = perf_counter()
+                requests, consumed, pong = parse_requests(data, aliases, extended)
+                metrics.PARSE_SECONDS.observe(perf_counter() - start)
+            else:
+                requests, consumed, pong = parse_requests(data, aliases, extended)
+        except ParseError as ex:
+            logger.warning(f"{ex}, disconnect")
+            self.transport.close()
+            return b""
+
+        if aliases and self.aliases is None:
+            self.aliases = aliases
+        if data is buffer:
+            del buffer[:consumed]
+            if not buffer:
+                self.buffer = buffer = None
+        elif consumed < len(data):
+            self.buffer = buffer = bytearray(data[consumed:])
+
+        if pong:
+            self.pong()
+        if not requests:
+            return b""
+        last = requests[-1]
+        session_request = None
+        if isinstance(last, HelloRequest):
+            self.extended = last.version >= EXTENDED
+        elif isinstance(last, StreamStartRequest):
+            self.stream = last.stream
+            self.stream_remaining = last.stream.length
+        elif isinstance(last, SessionRequest):
+            session_request = requests.pop()
+        if len(requests) == 1:
+            self.dispatch(requests[0])
+        elif requests:
+            self.dispatch(BatchRequest(requests))
+        if session_request is not None:
+            self.resume(session_request.token)
+
+        if buffer and (
+            self.stream is not None
+            or self.extended != extended
+            or session_request is not None
+        ):
+            self.buffer = None
+            return bytes(buffer)
+        return b""
+
+    def stream_received(self, data: bytes) -> bytes:
+        """
+        Hand the streamed part of data on and return the rest.
+        """
+        size = min(self.stream_remaining, len(data))
+        self.dispatch(StreamDataRequest(self.stream, data[:size]))
+        self.stream_remaining -= size
+        if not self.stream_remaining:
+            self.stream = None
+        return data[size:]
+
+    def dispatch(self, request: Request):
+        queue = self.response_queue if self.session is None else self.session
+        if self.route_map is not None:
+            handle_request(self.route_map, queue, request)
+        else:
+            self.request_queue.put_nowait((queue, request))
+
+    def resume(self, token: str):
+        if self.sessions is None or self.session is not None:
+            self.dispatch(InvalidRequest("Session refused"))
+            return
+        sessions = self.sessions
+        self.session, resumed = sessions.take(token)
+        # The requests that follow are made for the session right away, it is only
+        # attached once the requests before it have been handled
+        attach = partial(
+            sessions.attach, self.session, self.response_queue, self.extended, resumed
+        )
+        self.dispatch(CallRequest(attach))
+
+    def wakeup(self):
+        asyncio.get_running_loop().call_soon(self.flush)
+
+    def flush(self):
+        response_queue = self.response_queue
+        if response_queue.disconnected:
+            self.transport.close()
+            return
+        if self.paused_at is not None:
+            return
+        responses = response_queue.take()
+        if responses is None:
+            return
+        if metrics.ENABLED:
+            start = perf_counter()
+        if len(responses) == 1:
+            self.transport.write(responses[0].frame)
+        else:
+            self.transport.writelines([response.frame for response in responses])
+        if metrics.ENABLED:
+            metrics.WRITE_SECONDS.observe(perf_counter() - start)
+
+    def pause_writing(self):
+        self.paused_at = perf_counter()
+
+    def resume_writing(self):
+        if metrics.ENABLED:
+            metrics.DRAIN_SECONDS.observe(perf_counter() - self.paused_at)
+        self.paused_at = None
+        self.flush()
+
+    def pong(self):
+        self.pinged = False
+        self.timers.schedule(self.timer, settings.PING_INTERVAL)
+
+    def expired(self):
+        """
+        Ping the device when the ping interval is up, or time it out if the ping
+        went unanswered.
+        """
+        if self.pinged:
+            logger.warning("Connection timed out, disconnect")
+            self.transport.close()
+            return
+        self.pinged = True
+        self.response_queue.offer(PingResponse())
+        self.timers.schedule(self.timer, settings.TIMEOUT - settings.PING_INTERVAL)
+
+
+async def serve(worker: int = 0, workers: int = 1):
+    request_queue = RequestQueue()
+    route_map = RouteMap(cache_size=settings.MATCH_CACHE_SIZE)
+    # The route map is only touched from this thread, so connections may route
+    # their requests directly, as the mapper does.
+    direct_route_map = route_map if settings.DIRECT_ROUTING else None
+    sessions = None
+    if settings.SESSION_GRACE:
+        sessions = Sessions(request_queue, direct_route_map)
+    loop = asyncio.get_running_loop()
+    server = await loop.create_server(
+        lambda: DeviceProtocol(
+            request_queue,
+            route_map=direct_route_map,
+            sessions=sessions,
+            overflow=settings.RESPONSE_QUEUE_OVERFLOW,
+        ),
+        settings.BUSROUTER_HOST,
+        settings.BUSROUTER_PORT,
+        reuse_port=workers > 1,
+    )
+    logging.info(f"Serving @ {settings.BUSROUTER_HOST}:{settings.BUSROUTER_PORT}")
+    async with asyncio.TaskGroup() as tg:
+        tg.create_task(route(request_queue, route_map))
+        tg.create_task(server.serve_forever())
+        # Every worker forwards the publishes made on it
+        tg.create_task(mapper(route_map))
+        if metrics.ENABLED:
+            tg.create_task(
+                metrics.serve(settings.METRICS_HOST, settings.METRICS_PORT + worker)
+            )
+        if workers > 1 or settings.PEER_PORT:
+            route_map.interest = Interest()
+        if workers > 1:
+            os.makedirs(settings.IPC_DIR, exist_ok=True)
+            ipc_server = await loop.create_unix_server(
+                lambda: DeviceProtocol(
+                    request_queue,
+                    peer=True,
+                    route_map=direct_route_map,
+                    overflow=settings.PEER_QUEUE_OVERFLOW,
+                ),
+                ipc_path(worker),
+            )
+            tg.create_task(ipc_server.serve_forever())
+            for peer in range(workers):
+                if peer != worker:
+                    tg.create_task(
+                        link_peer(
+                            ipc_path(peer),
+                            route_map.interest,
+                            request_queue,
+                            direct_route_map,
+                        )
+                    )
+        if settings.PEER_PORT:
+            peer_server = await loop.create_server(
+                lambda: DeviceProtocol(
+                    request_queue,
+                    peer=True,
+                    route_map=direct_route_map,
+                    overflow=settings.PEER_QUEUE_OVERFLOW,
+                ),
+                settings.PEER_HOST,
+                settings.PEER_PORT,
+            )
+            logging.info(f"Serving peers @ {settings.PEER_HOST}:{settings.PEER_PORT}")
+            tg.create_task(peer_server.serve_forever())
+            for address in settings.PEERS:
                 tg.create_task(
-                    handle_device_request(request_queue, response_queue, reader, tg)
+                    link_peer(
+                        address, route_map.interest, request_queue, direct_route_map
+                    )
                 )
-        except* CloseConnection:
-            pass
-        except* IncompleteReadError:
-            logging.warning("Incomplete read error!")
-        finally:
-            logger.info("Closing connection")
-            writer.close()
-            await writer.wait_closed()
-
-    return handle_device
 
 
-async def main():
+def run_worker(worker: int = 0, workers: int = 1):
     logging.basicConfig(
         level=logging.DEBUG,
-        format="%(asctime)s [%(levelname)s]: %(message)s",
+        format=f"%(asctime)s [%(levelname)s] worker {worker}: %(message)s",
         handlers=[
             logging.StreamHandler(),
             logging.FileHandler("app.log"),
         ],
     )
+    try:
+        asyncio.run(serve(worker, workers))
+    except KeyboardInterrupt:
+        pass
 
-    request_queue = Queue()
-
-    logging.info("Starting router...")
-    route_task = asyncio.create_task(route(request_queue))
-    # TODO handle cancel
 
-    mapper_task = asyncio.create_task(mapper(request_queue))
-    # TODO handle cancel
+def main():
+    """
+    Run the router, or with WORKERS > 1 one router process per worker.
 
-    HOST = "0.0.0.0"
-    PORT = 42069
-    server = await asyncio.start_server(
-        handle_device_factory(request_queue), HOST, PORT
-    )
-    logging.info(f"Serving @ {HOST}:{PORT}")
-    async with asyncio.TaskGroup() as tg:
-        tg.create_task(route(request_queue))
-        tg.create_task(mapper(request_queue))
-        tg.create_task(server.serve_forever())
-    # async with server:
-    #    await server.serve_forever()
+    Workers share the listening port through SO_REUSEPORT and keep only the
+    subscriptions of their own connections. They link to each other over unix
+    sockets in IPC_DIR and forward a publish only to the workers that have
+    subscribers for it.
 
+    Nodes federate the same way over TCP: with PEER_PORT set the router accepts
+    links from the nodes listed in PEERS and links to each of them. A node is a
+    single worker, as publishes are forwarded a single hop.
+    """
+    if settings.WORKERS > 1 and settings.PEER_PORT:
+        sys.exit("PEER_PORT can not be combined with WORKERS > 1")
+    if settings.WORKERS == 1:
+        run_worker()
+        return
 
-if __name__ == "__main__":
+    processes = [
+        multiprocessing.Process(target=run_worker, args=(worker, settings.WORKERS))
+        for worker in range(settings.WORKERS)
+    ]
+    for process in processes:
+        process.start()
     try:
-        asyncio.run(main())
+        for process in processes:
+            process.join()
     except KeyboardInterrupt:
-        print("Good bye")
+        # The workers got the interrupt too
+        for process in processes:
+            process.join()
+
+
+if __name__ == "__main__":
+    main()
+    print("Good bye")
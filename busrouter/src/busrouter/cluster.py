@@ -0,0 +1,305 @@
+import asyncio
+import logging
+import os
+from typing import Optional, Union
+
+from busrouter import settings
+from busrouter.router import (
+    EXTENDED,
+    BatchRequest,
+    PublishRequest,
+    Request,
+    RequestQueue,
+    Response,
+    ResponseQueue,
+    RouteMap,
+    Stream,
+    StreamDataRequest,
+    StreamStartRequest,
+    handle_request,
+    read_varint,
+    varint_prefixed,
+)
+
+logger = logging.getLogger(__name__)
+
+OK = Response.OK[0]
+NOK = Response.NOK[0]
+BULK = Response.BULK[0]
+PUBLISH = Response.PUBLISH[0]
+PING = Response.PING[0]
+HELLO = Response.HELLO[0]
+STREAM_START = Response.STREAM_START[0]
+STREAM_DATA = Response.STREAM_DATA[0]
+
+
+def ipc_path(worker: int) -> str:
+    return os.path.join(settings.IPC_DIR, f"worker-{worker}.sock")
+
+
+def bulk_frames(command: bytes, topics: list[str]) -> list[bytes]:
+    """
+    Bulk requests for topics in the extended framing, which peer links use.
+    """
+    frames = []
+    for start in range(0, len(topics), 255):
+        chunk = topics[start : start + 255]
+        frames.append(
+            command
+            + len(chunk).to_bytes(1)
+            + b"".join([varint_prefixed(topic.encode("ascii")) for topic in chunk])
+        )
+    return frames
+
+
+class Interest:
+    """
+    The filters that local connections subscribe to.
+
+    Filters are reference counted, so peer links only hear about the first
+    subscription to a filter and the last unsubscription from it. Subscriptions of
+    peer queues are not counted, a router never advertises what it only forwards.
+
+    Changes are collected and sent to the peers as bulk requests in one write on the
+    next loop iteration. A filter that is dropped and subscribed again in the
+    meantime, or the other way around, is not sent at all.
+    """
+
+    def __init__(self):
+        self.counts: dict[str, int] = {}
+        self.links: list[PeerLink] = []
+        self.pending: dict[str, bool] = {}
+        self.scheduled = False
+
+    def add(self, topic: str, queue: ResponseQueue):
+        if queue.peer:
+            return
+        count = self.counts.get(topic, 0)
+        self.counts[topic] = count + 1
+        if not count:
+            self.change(topic, True)
+
+    def remove(self, topic: str, queue: ResponseQueue):
+        if queue.peer:
+            return
+        count = self.counts[topic] - 1
+        if count:
+            self.counts[topic] = count
+            return
+        del self.counts[topic]
+        self.change(topic, False)
+
+    def change(self, topic: str, subscribe: bool):
+        if self.pending.get(topic) == (not subscribe):
+            # Cancels out a change that was not sent yet
+            del self.pending[topic]
+        else:
+            self.pending[topic] = subscribe
+        if not self.scheduled:
+            self.scheduled = True
+            asyncio.get_running_loop().call_soon(self.flush)
+
+    def flush(self):
+        self.scheduled = False
+        if not self.pending:
+            return
+        subscribes = [topic for topic, subscribe in self.pending.items() if subscribe]
+        unsubscribes = [
+            topic for topic, subscribe in self.pending.items() if not subscribe
+        ]
+        self.pending.clear()
+        frames = bulk_frames(Request.SUBSCRIBE_BULK, subscribes)
+        frames += bulk_frames(Request.UNSUBSCRIBE_BULK, unsubscribes)
+        for link in self.links:
+            link.send(frames)
+
+
+def parse_responses(
+    data, streams: Optional[dict[int, tuple[Stream, int]]] = None
+) -> tuple[list[Request], int, bool]:
+    """
+    Parse every complete frame a router sent to us, in the extended framing.
+
+    Publishes are turned into fire-and-forget publish requests for the local router,
+    and streams into stream requests. Streams in progress are kept in streams by
+    their id, with the length still to come. Returns the requests, the number of
+    bytes consumed and whether we were pinged.
+    """
+    if streams is None:
+        streams = {}
+    requests = []
+    pinged = False
+    offset = 0
+    with memoryview(data) as view:
+        size = len(view)
+        while offset < size:
+            cmd = view[offset]
+            if cmd == PING:
+                pinged = True
+                offset += 1
+                continue
+            if cmd == NOK:
+                logger.warning("Peer refused a subscription")
+            if cmd == HELLO:
+                if offset + 2 > size:
+                    break
+                if view[offset + 1] != EXTENDED:
+                    logger.warning("Peer refused the extended framing")
+                offset += 2
+                continue
+            if cmd == BULK:
+                if offset + 2 > size:
+                    break
+                end = offset + 2 + (view[offset + 1] + 7) // 8
+                if end > size:
+                    break
+                if any(view[offset + 2 : end]):
+                    logger.warning("Peer refused a subscription")
+                offset = end
+                continue
+            if cmd == STREAM_DATA:
+                stream_id, start = read_varint(view, offset + 1)
+                if stream_id < 0:
+                    break
+                length, start = read_varint(view, start)
+                if length < 0 or start + length > size:
+                    break
+                end = start + length
+                if stream_id in streams:
+                    stream, remaining = streams[stream_id]
+                    requests.append(StreamDataRequest(stream, bytes(view[start:end])))
+                    remaining -= length
+                    if length and remaining:
+                        streams[stream_id] = stream, remaining
+                    else:
+                        del streams[stream_id]
+                offset = end
+                continue
+            if cmd == STREAM_START:
+                stream_id, start = read_varint(view, offset + 1)
+                if stream_id < 0:
+                    break
+            elif cmd == PUBLISH:
+                start = offset + 1
+            else:
+                offset += 1
+                continue
+
+            length, start = read_varint(view, start)
+            if length < 0 or start + length > size:
+                break
+            end = start + length
+            topic = str(view[start:end], "ascii")
+            length, start = read_varint(view, end)
+            if length < 0:
+                break
+            if cmd == STREAM_START:
+                stream = Stream(topic, length, ack=False)
+                streams[stream_id] = stream, length
+                requests.append(StreamStartRequest(stream))
+                offset = start
+                continue
+            end = start + length
+            if end > size:
+                break
+            requests.append(PublishRequest(topic, bytes(view[start:end]), False))
+            offset = end
+    return requests, offset, pinged
+
+
+class PeerLink(asyncio.Protocol):
+    """
+    A connection to another router, a worker over a unix socket or another node
+    over TCP.
+
+    The link negotiates the extended framing and subscribes to our local interest at
+    the peer, and the peer sends back the publishes and streams that match it. Those
+    are handed to the local router as coming from a peer queue, so they are only
+    delivered to local connections. Publishes are forwarded a single hop, so routers
+    need a link to every other router.
+    """
+
+    def __init__(
+        self,
+        interest: Interest,
+        request_queue: RequestQueue,
+        route_map: Optional[RouteMap] = None,
+    ):
+        self.interest = interest
+        self.request_queue = request_queue
+        self.route_map = route_map
+        self.response_queue = ResponseQueue(
+            overflow=settings.PEER_QUEUE_OVERFLOW, peer=True
+        )
+        self.buffer = bytearray()
+        self.streams: dict[int, tuple[Stream, int]] = {}
+        self.transport: Optional[asyncio.Transport] = None
+        self.closed = asyncio.get_running_loop().create_future()
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+        # Pending changes are already part of counts
+        self.interest.flush()
+        frames = [Request.HELLO + EXTENDED.to_bytes(1), Request.PONG]
+        frames += bulk_frames(Request.SUBSCRIBE_BULK, list(self.interest.counts))
+        transport.writelines(frames)
+        self.interest.links.append(self)
+
+    def connection_lost(self, exc: Optional[Exception]):
+        self.interest.links.remove(self)
+        if self.streams:
+            # Aborts the streams that were cut short
+            self.dispatch(
+                [StreamDataRequest(stream, b"") for stream, _ in self.streams.values()]
+            )
+            self.streams.clear()
+        self.closed.set_result(None)
+
+    def send(self, frames: list[bytes]):
+        self.transport.writelines(frames)
+
+    def data_received(self, data: bytes):
+        buffer = self.buffer
+        buffer += data
+        requests, consumed, pinged = parse_responses(buffer, self.streams)
+        del buffer[:consumed]
+
+        if pinged:
+            self.transport.write(Request.PONG)
+        if requests:
+            self.dispatch(requests)
+
+    def dispatch(self, requests: list[Request]):
+        request = BatchRequest(requests)
+        if self.route_map is not None:
+            handle_request(self.route_map, self.response_queue, request)
+        else:
+            self.request_queue.put_nowait((self.response_queue, request))
+
+
+async def link_peer(
+    address: Union[str, tuple[str, int]],
+    interest: Interest,
+    request_queue: RequestQueue,
+    route_map: Optional[RouteMap] = None,
+):
+    """
+    Keep a link to the peer at address, a unix socket path or a host and port.
+    """
+    loop = asyncio.get_running_loop()
+
+    def factory():
+        return PeerLink(interest, request_queue, route_map)
+
+    while 1:
+        try:
+            if isinstance(address, str):
+                _, link = await loop.create_unix_connection(factory, address)
+            else:
+                _, link = await loop.create_connection(factory, *address)
+        except OSError:
+            await asyncio.sleep(settings.PEER_RETRY_INTERVAL)
+            continue
+        logger.info(f"Linked to peer {address}")
+        await link.closed
+        logger.warning(f"Lost link to peer {address}")
@@ -1,6 +1,6 @@
 import asyncio
 import logging
-from asyncio import Queue
+from typing import Optional
 
 import httpx
 
@@ -9,12 +9,18 @@ from busrouter import settings
 logger = logging.getLogger(__name__)
 
 from busrouter.router import (
-    Request,
-    RequestQueue,
+    Alias,
+    BatchResponse,
+    PublishResponse,
     Response,
-    ResponseQueue,
-    SubscribeRequest,
-    UnsubscribeAllRequest,
+    RouteChangeError,
+    RouteMap,
+    add_route,
+    add_routes,
+    discard_routes,
+    match_route,
+    publish_alias,
+    remove_route,
 )
 
 
@@ -22,31 +28,191 @@ class SetupError(Exception):
     pass
 
 
-async def setup(request_queue: Queue, response_queue: Queue):
-    async with httpx.AsyncClient() as client:
-        result = await client.get(settings.MAPPER_SETUP_URL)
+class Forwarder:
+    """
+    Republishes messages published to a source filter to its sink topics.
+
+    The forwarder subscribes to every source in the route map and is offered the
+    matching publishes like any subscriber, it republishes them right away inside
+    the router. Sources are compiled into a trie of their own, whose matches are
+    the sinks, and each sink resolves its subscribers once per route map change.
+
+    A publish is not forwarded to a topic it was already forwarded from, so loops
+    of routes end instead of cycling. The forwarder counts as a peer queue: it only
+    forwards publishes made on this router, which is what every other router does
+    too.
+    """
+
+    __slots__ = (
+        "route_map",
+        "routes",
+        "sources",
+        "table",
+        "sinks",
+        "chain",
+        "loops",
+        "disconnected",
+        "peer",
+        "extended",
+    )
+
+    def __init__(self, route_map: RouteMap):
+        self.route_map = route_map
+        self.routes: set[tuple[str, str]] = set()
+        self.sources: dict[str, int] = {}
+        self.table = RouteMap(cache_size=settings.MATCH_CACHE_SIZE)
+        self.sinks: dict[str, Alias] = {}
+        self.chain: list[str] = []
+        self.loops = 0
+        self.disconnected = False
+        self.peer = True
+        # Takes messages of any length
+        self.extended = True
+
+    def load(self, routes: list[tuple[str, str]]) -> tuple[int, int]:
+        """
+        Bring the forwarding table in line with routes of source filters and sink
+        topics, changing only the routes that differ.
+
+        The table is updated in one go, publishes see either the old or the new
+        routes. Returns the number of routes added and removed.
+        """
+        routes = set(routes)
+        removed = self.routes - routes
+        added = routes - self.routes
+        sources = set(self.sources)
+        for source, sink in removed:
+            alias = self.sinks[sink]
+            remove_route(self.table, source, alias)
+            if alias not in self.table.subscriptions:
+                del self.sinks[sink]
+            count = self.sources.pop(source) - 1
+            if count:
+                self.sources[source] = count
+            self.routes.discard((source, sink))
+
+        for source, sink in added:
+            alias = self.sinks.get(sink)
+            if alias is None:
+                alias = Alias(sink)
+            try:
+                add_route(self.table, source, alias)
+            except RouteChangeError:
+                logger.warning(f"Invalid route source: {source}")
+                continue
+            self.sinks[sink] = alias
+            self.sources[source] = self.sources.get(source, 0) + 1
+            self.routes.add((source, sink))
+
+        discard_routes(self.route_map, list(sources.difference(self.sources)), self)
+        add_routes(self.route_map, list(self.sources.keys() - sources), self)
+        return len(added), len(removed)
+
+    def qsize(self) -> int:
+        return 0
+
+    def empty(self) -> bool:
+        return True
+
+    def full(self) -> bool:
+        # Streams are not forwarded
+        return True
+
+    def offer(self, response: Response) -> bool:
+        if isinstance(response, PublishResponse):
+            self.forward(response.topic, response.message)
+        elif isinstance(response, BatchResponse):
+            for publish_response in response.responses:
+                self.forward(publish_response.topic, publish_response.message)
+        return True
+
+    def forward(self, topic: str, message: bytes):
+        sinks = match_route(self.table, topic)
+        if not sinks:
+            return
+        chain = self.chain
+        chain.append(topic)
+        try:
+            for sink in sinks:
+                if sink.topic in chain:
+                    self.loops += 1
+                    logger.debug(f"Not forwarding {topic} back to {sink.topic}")
+                    continue
+                publish_alias(self.route_map, sink, message)
+        finally:
+            chain.pop()
+
+
+async def sync(forwarder: Forwarder, client: httpx.AsyncClient) -> Optional[int]:
+    """
+    Load the full route table, returning its revision if busman has a change feed.
+    """
+    result = await client.get(settings.MAPPER_SETUP_URL)
 
     if result.status_code != 200:
         raise SetupError(f"Request failed, status: {result.status_code}")
 
-    await request_queue.put((response_queue, UnsubscribeAllRequest()))
-    await response_queue.get()
-    # TODO Check result
-
     mappings = result.json()
-    for mapping in mappings:
-        source, sink = mapping["source"], mapping["sink"]
-        await request_queue.put((response_queue, SubscribeRequest(source)))
-        response = await response_queue.get()
-        # TODO check response
+    routes = [(mapping["source"], mapping["sink"]) for mapping in mappings]
+    added, removed = forwarder.load(routes)
+    if added or removed:
+        logger.info(f"Synced {len(routes)} routes, {added} added, {removed} removed")
+    revision = result.headers.get("X-Route-Revision")
+    return None if revision is None else int(revision)
 
 
-async def mapper(request_queue: RequestQueue):
-    response_queue: ResponseQueue = Queue()
-    while 1:
-        try:
-            mapping = await setup(request_queue, response_queue)
-            break
-        except ValueError:
-            logger.warning("Failed to get mapping... will retry.")
-            await asyncio.sleep(1)
+async def follow(forwarder: Forwarder, client: httpx.AsyncClient, revision: int) -> int:
+    """
+    Apply the route changes after revision, waiting up to MAPPER_WAIT seconds for
+    them, and return the revision reached.
+    """
+    result = await client.get(
+        settings.MAPPER_SETUP_URL,
+        params={"since": revision, "wait": settings.MAPPER_WAIT},
+        timeout=settings.MAPPER_WAIT + 10,
+    )
+
+    if result.status_code != 200:
+        raise SetupError(f"Request failed, status: {result.status_code}")
+
+    feed = result.json()
+    routes = set(forwarder.routes)
+    for change in feed["changes"]:
+        route = (change["source"], change["sink"])
+        if change["action"] == "added":
+            routes.add(route)
+        else:
+            routes.discard(route)
+    added, removed = forwarder.load(routes)
+    if added or removed:
+        logger.info(
+            f"Followed routes to revision {feed['revision']}, "
+            f"{added} added, {removed} removed"
+        )
+    return feed["revision"]
+
+
+async def mapper(route_map: RouteMap):
+    """
+    Keep the forwarding routes in sync with busman.
+
+    The full table is loaded once and then followed through the change feed,
+    which busman answers as soon as routes change. Against a busman without the
+    feed the table is fetched again every MAPPER_SYNC_INTERVAL seconds.
+    """
+    forwarder = Forwarder(route_map)
+    revision = None
+    async with httpx.AsyncClient() as client:
+        while 1:
+            try:
+                if revision is None:
+                    revision = await sync(forwarder, client)
+                else:
+                    revision = await follow(forwarder, client, revision)
+            except (ValueError, KeyError, TypeError, SetupError, httpx.HTTPError):
+                logger.warning("Failed to get mapping... will retry.")
+                revision = None
+                await asyncio.sleep(1)
+                continue
+            if revision is None:
+                await asyncio.sleep(settings.MAPPER_SYNC_INTERVAL)
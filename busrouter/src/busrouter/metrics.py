@@ -0,0 +1,158 @@
+import asyncio
+import logging
+from bisect import bisect_left
+from typing import Callable, Optional
+
+from busrouter import settings
+
+logger = logging.getLogger(__name__)
+
+# Instrumented code checks this flag before taking any timestamps, so disabled
+# metrics cost a single attribute lookup per call site. It is read when
+# connections and queues are created, toggle it before starting the router.
+ENABLED = settings.METRICS_ENABLED
+
+# 1 us .. ~1 s
+BUCKETS = [1e-6 * 2**i for i in range(21)]
+
+
+class Counter:
+    __slots__ = ("name", "help", "value")
+    type = "counter"
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.value = 0
+        REGISTRY.append(self)
+
+    def inc(self, amount: int = 1):
+        self.value += amount
+
+    def samples(self):
+        yield self.name, self.value
+
+
+class Gauge:
+    """
+    A gauge that is either set directly or read from a function at scrape time.
+    """
+
+    __slots__ = ("name", "help", "value", "function")
+    type = "gauge"
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.function: Optional[Callable[[], float]] = None
+        REGISTRY.append(self)
+
+    def inc(self, amount: int = 1):
+        self.value += amount
+
+    def dec(self, amount: int = 1):
+        self.value -= amount
+
+    def samples(self):
+        yield self.name, self.function() if self.function else self.value
+
+
+class Histogram:
+    __slots__ = ("name", "help", "counts", "sum")
+    type = "histogram"
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        REGISTRY.append(self)
+
+    def observe(self, seconds: float):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+
+    def samples(self):
+        total = 0
+        for bucket, count in zip(BUCKETS, self.counts):
+            total += count
+            yield f'{self.name}_bucket{{le="{bucket:g}"}}', total
+        total += self.counts[-1]
+        yield f'{self.name}_bucket{{le="+Inf"}}', total
+        yield f"{self.name}_sum", self.sum
+        yield f"{self.name}_count", total
+
+
+REGISTRY: list[Counter | Gauge | Histogram] = []
+
+CONNECTIONS = Gauge("busrouter_connections", "Open device connections")
+SUBSCRIPTIONS = Gauge("busrouter_subscriptions", "Subscribed filters")
+SESSIONS = Gauge("busrouter_sessions", "Sessions, attached or in their grace period")
+PUBLISHES = Counter("busrouter_publishes_total", "Handled publish requests")
+DELIVERIES = Counter("busrouter_deliveries_total", "Responses offered to subscribers")
+OVERFLOWS = Counter(
+    "busrouter_response_queue_overflows_total", "Responses that overflowed a queue"
+)
+TOO_LONG = Counter(
+    "busrouter_too_long_total",
+    "Publishes and streams not delivered to subscribers on the classic framing",
+)
+REQUEST_QUEUE_DEPTH = Gauge("busrouter_request_queue_depth", "Queued router requests")
+RESPONSE_QUEUE_DEPTH = Gauge(
+    "busrouter_response_queue_depth", "Queued responses of all subscribers"
+)
+MATCH_CACHE_HITS = Gauge("busrouter_match_cache_hits", "Match cache hits")
+MATCH_CACHE_MISSES = Gauge("busrouter_match_cache_misses", "Match cache misses")
+
+PARSE_SECONDS = Histogram("busrouter_parse_seconds", "Time to parse a received chunk")
+QUEUE_WAIT_SECONDS = Histogram(
+    "busrouter_request_queue_wait_seconds", "Time requests wait for the router"
+)
+MATCH_SECONDS = Histogram("busrouter_match_seconds", "Time to match a publish topic")
+FANOUT_SECONDS = Histogram("busrouter_fanout_seconds", "Time to offer a publish")
+WRITE_SECONDS = Histogram("busrouter_write_seconds", "Time to write responses")
+DRAIN_SECONDS = Histogram(
+    "busrouter_drain_seconds", "Time spent waiting for a paused transport"
+)
+
+
+def render() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        for name, value in metric.samples():
+            lines.append(f"{name} {value}")
+    lines.append("")
+    return "\n".join(lines)
+
+
+async def handle_scrape(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()).strip():
+            pass
+        if request_line.split(b" ")[1:2] == [b"/metrics"]:
+            status = b"200 OK"
+            body = render().encode()
+        else:
+            status = b"404 Not Found"
+            body = b""
+        writer.write(
+            b"HTTP/1.1 %s\r\n"
+            b"Content-Type: text/plain; version=0.0.4\r\n"
+            b"Content-Length: %d\r\n"
+            b"Connection: close\r\n\r\n%s" % (status, len(body), body)
+        )
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host: str, port: int):
+    server = await asyncio.start_server(handle_scrape, host, port)
+    logger.info(f"Serving metrics @ {host}:{port}")
+    await server.serve_forever()
@@ -1,11 +1,18 @@
-import asyncio
 import logging
-from asyncio import Queue
-from collections import defaultdict
-from functools import lru_cache
+from asyncio import Queue, QueueEmpty, QueueFull
+from collections import OrderedDict, deque
+from time import perf_counter
+from types import MappingProxyType
+from typing import Callable, Mapping, Optional
+
+from busrouter import metrics, settings
 
 logger = logging.getLogger(__name__)
 
+# Protocol version of the extended framing, negotiated with a hello request. It
+# uses varint lengths and streams large publishes.
+EXTENDED = 1
+
 
 class ParseError(Exception):
     pass
@@ -14,7 +21,16 @@ class ParseError(Exception):
 class Request:
     SUBSCRIBE = b"+"
     UNSUBSCRIBE = b"-"
+    SUBSCRIBE_BULK = b"["
+    UNSUBSCRIBE_BULK = b"]"
     PUBLISH = b"@"
+    PUBLISH_NOACK = b"&"
+    PUBLISH_BATCH = b"*"
+    REGISTER = b"="
+    PUBLISH_ALIAS = b"$"
+    PUBLISH_ALIAS_NOACK = b"%"
+    HELLO = b"^"
+    SESSION = b"~"
     PONG = b"!"
 
 
@@ -34,6 +50,26 @@ class UnsubscribeRequest(Request):
         self.topic = topic
 
 
+class SubscribeBulkRequest(Request):
+    """
+    Subscribe to many filters at once, a filter that is not ASCII is None.
+    """
+
+    __slots__ = ("topics",)
+    __match_args__ = ("topics",)
+
+    def __init__(self, topics: list[Optional[str]]):
+        self.topics = topics
+
+
+class UnsubscribeBulkRequest(Request):
+    __slots__ = ("topics",)
+    __match_args__ = ("topics",)
+
+    def __init__(self, topics: list[Optional[str]]):
+        self.topics = topics
+
+
 class UnsubscribeAllRequest(Request):
     __slots__ = ("skip_response",)
     __match_args__ = ("skip_response",)
@@ -43,48 +79,493 @@ class UnsubscribeAllRequest(Request):
 
 
 class PublishRequest(Request):
-    __slots__ = ("topic", "message")
-    __match_args__ = ("topic", "message")
+    __slots__ = ("topic", "message", "ack")
+    __match_args__ = ("topic", "message", "ack")
 
-    def __init__(self, topic: str, message: bytes):
+    def __init__(self, topic: str, message: bytes, ack: bool = True):
         self.topic = topic
         self.message = message
+        self.ack = ack
+
+
+class PublishBatchRequest(Request):
+    __slots__ = ("messages",)
+    __match_args__ = ("messages",)
+
+    def __init__(self, messages: list[tuple[str, bytes]]):
+        self.messages = messages
+
+
+class RegisterRequest(Request):
+    __slots__ = ("alias_id",)
+    __match_args__ = ("alias_id",)
+
+    def __init__(self, alias_id: int):
+        self.alias_id = alias_id
+
+
+class AliasPublishRequest(Request):
+    __slots__ = ("alias", "message", "ack")
+    __match_args__ = ("alias", "message", "ack")
+
+    def __init__(self, alias: "Alias", message: bytes, ack: bool = True):
+        self.alias = alias
+        self.message = message
+        self.ack = ack
+
+
+class HelloRequest(Request):
+    __slots__ = ("version",)
+    __match_args__ = ("version",)
+
+    def __init__(self, version: int):
+        self.version = version
+
+
+class SessionRequest(Request):
+    __slots__ = ("token",)
+    __match_args__ = ("token",)
+
+    def __init__(self, token: str):
+        self.token = token
+
+
+class CallRequest(Request):
+    """
+    Calls function when the router gets to it, after the requests queued before it.
+    """
+
+    __slots__ = ("function",)
+    __match_args__ = ("function",)
+
+    def __init__(self, function: Callable[[], None]):
+        self.function = function
+
+
+class Stream:
+    """
+    A large publish that is forwarded to subscribers in chunks as it arrives.
+
+    A stream without a topic is read and discarded, it was refused while parsing.
+    """
+
+    __slots__ = ("topic", "length", "remaining", "ack", "stream_id", "routes")
+
+    def __init__(self, topic: Optional[str], length: int, ack: bool = True):
+        self.topic = topic
+        self.length = length
+        self.remaining = length
+        self.ack = ack
+        self.stream_id = 0
+        self.routes: list[ResponseQueue] = []
+
+
+class StreamStartRequest(Request):
+    __slots__ = ("stream",)
+    __match_args__ = ("stream",)
+
+    def __init__(self, stream: Stream):
+        self.stream = stream
+
+
+class StreamDataRequest(Request):
+    """
+    The next chunk of a stream, an empty chunk aborts the stream.
+    """
+
+    __slots__ = ("stream", "chunk")
+    __match_args__ = ("stream", "chunk")
+
+    def __init__(self, stream: Stream, chunk: bytes):
+        self.stream = stream
+        self.chunk = chunk
 
 
 class PongRequest(Request):
     pass
 
 
+class InvalidRequest(Request):
+    __slots__ = ("reason",)
+    __match_args__ = ("reason",)
+
+    def __init__(self, reason: str):
+        self.reason = reason
+
+
+class BatchRequest(Request):
+    __slots__ = ("requests",)
+    __match_args__ = ("requests",)
+
+    def __init__(self, requests: list[Request]):
+        self.requests = requests
+
+
 class Response:
     OK = b"k"
     NOK = b"E"
+    BULK = b"["
     PUBLISH = b"@"
+    REGISTERED = b"="
+    HELLO = b"^"
+    STREAM_START = b"<"
+    STREAM_DATA = b">"
+    SESSION = b"~"
     PING = b"?"
 
 
 class OkResponse(Response):
-    pass
+    frame = Response.OK
 
 
 class NokResponse(Response):
-    pass
+    frame = Response.NOK
+
+
+class BulkResponse(Response):
+    """
+    The result of a bulk subscribe or unsubscribe.
+
+    The frame is the number of filters followed by a little-endian bitmap with a bit
+    set for every filter that failed, 1 << 0 of the first byte for the first filter.
+    """
+
+    __slots__ = ("results", "frame")
+    __match_args__ = ("results",)
+
+    def __init__(self, results: list[bool]):
+        self.results = results
+        failed = 0
+        for index, result in enumerate(results):
+            if not result:
+                failed |= 1 << index
+        self.frame = b"".join(
+            (
+                Response.BULK,
+                len(results).to_bytes(1),
+                failed.to_bytes((len(results) + 7) // 8, "little"),
+            )
+        )
 
 
 class PublishResponse(Response):
-    __slots__ = ("topic", "message")
+    """
+    A message delivered to subscribers.
+
+    The wire frame is encoded once when the response is created, and the same
+    response object is shared by every subscriber of the publish. Extended responses
+    are framed with varint lengths, which only differ from single byte lengths for
+    lengths of 128 and more.
+    """
+
+    __slots__ = ("topic", "message", "frame")
     __match_args__ = ("topic", "message")
 
-    def __init__(self, topic: str, message: bytes):
+    def __init__(self, topic: str, message: bytes, extended: bool = False):
         self.topic = topic
         self.message = message
+        if extended:
+            self.frame = b"".join(
+                (
+                    Response.PUBLISH,
+                    varint_prefixed(topic.encode("ascii")),
+                    varint_prefixed(message),
+                )
+            )
+        else:
+            self.frame = b"".join(
+                (
+                    Response.PUBLISH,
+                    str_to_length_prefixed_bytes(topic),
+                    bytes_to_length_prefixed_bytes(message),
+                )
+            )
+
+
+class BatchResponse(Response):
+    """
+    Several publishes delivered to a subscriber as one response.
+
+    The frame is the publish frames concatenated, so clients parse it like any other
+    run of publishes.
+    """
+
+    __slots__ = ("responses", "frame")
+    __match_args__ = ("responses",)
+
+    def __init__(self, responses: list[PublishResponse]):
+        self.responses = responses
+        self.frame = b"".join([response.frame for response in responses])
+
+
+class RegisteredResponse(Response):
+    __slots__ = ("alias_id", "frame")
+    __match_args__ = ("alias_id",)
+
+    def __init__(self, alias_id: int):
+        self.alias_id = alias_id
+        self.frame = Response.REGISTERED + alias_id.to_bytes(2)
+
+
+class HelloResponse(Response):
+    __slots__ = ("version", "frame")
+    __match_args__ = ("version",)
+
+    def __init__(self, version: int):
+        self.version = version
+        self.frame = Response.HELLO + version.to_bytes(1)
+
+
+class SessionResponse(Response):
+    """
+    Tells whether a session was resumed with its subscriptions, or started anew.
+    """
+
+    __slots__ = ("resumed", "frame")
+    __match_args__ = ("resumed",)
+
+    def __init__(self, resumed: bool):
+        self.resumed = resumed
+        self.frame = Response.SESSION + resumed.to_bytes(1)
+
+
+class StreamStartResponse(Response):
+    __slots__ = ("stream_id", "topic", "length", "frame")
+    __match_args__ = ("stream_id", "topic", "length")
+
+    def __init__(self, stream_id: int, topic: str, length: int):
+        self.stream_id = stream_id
+        self.topic = topic
+        self.length = length
+        self.frame = b"".join(
+            (
+                Response.STREAM_START,
+                varint(stream_id),
+                varint_prefixed(topic.encode("ascii")),
+                varint(length),
+            )
+        )
+
+
+class StreamDataResponse(Response):
+    __slots__ = ("stream_id", "chunk", "frame")
+    __match_args__ = ("stream_id", "chunk")
+
+    def __init__(self, stream_id: int, chunk: bytes):
+        self.stream_id = stream_id
+        self.chunk = chunk
+        self.frame = Response.STREAM_DATA + varint(stream_id) + varint_prefixed(chunk)
 
 
 class PingResponse(Response):
-    pass
+    frame = Response.PING
+
+
+class Overflow:
+    DROP_NEWEST = "drop-newest"
+    DROP_OLDEST = "drop-oldest"
+    DISCONNECT = "disconnect"
+    POLICIES = (DROP_NEWEST, DROP_OLDEST, DISCONNECT)
+
+
+def _check_overflow(overflow: str) -> str:
+    if overflow not in Overflow.POLICIES:
+        raise ValueError(f"Unknown overflow policy: {overflow}")
+    return overflow
+
+
+class ResponseQueue(Queue):
+    """
+    A bounded outbound queue for a single connection.
+
+    The router never waits on a response queue, it offers responses and lets the
+    overflow policy decide what happens when the queue is full: drop the new
+    response, drop the oldest queued response, or mark the queue as disconnected
+    so the router stops routing to it and the connection gets closed.
+
+    Peer queues belong to links to other routers. Publishes that came from a peer
+    are never routed back to peers.
+
+    Extended queues have negotiated the extended framing, only they receive
+    messages longer than 255 bytes and streams.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = settings.RESPONSE_QUEUE_SIZE,
+        overflow: str = settings.RESPONSE_QUEUE_OVERFLOW,
+        peer: bool = False,
+    ):
+        super().__init__(maxsize)
+        self.overflow = _check_overflow(overflow)
+        self.overflows = 0
+        self.disconnected = False
+        self.peer = peer
+        self.extended = False
+
+    def offer(self, response: Response) -> bool:
+        if self.disconnected:
+            return False
+        try:
+            self.put_nowait(response)
+            return True
+        except QueueFull:
+            pass
+
+        self.overflows += 1
+        if metrics.ENABLED:
+            metrics.OVERFLOWS.inc()
+        match self.overflow:
+            case Overflow.DROP_OLDEST:
+                self.get_nowait()
+                self.put_nowait(response)
+                return True
+            case Overflow.DISCONNECT:
+                logger.warning("Response queue overflow, disconnecting slow consumer")
+                self.disconnected = True
+        return False
+
+
+class Outbox:
+    """
+    A bounded response queue that its connection flushes, instead of awaiting it.
+
+    To the router it behaves like a ResponseQueue. wakeup is called when the first
+    response is queued and when the overflow policy disconnects the outbox. The
+    responses are only allocated while some are pending.
+    """
+
+    __slots__ = (
+        "maxsize",
+        "overflow",
+        "overflows",
+        "disconnected",
+        "peer",
+        "extended",
+        "responses",
+        "wakeup",
+    )
+
+    def __init__(
+        self,
+        wakeup: Callable[[], None],
+        maxsize: int = settings.RESPONSE_QUEUE_SIZE,
+        overflow: str = settings.RESPONSE_QUEUE_OVERFLOW,
+        peer: bool = False,
+    ):
+        self.maxsize = maxsize
+        self.overflow = _check_overflow(overflow)
+        self.overflows = 0
+        self.disconnected = False
+        self.peer = peer
+        self.extended = False
+        self.responses: Optional[deque[Response]] = None
+        self.wakeup = wakeup
+
+    def qsize(self) -> int:
+        return len(self.responses) if self.responses is not None else 0
+
+    def empty(self) -> bool:
+        return self.responses is None
+
+    def full(self) -> bool:
+        return 0 < self.maxsize <= self.qsize()
+
+    def put_nowait(self, response: Response):
+        responses = self.responses
+        if responses is None:
+            self.responses = deque((response,))
+            self.wakeup()
+        elif 0 < self.maxsize <= len(responses):
+            raise QueueFull
+        else:
+            responses.append(response)
+
+    def get_nowait(self) -> Response:
+        responses = self.responses
+        if responses is None:
+            raise QueueEmpty
+        response = responses.popleft()
+        if not responses:
+            self.responses = None
+        return response
+
+    def take(self) -> Optional[deque[Response]]:
+        responses = self.responses
+        self.responses = None
+        return responses
+
+    def offer(self, response: Response) -> bool:
+        if ResponseQueue.offer(self, response):
+            return True
+        if self.disconnected:
+            self.wakeup()
+        return False
+
+
+class RequestQueue(Queue):
+    """
+    The router's request queue.
+
+    When metrics are enabled every item is stamped when it is put, so the time it
+    waited for the router can be recorded when it is taken.
+    """
+
+    def __init__(self, maxsize: int = 0):
+        super().__init__(maxsize)
+        self.timed = metrics.ENABLED
+
+    def _put(self, item: tuple[ResponseQueue, Request]):
+        if self.timed:
+            item = (perf_counter(), item)
+        super()._put(item)
+
+    def _get(self) -> tuple[ResponseQueue, Request]:
+        item = super()._get()
+        if self.timed:
+            put_time, item = item
+            metrics.QUEUE_WAIT_SECONDS.observe(perf_counter() - put_time)
+        return item
+
 
+def str_to_length_prefixed_bytes(s: str) -> bytes:
+    b = s.encode("ascii")
+    return len(b).to_bytes(1) + b
 
-ResponseQueue = Queue[Response]
-RequestQueue = Queue[tuple[ResponseQueue, Request]]
+
+def bytes_to_length_prefixed_bytes(b: bytes) -> bytes:
+    return len(b).to_bytes(1) + b
+
+
+def varint(value: int) -> bytes:
+    b = bytearray()
+    while value >= 0x80:
+        b.append(value & 0x7F | 0x80)
+        value >>= 7
+    b.append(value)
+    return bytes(b)
+
+
+def varint_prefixed(b: bytes) -> bytes:
+    return varint(len(b)) + b
+
+
+def read_varint(view: memoryview, offset: int) -> tuple[int, int]:
+    """
+    Read a varint of at most 4 bytes at offset.
+
+    Returns the value and the offset past it, or -1 if the varint is incomplete.
+    """
+    value = 0
+    for shift in (0, 7, 14, 21):
+        if offset >= len(view):
+            return -1, offset
+        byte = view[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+    raise ParseError("Varint is too long")
 
 
 def length_prefixed_to_bytes(b: bytes) -> tuple[bytes, bytes]:
@@ -101,166 +582,755 @@ def length_prefixed_to_str(b: bytes) -> tuple[str, bytes]:
     return data.decode("ascii"), rest
 
 
-class RouteSegment(defaultdict):
-    def __init__(self, **kwargs):
-        super().__init__(lambda: RouteSegment(**kwargs), **kwargs)
-        self.routes = []
+_NO_CHILDREN: Mapping[str, "RouteSegment"] = MappingProxyType({})
+_NO_ROUTES: frozenset = frozenset()
 
-    def add_route(self, key: str, queue: Queue):
-        self[key].routes.append(queue)
 
-    def remove_route(self, key: str, queue: Queue):
-        try:
-            self[key].routes.remove(queue)
-        except ValueError:
-            raise RouteChangeError("Queue was not in route")
-        finally:
-            if self[key].is_empty:
-                del self[key]
-
-    def change_route(self, key: str, queue: Queue, add: bool):
-        if add:
-            return self.add_route(key, queue)
+class RouteSegment:
+    """
+    A node in the subscription trie.
+
+    Both the children mapping and the subscriber set are allocated lazily, leaf nodes
+    share an empty read-only mapping and interior nodes an empty frozenset, so that
+    lookups never need to check for missing containers.
+    """
+
+    __slots__ = ("children", "routes")
+
+    def __init__(self):
+        self.children = _NO_CHILDREN
+        self.routes = _NO_ROUTES
+
+    def __contains__(self, key: str):
+        return key in self.children
+
+    def __getitem__(self, key: str) -> "RouteSegment":
+        return self.children[key]
+
+    def child(self, key: str) -> "RouteSegment":
+        children = self.children
+        if children is _NO_CHILDREN:
+            children = self.children = {}
+        node = children.get(key)
+        if node is None:
+            node = children[key] = RouteSegment()
+        return node
+
+    def add(self, queue):
+        if self.routes is _NO_ROUTES:
+            self.routes = {queue}
         else:
-            return self.remove_route(key, queue)
-
-    def collect(self, segment):
-        routes = []
-        if segment in self:
-            routes += self[segment].routes
-        if "+" in self:
-            routes += self["+"].routes
-        if "#" in self:
-            routes += self["#"].routes
-        return routes
-
-    def collect_all(self, recursive=False):
-        routes = []
-        for key in self.keys():
-            routes += self[key].routes
-            if recursive:
-                routes += self[key].collect_all(recursive=True)
-        return routes
-
-    def remove_routes(self, queue: Queue):
-        for key in self.keys():
-            if queue in self[key].routes:
-                self[key].routes.remove(queue)
-            self[key].remove_routes(queue)
+            self.routes.add(queue)
+
+    def discard(self, queue) -> bool:
+        routes = self.routes
+        if queue not in routes:
+            return False
+        routes.remove(queue)
+        if not routes:
+            self.routes = _NO_ROUTES
+        return True
+
+    def collect_all(self, matched: set):
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            for child in node.children.values():
+                matched.update(child.routes)
+                stack.append(child)
 
     @property
     def is_empty(self):
-        return not len(self.routes)
+        return not self.routes and not self.children
 
 
-class RouteChangeError(Exception):
-    pass
+class RouteMap(RouteSegment):
+    """
+    The root of the subscription trie.
 
+    Every change to the map bumps the generation, which invalidates the match cache
+    without having to walk it. Setting cache_size to zero disables the cache.
 
-class RouteMatchError(Exception):
-    pass
+    The filters held by each queue are indexed in subscriptions, so that dropping a
+    queue only touches its own branches of the trie.
 
+    When the router has peers, interest is told about every filter that local
+    queues subscribe to or drop, see busrouter.cluster.Interest.
+    """
 
-def _change_route(route_segment, topic: list[str], queue: Queue, add: bool):
-    match topic:
-        case ["#"]:
-            return route_segment.change_route("#", queue, add)
-        case ["+"]:
-            return route_segment.change_route("+", queue, add)
-        case ["+", *rest]:
-            return _change_route(route_segment["+"], rest, queue, add)
-        case [segment]:
-            return route_segment.change_route(segment, queue, add)
-        case [segment, *rest]:
-            return _change_route(route_segment[segment], rest, queue, add)
-        case _:
-            raise RouteChangeError(f"Unable to handle topic: {topic}")
-
-
-def add_route(route_map, topic: str, queue: Queue):
-    return _change_route(route_map, topic.split("/"), queue, True)
-
-
-def remove_route(route_map, topic: str, queue: Queue):
-    return _change_route(route_map, topic.split("/"), queue, False)
-
-
-def remove_routes(route_map, queue):
-    return route_map.remove_routes(queue)
-
-
-def _match_route(route_segment, topic: list[str]):
-    match topic:
-        case ["#"]:
-            return route_segment.collect_all(recursive=True)
-        case ["+"]:
-            return route_segment.collect_all()
-        case ["+", *rest]:
-            routes = []
-            for segment in route_segment.keys():
-                routes += _match_route(route_segment[segment], rest)
-            return routes
-        case [segment]:
-            return route_segment.collect(segment)
-        case [segment, *rest]:
-            routes = []
-            if "#" in route_segment:
-                routes += route_segment["#"].routes
-            if "+" in route_segment:
-                routes += _match_route(route_segment["+"], rest)
-            if segment in route_segment:
-                routes += _match_route(route_segment[segment], rest)
-            return routes
-        case _:
-            raise RouteMatchError(f"Unable to handle topic: {topic}")
+    __slots__ = (
+        "generation",
+        "subscriptions",
+        "interest",
+        "cache",
+        "cache_size",
+        "hits",
+        "misses",
+        "stream_ids",
+    )
 
+    def __init__(self, cache_size: int = 0):
+        super().__init__()
+        self.generation = 0
+        self.subscriptions: dict[object, set[str]] = {}
+        self.interest = None
+        self.cache: OrderedDict[str, tuple[int, set]] = OrderedDict()
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self.stream_ids = 0
 
-def match_route(route_map, topic: str):
-    return _match_route(route_map, topic.split("/"))
 
+class Alias:
+    """
+    A topic registered by a connection, which then publishes to it by a numeric id.
 
-async def publish(route_map, topic, message):
-    routes = match_route(route_map, topic)
-    if routes:
-        response = PublishResponse(topic, message)
-        async with asyncio.TaskGroup() as tg:
-            for response_queue in routes:
-                tg.create_task(response_queue.put(response))
+    The subscribers of the topic are resolved once and reused until the route map
+    changes.
+    """
 
+    __slots__ = ("topic", "generation", "routes")
 
-async def route(request_queue: RequestQueue):
-    route_map = RouteSegment()
+    def __init__(self, topic: str):
+        self.topic = topic
+        self.generation = -1
+        self.routes = _NO_ROUTES
 
-    while 1:
-        response_queue, request = await request_queue.get()
-        match request:
-            case PublishRequest(topic, message):
-                await publish(route_map, topic, message)
-                await response_queue.put(OkResponse())
 
-            case SubscribeRequest(topic):
-                add_route(route_map, topic, response_queue)
-                await response_queue.put(OkResponse())
+class RouteChangeError(Exception):
+    pass
 
-            case UnsubscribeAllRequest(skip_response):
+
+class RouteMatchError(Exception):
+    pass
+
+
+def _split(topic: str) -> list[str]:
+    segments = topic.split("/")
+    if "#" in segments[:-1]:
+        raise RouteChangeError(f"Unable to handle topic: {topic}")
+    return segments
+
+
+def _prune(path: list[tuple[RouteSegment, str]]):
+    for parent, key in reversed(path):
+        if not parent.children[key].is_empty:
+            break
+        del parent.children[key]
+        if not parent.children:
+            parent.children = _NO_CHILDREN
+
+
+def _remove_route(route_map: RouteMap, segments: list[str], queue) -> bool:
+    node = route_map
+    path = []
+    for segment in segments:
+        child = node.children.get(segment)
+        if child is None:
+            return False
+        path.append((node, segment))
+        node = child
+    if not node.discard(queue):
+        return False
+    _prune(path)
+    return True
+
+
+def add_route(route_map: RouteMap, topic: str, queue):
+    segments = _split(topic)
+    topics = route_map.subscriptions.get(queue)
+    if topics is None:
+        topics = route_map.subscriptions[queue] = set()
+    elif topic in topics:
+        return
+
+    node = route_map
+    for segment in segments:
+        node = node.child(segment)
+    node.add(queue)
+    topics.add(topic)
+    route_map.generation += 1
+    if route_map.interest is not None:
+        route_map.interest.add(topic, queue)
+
+
+def add_routes(route_map: RouteMap, topics: list[Optional[str]], queue) -> list[bool]:
+    """
+    Subscribe the queue to every filter in topics in a single pass.
+
+    The filters are walked in sorted order, so each one continues from the trie
+    nodes it shares with the previous one. Returns whether each filter was accepted,
+    invalid filters are skipped.
+    """
+    subscribed = route_map.subscriptions.get(queue)
+    if subscribed is None:
+        subscribed = set()
+    accepted = {None: False}
+    added = []
+    nodes: list[RouteSegment] = [route_map]
+    previous: list[str] = []
+    for topic in sorted({topic for topic in topics if topic is not None}):
+        try:
+            segments = _split(topic)
+        except RouteChangeError:
+            accepted[topic] = False
+            continue
+        accepted[topic] = True
+        if topic in subscribed:
+            continue
+        common = 0
+        limit = min(len(segments), len(previous))
+        while common < limit and segments[common] == previous[common]:
+            common += 1
+        del nodes[common + 1 :]
+        node = nodes[-1]
+        for segment in segments[common:]:
+            node = node.child(segment)
+            nodes.append(node)
+        node.add(queue)
+        subscribed.add(topic)
+        added.append(topic)
+        previous = segments
+
+    if added:
+        route_map.subscriptions[queue] = subscribed
+        route_map.generation += 1
+        if route_map.interest is not None:
+            for topic in added:
+                route_map.interest.add(topic, queue)
+    return [accepted[topic] for topic in topics]
+
+
+def discard_routes(
+    route_map: RouteMap, topics: list[Optional[str]], queue
+) -> list[bool]:
+    """
+    Unsubscribe the queue from every filter in topics in a single pass.
+
+    The filters are walked in sorted order like in add_routes, nodes left empty are
+    pruned once the walk moves past them. Returns whether each filter was
+    subscribed, a repeated filter only was the first time.
+    """
+    subscribed = route_map.subscriptions.get(queue)
+    if subscribed is None:
+        return [False] * len(topics)
+    removed = set()
+    results = []
+    for topic in topics:
+        if topic in subscribed and topic not in removed:
+            removed.add(topic)
+            results.append(True)
+        else:
+            results.append(False)
+    if not removed:
+        return results
+
+    path: list[tuple[RouteSegment, str]] = []
+    node: RouteSegment = route_map
+    previous: list[str] = []
+    for topic in sorted(removed):
+        segments = topic.split("/")
+        common = 0
+        limit = min(len(segments), len(previous))
+        while common < limit and segments[common] == previous[common]:
+            common += 1
+        _prune(path[common:])
+        del path[common:]
+        node = path[-1][0].children[path[-1][1]] if path else route_map
+        for segment in segments[common:]:
+            path.append((node, segment))
+            node = node.children[segment]
+        node.discard(queue)
+        previous = segments
+    _prune(path)
+
+    subscribed -= removed
+    if not subscribed:
+        del route_map.subscriptions[queue]
+    route_map.generation += 1
+    if route_map.interest is not None:
+        for topic in removed:
+            route_map.interest.remove(topic, queue)
+    return results
+
+
+def remove_route(route_map: RouteMap, topic: str, queue):
+    if not _remove_route(route_map, _split(topic), queue):
+        raise RouteChangeError("Queue was not in route")
+    topics = route_map.subscriptions[queue]
+    topics.discard(topic)
+    if not topics:
+        del route_map.subscriptions[queue]
+    route_map.generation += 1
+    if route_map.interest is not None:
+        route_map.interest.remove(topic, queue)
+
+
+def remove_routes(route_map: RouteMap, queue):
+    topics = route_map.subscriptions.pop(queue, None)
+    if topics is None:
+        return
+    for topic in topics:
+        _remove_route(route_map, topic.split("/"), queue)
+    route_map.generation += 1
+    if route_map.interest is not None:
+        for topic in topics:
+            route_map.interest.remove(topic, queue)
+
+
+def _match_route(route_map: RouteSegment, topic: str) -> set:
+    segments = topic.split("/")
+    last = len(segments)
+    matched = set()
+    stack = [(route_map, 0)]
+    while stack:
+        node, index = stack.pop()
+        if index == last:
+            matched.update(node.routes)
+            continue
+        children = node.children
+        if not children:
+            continue
+        segment = segments[index]
+        index += 1
+        if segment == "#":
+            node.collect_all(matched)
+            continue
+        wildcard = children.get("#")
+        if wildcard is not None:
+            matched.update(wildcard.routes)
+        if segment == "+":
+            for key, child in children.items():
+                if key != "#":
+                    stack.append((child, index))
+            continue
+        child = children.get(segment)
+        if child is not None:
+            stack.append((child, index))
+        child = children.get("+")
+        if child is not None:
+            stack.append((child, index))
+    return matched
+
+
+def match_route(route_map: RouteMap, topic: str) -> set:
+    """
+    Return the subscribers whose filters match the topic, each exactly once.
+
+    Wildcards are accepted on both sides: "+" matches exactly one segment and "#"
+    matches the rest of the topic. When the match cache is enabled the returned set
+    is shared between calls and must not be modified.
+    """
+    if not route_map.cache_size:
+        return _match_route(route_map, topic)
+
+    cache = route_map.cache
+    entry = cache.get(topic)
+    if entry is not None and entry[0] == route_map.generation:
+        route_map.hits += 1
+        cache.move_to_end(topic)
+        return entry[1]
+
+    route_map.misses += 1
+    routes = _match_route(route_map, topic)
+    cache[topic] = (route_map.generation, routes)
+    cache.move_to_end(topic)
+    if len(cache) > route_map.cache_size:
+        cache.popitem(last=False)
+    return routes
+
+
+def _match_batched(route_map: RouteMap, topic: str, matches: Optional[dict]) -> set:
+    if matches is None:
+        return match_route(route_map, topic)
+    routes = matches.get(topic)
+    if routes is None:
+        routes = matches[topic] = match_route(route_map, topic)
+    return routes
+
+
+def publish(
+    route_map: RouteMap,
+    topic: str,
+    message: bytes,
+    from_peer: bool = False,
+    matches: Optional[dict] = None,
+):
+    """
+    Offer the message to every subscriber of the topic.
+
+    matches optionally memoizes topic matches within a batch, the caller must clear
+    it whenever the routes change.
+    """
+    if metrics.ENABLED:
+        return _publish_timed(route_map, topic, message, from_peer, matches)
+    routes = _match_batched(route_map, topic, matches)
+    if routes:
+        _deliver(route_map, routes, topic, message, from_peer)
+
+
+def _publish_timed(
+    route_map: RouteMap,
+    topic: str,
+    message: bytes,
+    from_peer: bool,
+    matches: Optional[dict],
+):
+    start = perf_counter()
+    routes = _match_batched(route_map, topic, matches)
+    matched = perf_counter()
+    metrics.MATCH_SECONDS.observe(matched - start)
+    metrics.PUBLISHES.inc()
+    if routes:
+        _deliver(route_map, routes, topic, message, from_peer)
+        metrics.FANOUT_SECONDS.observe(perf_counter() - matched)
+        metrics.DELIVERIES.inc(len(routes))
+
+
+def publish_batch(
+    route_map: RouteMap, messages: list[tuple[str, bytes]], from_peer: bool = False
+):
+    """
+    Offer a batch of messages, each subscriber getting its matches as one response.
+
+    Subscribers that match the same messages share the response. Batches with
+    long messages are published message by message, as their frames depend on the
+    framing of each subscriber.
+    """
+    for topic, message in messages:
+        if len(message) > 127 or len(topic) > 127:
+            for topic, message in messages:
+                publish(route_map, topic, message, from_peer)
+            return
+
+    deliveries: dict[ResponseQueue, list[int]] = {}
+    for index, (topic, _) in enumerate(messages):
+        for response_queue in match_route(route_map, topic):
+            if from_peer and response_queue.peer:
+                continue
+            indices = deliveries.get(response_queue)
+            if indices is None:
+                deliveries[response_queue] = [index]
+            else:
+                indices.append(index)
+
+    publishes: dict[int, PublishResponse] = {}
+    responses: dict[tuple[int, ...], Response] = {}
+    for response_queue, indices in deliveries.items():
+        key = tuple(indices)
+        response = responses.get(key)
+        if response is None:
+            for index in indices:
+                if index not in publishes:
+                    publishes[index] = PublishResponse(*messages[index])
+            if len(indices) == 1:
+                response = publishes[indices[0]]
+            else:
+                response = BatchResponse([publishes[index] for index in indices])
+            responses[key] = response
+        if not response_queue.offer(response) and response_queue.disconnected:
+            remove_routes(route_map, response_queue)
+
+    if metrics.ENABLED:
+        metrics.PUBLISHES.inc(len(messages))
+        metrics.DELIVERIES.inc(sum(map(len, deliveries.values())))
+
+
+def resolve_alias(route_map: RouteMap, alias: Alias) -> set:
+    if alias.generation != route_map.generation:
+        alias.routes = match_route(route_map, alias.topic)
+        alias.generation = route_map.generation
+    return alias.routes
+
+
+def publish_alias(
+    route_map: RouteMap, alias: Alias, message: bytes, from_peer: bool = False
+):
+    routes = resolve_alias(route_map, alias)
+    if metrics.ENABLED:
+        metrics.PUBLISHES.inc()
+        metrics.DELIVERIES.inc(len(routes))
+    if routes:
+        _deliver(route_map, routes, alias.topic, message, from_peer)
+
+
+def _deliver(
+    route_map: RouteMap, routes: set, topic: str, message: bytes, from_peer: bool
+):
+    if len(message) < 128 and len(topic) < 128:
+        _fan_out(route_map, routes, PublishResponse(topic, message), from_peer)
+        return
+
+    classic = None
+    if len(message) < 256 and len(topic) < 256:
+        classic = PublishResponse(topic, message)
+    extended = PublishResponse(topic, message, extended=True)
+    for response_queue in routes:
+        if from_peer and response_queue.peer:
+            continue
+        response = extended if response_queue.extended else classic
+        if response is None:
+            if metrics.ENABLED:
+                metrics.TOO_LONG.inc()
+            continue
+        if not response_queue.offer(response) and response_queue.disconnected:
+            remove_routes(route_map, response_queue)
+
+
+def start_stream(route_map: RouteMap, stream: Stream, from_peer: bool = False):
+    """
+    Start forwarding a stream to the extended subscribers of its topic.
+
+    Subscribers are resolved once, the ones that subscribe later miss the stream.
+    """
+    route_map.stream_ids += 1
+    stream.stream_id = route_map.stream_ids
+    if stream.topic is None:
+        return
+    routes = [
+        response_queue
+        for response_queue in match_route(route_map, stream.topic)
+        if not (from_peer and response_queue.peer)
+    ]
+    stream.routes = [
+        response_queue for response_queue in routes if response_queue.extended
+    ]
+    if metrics.ENABLED and len(stream.routes) < len(routes):
+        metrics.TOO_LONG.inc(len(routes) - len(stream.routes))
+    if stream.routes:
+        _offer_stream(
+            route_map,
+            stream,
+            StreamStartResponse(stream.stream_id, stream.topic, stream.length),
+        )
+
+
+def stream_data(
+    route_map: RouteMap, stream: Stream, chunk: bytes, response_queue: ResponseQueue
+):
+    """
+    Forward a chunk of a stream, acknowledging the publish after the last chunk.
+
+    A subscriber whose queue is full when a chunk arrives is dropped from the stream
+    and sent an abort, subject to its overflow policy.
+    """
+    if stream.routes:
+        _offer_stream(route_map, stream, StreamDataResponse(stream.stream_id, chunk))
+    if not chunk:
+        stream.routes = []
+        return
+    stream.remaining -= len(chunk)
+    if stream.remaining:
+        return
+    if stream.topic is None:
+        response_queue.offer(NokResponse())
+    elif stream.ack:
+        response_queue.offer(OkResponse())
+
+
+def _offer_stream(route_map: RouteMap, stream: Stream, response: Response):
+    dropped = []
+    for response_queue in stream.routes:
+        if response_queue.disconnected:
+            dropped.append(response_queue)
+        elif not response_queue.full():
+            response_queue.put_nowait(response)
+        else:
+            dropped.append(response_queue)
+            abort = StreamDataResponse(stream.stream_id, b"")
+            if not response_queue.offer(abort) and response_queue.disconnected:
                 remove_routes(route_map, response_queue)
-                if not skip_response:
-                    await response_queue.put(OkResponse())
+    if dropped:
+        stream.routes = [
+            response_queue
+            for response_queue in stream.routes
+            if response_queue not in dropped
+        ]
+
+
+def _fan_out(route_map: RouteMap, routes: set, response: Response, from_peer: bool):
+    for response_queue in routes:
+        if from_peer and response_queue.peer:
+            continue
+        if not response_queue.offer(response) and response_queue.disconnected:
+            remove_routes(route_map, response_queue)
+
+
+def handle_request(
+    route_map: RouteMap, response_queue: ResponseQueue, request: Request
+):
+    match request:
+        case PublishRequest(topic, message, ack):
+            publish(route_map, topic, message, response_queue.peer)
+            if ack:
+                response_queue.offer(OkResponse())
+
+        case AliasPublishRequest(alias, message, ack):
+            publish_alias(route_map, alias, message, response_queue.peer)
+            if ack:
+                response_queue.offer(OkResponse())
+
+        case RegisterRequest(alias_id):
+            response_queue.offer(RegisteredResponse(alias_id))
+
+        case StreamStartRequest(stream):
+            start_stream(route_map, stream, response_queue.peer)
+
+        case StreamDataRequest(stream, chunk):
+            stream_data(route_map, stream, chunk, response_queue)
+
+        case HelloRequest(version):
+            version = min(version, EXTENDED)
+            response_queue.offer(HelloResponse(version))
+            response_queue.extended = version == EXTENDED
+
+        case PublishBatchRequest(messages):
+            publish_batch(route_map, messages, response_queue.peer)
+            response_queue.offer(OkResponse())
+
+        case SubscribeRequest(topic):
+            try:
+                add_route(route_map, topic, response_queue)
+            except RouteChangeError as ex:
+                logger.info("Failed to change route", exc_info=ex)
+                response_queue.offer(NokResponse())
+            else:
+                response_queue.offer(OkResponse())
+
+        case SubscribeBulkRequest(topics):
+            results = add_routes(route_map, topics, response_queue)
+            response_queue.offer(BulkResponse(results))
+
+        case UnsubscribeBulkRequest(topics):
+            results = discard_routes(route_map, topics, response_queue)
+            response_queue.offer(BulkResponse(results))
+
+        case UnsubscribeAllRequest(skip_response):
+            remove_routes(route_map, response_queue)
+            if not skip_response:
+                response_queue.offer(OkResponse())
+
+        case UnsubscribeRequest(topic):
+            try:
+                remove_route(route_map, topic, response_queue)
+            except RouteChangeError as ex:
+                logger.info("Failed to change route", exc_info=ex)
+                response_queue.offer(NokResponse())
+            else:
+                response_queue.offer(OkResponse())
+
+        case InvalidRequest(reason):
+            logger.info(f"Invalid request: {reason}")
+            response_queue.offer(NokResponse())
+
+        case BatchRequest():
+            handle_batch(route_map, [(response_queue, request)])
+
+        case PongRequest():
+            pass
+
+        case CallRequest(function):
+            function()
 
-            case UnsubscribeRequest(topic):
-                # TODO errors
+        case _:
+            raise RuntimeError(f"Unhandled request type: {request}")
+
+
+def _flatten(batch: list[tuple[ResponseQueue, Request]]):
+    for response_queue, request in batch:
+        if isinstance(request, BatchRequest):
+            for batched_request in request.requests:
+                yield response_queue, batched_request
+        else:
+            yield response_queue, request
+
+
+def _apply_changes(route_map: RouteMap, changes: dict[tuple[ResponseQueue, str], bool]):
+    for (queue, topic), subscribe in changes.items():
+        topics = route_map.subscriptions.get(queue, ())
+        if subscribe and topic not in topics:
+            add_route(route_map, topic, queue)
+        elif not subscribe and topic in topics:
+            remove_route(route_map, topic, queue)
+    changes.clear()
+
+
+def handle_batch(route_map: RouteMap, batch: list[tuple[ResponseQueue, Request]]):
+    """
+    Handle a batch of requests in order.
+
+    Publishes to the same topic share one match while the routes are unchanged.
+    Subscribes and unsubscribes are acknowledged right away but only applied when a
+    publish or the end of the batch needs them, so churn on the same filter from the
+    same connection costs at most one route change.
+    """
+    matches = {}
+    generation = route_map.generation
+    changes: dict[tuple[ResponseQueue, str], bool] = {}
+    for response_queue, request in _flatten(batch):
+        match request:
+            case PublishRequest(topic, message, ack):
+                if changes:
+                    _apply_changes(route_map, changes)
+                if route_map.generation != generation:
+                    matches.clear()
+                    generation = route_map.generation
+                publish(route_map, topic, message, response_queue.peer, matches)
+                if ack:
+                    response_queue.offer(OkResponse())
+
+            case SubscribeRequest(topic):
                 try:
-                    remove_route(route_map, topic, response_queue)
+                    _split(topic)
                 except RouteChangeError as ex:
                     logger.info("Failed to change route", exc_info=ex)
-                    await response_queue.put(NokResponse())
+                    response_queue.offer(NokResponse())
                 else:
-                    await response_queue.put(OkResponse())
+                    changes[response_queue, topic] = True
+                    response_queue.offer(OkResponse())
 
-            case PongRequest():
-                pass
+            case UnsubscribeRequest(topic):
+                subscribed = changes.get((response_queue, topic))
+                if subscribed is None:
+                    topics = route_map.subscriptions.get(response_queue, ())
+                    subscribed = topic in topics
+                if subscribed:
+                    changes[response_queue, topic] = False
+                    response_queue.offer(OkResponse())
+                else:
+                    logger.info(f"Failed to change route: {topic} was not subscribed")
+                    response_queue.offer(NokResponse())
 
             case _:
-                raise RuntimeError(f"Unhandled request type: {request}")
-
-        request_queue.task_done()
+                if changes:
+                    _apply_changes(route_map, changes)
+                handle_request(route_map, response_queue, request)
+    if changes:
+        _apply_changes(route_map, changes)
+
+
+def register_metrics(route_map: RouteMap, request_queue: RequestQueue):
+    subscriptions = route_map.subscriptions
+    metrics.SUBSCRIPTIONS.function = lambda: sum(map(len, subscriptions.values()))
+    metrics.REQUEST_QUEUE_DEPTH.function = request_queue.qsize
+    metrics.RESPONSE_QUEUE_DEPTH.function = lambda: sum(
+        queue.qsize() for queue in subscriptions
+    )
+    metrics.MATCH_CACHE_HITS.function = lambda: route_map.hits
+    metrics.MATCH_CACHE_MISSES.function = lambda: route_map.misses
+
+
+async def route(request_queue: RequestQueue, route_map: Optional[RouteMap] = None):
+    if route_map is None:
+        route_map = RouteMap(cache_size=settings.MATCH_CACHE_SIZE)
+    if metrics.ENABLED:
+        register_metrics(route_map, request_queue)
+
+    batch_size = settings.ROUTE_BATCH_SIZE
+    while 1:
+        batch = [await request_queue.get()]
+        while len(batch) < batch_size and not request_queue.empty():
+            batch.append(request_queue.get_nowait())
+        handle_batch(route_map, batch)
+        for _ in batch:
+            request_queue.task_done()
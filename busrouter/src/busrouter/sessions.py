@@ -0,0 +1,180 @@
+import logging
+from asyncio import QueueFull
+from collections import deque
+from functools import partial
+from typing import Optional
+
+from busrouter import metrics, settings
+from busrouter.router import (
+    BatchResponse,
+    Outbox,
+    PublishResponse,
+    Request,
+    RequestQueue,
+    Response,
+    RouteMap,
+    SessionResponse,
+    UnsubscribeAllRequest,
+    handle_request,
+)
+from busrouter.timers import Timer, get_wheel
+
+logger = logging.getLogger(__name__)
+
+
+class Session:
+    """
+    The subscriptions of a client, kept across its connections.
+
+    The session is the subscriber in the route map, so resuming it on a new
+    connection restores every subscription without touching the trie. While a
+    connection is attached, responses are passed on to its outbox. While detached,
+    publishes are buffered up to buffer_size, dropping the oldest, and everything
+    else is dropped.
+    """
+
+    __slots__ = (
+        "token",
+        "outbox",
+        "buffer",
+        "buffer_size",
+        "overflows",
+        "disconnected",
+        "peer",
+        "extended",
+        "timer",
+        "claims",
+    )
+
+    def __init__(self, token: str, buffer_size: int = settings.SESSION_BUFFER_SIZE):
+        self.token = token
+        self.outbox: Optional[Outbox] = None
+        self.buffer: Optional[deque[Response]] = None
+        self.buffer_size = buffer_size
+        self.overflows = 0
+        self.disconnected = False
+        self.peer = False
+        self.extended = False
+        self.timer: Optional[Timer] = None
+        # Connections that took the session but are not attached yet
+        self.claims = 0
+
+    def qsize(self) -> int:
+        if self.outbox is not None:
+            return self.outbox.qsize()
+        return len(self.buffer) if self.buffer is not None else 0
+
+    def empty(self) -> bool:
+        return not self.qsize()
+
+    def full(self) -> bool:
+        # Streams can not be resumed, a detached session is dropped from them
+        return self.outbox is None or self.outbox.full()
+
+    def put_nowait(self, response: Response):
+        if self.outbox is None:
+            raise QueueFull
+        self.outbox.put_nowait(response)
+
+    def offer(self, response: Response) -> bool:
+        outbox = self.outbox
+        if outbox is not None:
+            return outbox.offer(response)
+        if self.disconnected:
+            return False
+        if not isinstance(response, (PublishResponse, BatchResponse)):
+            return False
+        buffer = self.buffer
+        if buffer is None:
+            buffer = self.buffer = deque(maxlen=self.buffer_size)
+        elif len(buffer) == self.buffer_size:
+            self.overflows += 1
+            if metrics.ENABLED:
+                metrics.OVERFLOWS.inc()
+        buffer.append(response)
+        return True
+
+
+class Sessions:
+    """
+    The sessions of a router, by token.
+
+    A session is kept for SESSION_GRACE seconds after its connection is lost. If it
+    is not resumed in time its subscriptions are dropped, through the request queue
+    or right away when a route map is given.
+    """
+
+    def __init__(
+        self, request_queue: RequestQueue, route_map: Optional[RouteMap] = None
+    ):
+        self.request_queue = request_queue
+        self.route_map = route_map
+        self.sessions: dict[str, Session] = {}
+        if metrics.ENABLED:
+            metrics.SESSIONS.function = self.sessions.__len__
+
+    def take(self, token: str) -> tuple[Session, bool]:
+        """
+        Claim the session of the token for a connection that attaches to it later,
+        creating a new session if there is none. Returns the session and whether it
+        already existed.
+
+        A claimed session does not expire before the connection is attached.
+        """
+        session = self.sessions.get(token)
+        resumed = session is not None
+        if session is None:
+            session = self.sessions[token] = Session(token)
+            session.timer = Timer(partial(self.expire, session))
+        else:
+            get_wheel().cancel(session.timer)
+        session.claims += 1
+        return session, resumed
+
+    def attach(self, session: Session, outbox: Outbox, extended: bool, resumed: bool):
+        """
+        Attach the outbox to a session claimed with take.
+
+        The outbox is sent whether the session was resumed, followed by the publishes
+        it missed. A connection that still holds the session is disconnected.
+        """
+        session.claims -= 1
+        if outbox.disconnected:
+            # The connection was lost before it got the session
+            if session.outbox is None and not session.claims:
+                get_wheel().schedule(session.timer, settings.SESSION_GRACE)
+            return
+        if session.outbox is not None:
+            logger.info("Session taken over, disconnecting previous connection")
+            session.outbox.disconnected = True
+            session.outbox.wakeup()
+
+        session.outbox = outbox
+        session.extended = extended
+        outbox.offer(SessionResponse(resumed))
+        buffer = session.buffer
+        session.buffer = None
+        if buffer:
+            for response in buffer:
+                outbox.offer(response)
+
+    def suspend(self, session: Session, outbox: Outbox):
+        if session.outbox is not outbox:
+            # Already resumed by another connection
+            return
+        session.outbox = None
+        if not session.claims:
+            get_wheel().schedule(session.timer, settings.SESSION_GRACE)
+
+    def expire(self, session: Session):
+        logger.info("Session expired")
+        del self.sessions[session.token]
+        session.disconnected = True
+        session.buffer = None
+        self.dispatch(session, UnsubscribeAllRequest(skip_response=True))
+
+    def dispatch(self, session: Session, request: Request):
+        if self.route_map is not None:
+            handle_request(self.route_map, session, request)
+        else:
+            self.request_queue.put_nowait((session, request))
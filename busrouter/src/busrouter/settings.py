@@ -8,9 +8,62 @@ def env(key, cast: Callable[[str], T], default: str) -> T:
     return cast(os.environ.get(key, default))
 
 
+def flag(value: str) -> bool:
+    return value.lower() in ("1", "true", "yes")
+
+
+def addresses(value: str) -> list[tuple[str, int]]:
+    result = []
+    for address in value.split(","):
+        if address.strip():
+            host, _, port = address.strip().rpartition(":")
+            result.append((host, int(port)))
+    return result
+
+
+def overflow(value: str) -> str:
+    if value not in ("drop-newest", "drop-oldest", "disconnect"):
+        raise ValueError(f"Unknown overflow policy: {value}")
+    return value
+
+
 BUSROUTER_HOST = env("BUSROUTER_HOST", str, "0.0.0.0")
 BUSROUTER_PORT = env("BUSROUTER_PORT", int, "42069")
 MAPPER_SETUP_URL = env("MAPPER_SETUP_URL", str, "http://localhost:8000/v1/routes/")
+MAPPER_SYNC_INTERVAL = env("MAPPER_SYNC_INTERVAL", float, "30")
+# How long a poll of the busman change feed waits for route changes
+MAPPER_WAIT = env("MAPPER_WAIT", float, "25")
 PING_INTERVAL = env("PING_INTERVAL", float, "10")
 PONG_GRACE = env("PONG_GRACE", float, "10")
 TIMEOUT = PING_INTERVAL + PONG_GRACE
+# Resolution of the keepalive timers
+TIMER_TICK = env("TIMER_TICK", float, "0.25")
+RESPONSE_QUEUE_SIZE = env("RESPONSE_QUEUE_SIZE", int, "1024")
+# drop-newest, drop-oldest or disconnect
+RESPONSE_QUEUE_OVERFLOW = env("RESPONSE_QUEUE_OVERFLOW", overflow, "drop-oldest")
+# Overflow policy of the queues to other workers and nodes
+PEER_QUEUE_OVERFLOW = env("PEER_QUEUE_OVERFLOW", overflow, RESPONSE_QUEUE_OVERFLOW)
+WRITE_HIGH_WATER = env("WRITE_HIGH_WATER", int, "65536")
+MATCH_CACHE_SIZE = env("MATCH_CACHE_SIZE", int, "4096")
+ROUTE_BATCH_SIZE = env("ROUTE_BATCH_SIZE", int, "256")
+# Topic aliases a single connection may register
+MAX_ALIASES = env("MAX_ALIASES", int, "1024")
+# Extended framing publishes longer than this are streamed instead of buffered
+STREAM_THRESHOLD = env("STREAM_THRESHOLD", int, "4096")
+# Seconds a session outlives its connection, 0 disables sessions
+SESSION_GRACE = env("SESSION_GRACE", float, "60")
+# Publishes buffered for a disconnected session
+SESSION_BUFFER_SIZE = env("SESSION_BUFFER_SIZE", int, "256")
+WORKERS = env("WORKERS", int, "1")
+IPC_DIR = env("IPC_DIR", str, f"/tmp/busrouter-{BUSROUTER_PORT}")
+PEER_RETRY_INTERVAL = env("PEER_RETRY_INTERVAL", float, "0.1")
+# Federation with other nodes, 0 disables it. PEERS lists the host:port of every
+# other node, separated by commas.
+PEER_HOST = env("PEER_HOST", str, BUSROUTER_HOST)
+PEER_PORT = env("PEER_PORT", int, "0")
+PEERS = env("PEERS", addresses, "")
+# Route requests in the connection handler instead of the router task
+DIRECT_ROUTING = env("DIRECT_ROUTING", flag, "0")
+METRICS_ENABLED = env("METRICS_ENABLED", flag, "0")
+METRICS_HOST = env("METRICS_HOST", str, "127.0.0.1")
+METRICS_PORT = env("METRICS_PORT", int, "42070")
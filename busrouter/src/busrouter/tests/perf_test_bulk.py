@@ -0,0 +1,114 @@
+"""
+Benchmark subscribing a large subscriber to many filters.
+
+Spawns the router and subscribes a connection to --filters filters over loopback
+TCP, one subscribe at a time waiting for each acknowledgement as clients used to,
+and with bulk subscribes of up to 255 filters each.
+
+    python -m busrouter.tests.perf_test_bulk --filters 1000 10000
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from busrouter.tests.perf_test_load import (
+    HOST,
+    free_port,
+    str_to_length_prefixed_bytes,
+    wait_for_port,
+)
+
+
+async def one_by_one(port: int, topics: list[str]) -> float:
+    reader, writer = await asyncio.open_connection(HOST, port)
+    writer.write(b"!")
+    start = time.perf_counter()
+    for topic in topics:
+        writer.write(b"+" + str_to_length_prefixed_bytes(topic))
+        while (response := await reader.readexactly(1)) == b"?":
+            writer.write(b"!")
+        assert response == b"k", response
+    elapsed = time.perf_counter() - start
+    writer.close()
+    return elapsed
+
+
+async def bulk(port: int, topics: list[str]) -> float:
+    reader, writer = await asyncio.open_connection(HOST, port)
+    writer.write(b"!")
+    start = time.perf_counter()
+    for offset in range(0, len(topics), 255):
+        chunk = topics[offset : offset + 255]
+        writer.write(
+            b"["
+            + len(chunk).to_bytes(1)
+            + b"".join([str_to_length_prefixed_bytes(topic) for topic in chunk])
+        )
+    for offset in range(0, len(topics), 255):
+        while (response := await reader.readexactly(1)) == b"?":
+            writer.write(b"!")
+        assert response == b"[", response
+        count = (await reader.readexactly(1))[0]
+        failed = await reader.readexactly((count + 7) // 8)
+        assert not any(failed)
+    elapsed = time.perf_counter() - start
+    writer.close()
+    return elapsed
+
+
+async def run(config) -> list[dict]:
+    port = free_port()
+    env = dict(
+        os.environ,
+        BUSROUTER_HOST=HOST,
+        BUSROUTER_PORT=str(port),
+        PYTHONPATH=str(Path(__file__).parents[2]),
+    )
+    results = []
+    with tempfile.TemporaryDirectory() as cwd:
+        process = subprocess.Popen(
+            [sys.executable, "-m", "busrouter.busrouter"],
+            env=env,
+            cwd=cwd,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            await wait_for_port(port)
+            for filters in config.filters:
+                result = {"filters": filters}
+                for name, subscribe in (("one_by_one", one_by_one), ("bulk", bulk)):
+                    topics = [f"{name}/{filters}/{n}/+/#" for n in range(filters)]
+                    result[f"{name}_seconds"] = await subscribe(port, topics)
+                print(
+                    f"{filters:>7} filters: one by one "
+                    f"{result['one_by_one_seconds'] * 1000:8.1f} ms, "
+                    f"bulk {result['bulk_seconds'] * 1000:6.1f} ms"
+                )
+                results.append(result)
+        finally:
+            process.terminate()
+            process.wait()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--filters", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--output", help="write results as JSON to this file")
+    config = parser.parse_args()
+
+    results = asyncio.run(run(config))
+    if config.output:
+        Path(config.output).write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
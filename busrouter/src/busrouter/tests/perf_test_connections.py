@@ -0,0 +1,154 @@
+"""
+Memory used by idle device connections.
+
+Spawns the router, opens idle loopback connections to it in steps and reports the
+router's resident memory per connection at each step. The client side is spread
+over several loopback source addresses, so 100k connections do not run out of
+ephemeral ports. Both processes need a file descriptor limit above the number of
+connections.
+
+    python -m busrouter.tests.perf_test_connections --connections 10000 50000 100000
+"""
+
+import argparse
+import json
+import os
+import resource
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from pathlib import Path
+
+HOST = "127.0.0.1"
+CONNECTIONS_PER_ADDRESS = 25_000
+LINGER_RESET = struct.pack("ii", 1, 0)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+def rss(pid: int) -> int:
+    for line in Path(f"/proc/{pid}/status").read_text().splitlines():
+        if line.startswith("VmRSS:"):
+            return int(line.split()[1]) * 1024
+    raise RuntimeError("No VmRSS")
+
+
+def connections_gauge(metrics_port: int) -> int:
+    url = f"http://{HOST}:{metrics_port}/metrics"
+    with urllib.request.urlopen(url, timeout=10) as response:
+        for line in response.read().decode().splitlines():
+            if line.startswith("busrouter_connections "):
+                return int(float(line.split()[1]))
+    raise RuntimeError("No connections gauge")
+
+
+def wait_for(condition, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError
+        time.sleep(0.1)
+
+
+def connect(port: int, index: int) -> socket.socket:
+    sock = socket.socket()
+    sock.bind((f"127.0.0.{2 + index // CONNECTIONS_PER_ADDRESS}", 0))
+    sock.connect((HOST, port))
+    sock.sendall(b"!")
+    return sock
+
+
+def raise_file_limit(connections: int):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = connections + 1000
+    if hard != resource.RLIM_INFINITY and hard < wanted:
+        sys.exit(f"File descriptor limit {hard} is too low for {connections}")
+    resource.setrlimit(resource.RLIMIT_NOFILE, (max(soft, wanted), hard))
+
+
+def run(config) -> list[dict]:
+    raise_file_limit(max(config.connections))
+    port = free_port()
+    metrics_port = free_port()
+    env = dict(
+        os.environ,
+        BUSROUTER_HOST=HOST,
+        BUSROUTER_PORT=str(port),
+        METRICS_ENABLED="1",
+        METRICS_PORT=str(metrics_port),
+        # Idle connections, no keepalive traffic during the run
+        PING_INTERVAL="3600",
+        PYTHONPATH=str(Path(__file__).parents[2]),
+    )
+    results = []
+    sockets = []
+    with tempfile.TemporaryDirectory() as cwd:
+        process = subprocess.Popen(
+            [sys.executable, "-m", "busrouter.busrouter"],
+            env=env,
+            cwd=cwd,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            wait_for(lambda: _reachable(metrics_port))
+            baseline = rss(process.pid)
+            for target in sorted(config.connections):
+                start = time.monotonic()
+                while len(sockets) < target:
+                    sockets.append(connect(port, len(sockets)))
+                wait_for(lambda: connections_gauge(metrics_port) >= target)
+                elapsed = time.monotonic() - start
+                used = rss(process.pid) - baseline
+                result = {
+                    "connections": target,
+                    "rss_mib": used / 2**20,
+                    "bytes_per_connection": used / target,
+                    "connect_seconds": elapsed,
+                }
+                print(
+                    f"{target:>8} connections: {result['rss_mib']:8.1f} MiB, "
+                    f"{result['bytes_per_connection']:6.0f} B/connection"
+                )
+                results.append(result)
+        finally:
+            for sock in sockets:
+                # Reset instead of leaving the client ports in TIME_WAIT
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, LINGER_RESET)
+                sock.close()
+            process.terminate()
+            process.wait()
+    return results
+
+
+def _reachable(metrics_port: int) -> bool:
+    try:
+        connections_gauge(metrics_port)
+    except OSError:
+        return False
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--connections", type=int, nargs="+", default=[10_000, 50_000, 100_000]
+    )
+    parser.add_argument("--output", help="write results as JSON to this file")
+    config = parser.parse_args()
+
+    results = run(config)
+    if config.output:
+        Path(config.output).write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""
+Benchmark forwarding published messages from sources to sinks.
+
+Loads routes from src/<n> to dst/<n>, with a subscriber on every sink, and
+publishes to random sources. The same messages published straight to the sinks
+give the baseline, the difference is the cost of forwarding.
+
+    python -m busrouter.tests.perf_test_forward --routes 1000 --messages 200000
+
+With --sync it instead times refreshing a table of --routes routes. The mapper used
+to unsubscribe everything and resubscribe each source with a round trip through
+the request queue, it now applies the difference to the table it holds.
+
+    python -m busrouter.tests.perf_test_forward --sync --routes 20000
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+from pathlib import Path
+
+from busrouter import settings
+from busrouter.mapper import Forwarder
+from busrouter.router import (
+    RequestQueue,
+    ResponseQueue,
+    RouteMap,
+    SubscribeRequest,
+    UnsubscribeAllRequest,
+    add_route,
+    publish,
+    route,
+)
+
+
+def run(config) -> dict:
+    route_map = RouteMap(cache_size=settings.MATCH_CACHE_SIZE)
+    forwarder = Forwarder(route_map)
+    routes = [(f"src/{n}", f"dst/{n}") for n in range(config.routes)]
+    if config.wildcards:
+        routes.append(("src/#", "dst/all"))
+    forwarder.load(routes)
+
+    queues = []
+    for _, sink in routes:
+        queue = ResponseQueue(maxsize=0)
+        add_route(route_map, sink, queue)
+        queues.append(queue)
+
+    random.seed(config.seed)
+    targets = [random.randrange(config.routes) for _ in range(config.messages)]
+    message = bytes(config.payload)
+    results = {}
+    for name, prefix in (("direct", "dst"), ("forwarded", "src")):
+        topics = [f"{prefix}/{n}" for n in targets]
+        start = time.perf_counter()
+        for topic in topics:
+            publish(route_map, topic, message)
+        elapsed = time.perf_counter() - start
+        delivered = sum(queue.qsize() for queue in queues)
+        for queue in queues:
+            while not queue.empty():
+                queue.get_nowait()
+        results[name] = {
+            "messages_per_second": config.messages / elapsed,
+            "us_per_message": elapsed / config.messages * 1e6,
+            "delivered": delivered,
+        }
+        print(
+            f"{name:>9}: {results[name]['messages_per_second']:>10.0f} msg/s, "
+            f"{results[name]['us_per_message']:5.2f} us/msg, "
+            f"{delivered} delivered"
+        )
+    return results
+
+
+async def resubscribe(routes: list[tuple[str, str]]) -> float:
+    request_queue = RequestQueue()
+    router = asyncio.create_task(route(request_queue, RouteMap()))
+    response_queue = ResponseQueue()
+    start = time.perf_counter()
+    await request_queue.put((response_queue, UnsubscribeAllRequest()))
+    await response_queue.get()
+    for source, _ in routes:
+        await request_queue.put((response_queue, SubscribeRequest(source)))
+        await response_queue.get()
+    elapsed = time.perf_counter() - start
+    router.cancel()
+    return elapsed
+
+
+def timed(function, *args) -> float:
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def sync(config) -> dict:
+    routes = [(f"src/{n}/+", f"dst/{n % 100}") for n in range(config.routes)]
+    changed = routes[config.routes // 100 :] + [
+        (f"new/{n}", "dst/new") for n in range(config.routes // 100)
+    ]
+    forwarder = Forwarder(RouteMap(cache_size=settings.MATCH_CACHE_SIZE))
+    results = {
+        "resubscribe_seconds": asyncio.run(resubscribe(routes)),
+        "initial_load_seconds": timed(forwarder.load, routes),
+        "unchanged_seconds": timed(forwarder.load, routes),
+        "one_percent_changed_seconds": timed(forwarder.load, changed),
+    }
+    for name, seconds in results.items():
+        print(f"{name:>28}: {seconds * 1000:8.1f} ms")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--routes", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=200_000)
+    parser.add_argument("--payload", type=int, default=16)
+    parser.add_argument(
+        "--wildcards", action="store_true", help="also forward src/# to dst/all"
+    )
+    parser.add_argument("--sync", action="store_true", help="time route refreshes")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write results as JSON to this file")
+    config = parser.parse_args()
+
+    results = sync(config) if config.sync else run(config)
+    if config.output:
+        Path(config.output).write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
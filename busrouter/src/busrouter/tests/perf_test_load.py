@@ -0,0 +1,410 @@
+"""
+End-to-end load test for busrouter.
+
+Publishers publish to load/<n> and subscribers subscribe either to one of those
+topics or, for the wildcard share, to load/+ or load/#. Every message carries its
+send time, so subscribers can measure end-to-end latency.
+
+    python -m busrouter.tests.perf_test_load --publishers 4 --subscribers 16 \\
+        --wildcards 0.25 --payload 64 --duration 10 --output results.json
+
+With --mode process the router is spawned as a separate process and driven over
+loopback TCP, optionally as --workers router processes sharing the port, or as
+--nodes federated routers with their own ports that clients are spread over. With
+--mode inprocess the route() coroutine is driven directly through its queues,
+which measures the router without the network stack. --direct routes requests
+where they are received instead of through the request queue and router task.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from array import array
+from itertools import cycle
+from pathlib import Path
+
+from busrouter.router import (
+    Alias,
+    AliasPublishRequest,
+    BatchResponse,
+    PublishBatchRequest,
+    PublishRequest,
+    PublishResponse,
+    RequestQueue,
+    ResponseQueue,
+    RouteMap,
+    SubscribeRequest,
+    handle_request,
+    route,
+)
+
+HOST = "127.0.0.1"
+
+
+class Stats:
+    def __init__(self):
+        self.published = 0
+        self.latencies = array("q")
+
+
+def str_to_length_prefixed_bytes(s: str) -> bytes:
+    b = s.encode("ascii")
+    return len(b).to_bytes(1) + b
+
+
+def make_payload(size: int) -> bytes:
+    return time.monotonic_ns().to_bytes(8) + bytes(max(size - 8, 0))
+
+
+def record(stats: Stats, message: bytes):
+    stats.latencies.append(time.monotonic_ns() - int.from_bytes(message[:8]))
+
+
+def subscriber_topics(config) -> list[str]:
+    topics = []
+    for _ in range(config.subscribers):
+        if random.random() < config.wildcards:
+            topics.append(random.choice(["load/+", "load/#"]))
+        else:
+            topics.append(f"load/{random.randrange(config.publishers)}")
+    return topics
+
+
+def parse_frames(buffer: bytearray, stats: Stats) -> bytes:
+    """
+    Consume complete frames from buffer, recording latencies of publishes.
+
+    Returns the single-byte responses seen.
+    """
+    responses = bytearray()
+    offset = 0
+    size = len(buffer)
+    while offset < size:
+        cmd = buffer[offset]
+        if cmd != ord("@"):
+            responses.append(cmd)
+            offset += 1
+            continue
+        if offset + 2 > size:
+            break
+        start = offset + 2 + buffer[offset + 1] + 1
+        if start > size:
+            break
+        end = start + buffer[start - 1]
+        if end > size:
+            break
+        record(stats, bytes(buffer[start:end]))
+        offset = end
+    del buffer[:offset]
+    return bytes(responses)
+
+
+async def tcp_subscriber(port: int, topic: str, stats: Stats, ready: asyncio.Event):
+    reader, writer = await asyncio.open_connection(HOST, port)
+    writer.write(b"!+" + str_to_length_prefixed_bytes(topic))
+    buffer = bytearray()
+    while 1:
+        data = await reader.read(65536)
+        if not data:
+            return
+        buffer += data
+        responses = parse_frames(buffer, stats)
+        if b"k" in responses:
+            ready.set()
+        if b"?" in responses:
+            writer.write(b"!")
+
+
+async def tcp_publisher(port: int, topic: str, config, stats: Stats):
+    reader, writer = await asyncio.open_connection(HOST, port)
+    writer.write(b"!")
+    pair = str_to_length_prefixed_bytes(topic) + bytes([config.payload])
+    if config.batch > 1:
+        prefix = b"*" + bytes([config.batch])
+    elif config.alias:
+        writer.write(b"=" + str_to_length_prefixed_bytes(topic))
+        while (response := await reader.readexactly(1)) == b"?":
+            writer.write(b"!")
+        assert response == b"=", response
+        alias_id = await reader.readexactly(2)
+        prefix = (b"%" if config.no_ack else b"$") + alias_id
+        pair = bytes([config.payload])
+    else:
+        prefix = b"&" if config.no_ack else b"@"
+    try:
+        while 1:
+            payload = make_payload(config.payload)
+            writer.write(prefix + (pair + payload) * config.batch)
+            await writer.drain()
+            stats.published += config.batch
+            if config.no_ack:
+                await asyncio.sleep(0)
+                continue
+            while (response := await reader.readexactly(1)) == b"?":
+                writer.write(b"!")
+            assert response == b"k", response
+    finally:
+        writer.close()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+async def wait_for_port(port: int, timeout: float = 10):
+    deadline = time.monotonic() + timeout
+    while 1:
+        try:
+            _, writer = await asyncio.open_connection(HOST, port)
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+        else:
+            writer.close()
+            return
+
+
+async def run_process(config, stats: Stats):
+    ports = [free_port() for _ in range(config.nodes)]
+    peer_ports = [free_port() for _ in range(config.nodes)]
+    processes = []
+    with tempfile.TemporaryDirectory() as cwd:
+        try:
+            for node, port in enumerate(ports):
+                env = dict(
+                    os.environ,
+                    BUSROUTER_HOST=HOST,
+                    BUSROUTER_PORT=str(port),
+                    WORKERS=str(config.workers),
+                    DIRECT_ROUTING="1" if config.direct else "0",
+                    PYTHONPATH=str(Path(__file__).parents[2]),
+                )
+                if config.nodes > 1:
+                    env["PEER_PORT"] = str(peer_ports[node])
+                    env["PEERS"] = ",".join(
+                        f"{HOST}:{peer_port}"
+                        for peer_port in peer_ports
+                        if peer_port != peer_ports[node]
+                    )
+                node_cwd = os.path.join(cwd, str(node))
+                os.mkdir(node_cwd)
+                processes.append(
+                    subprocess.Popen(
+                        [sys.executable, "-m", "busrouter.busrouter"],
+                        env=env,
+                        cwd=node_cwd,
+                        stdout=subprocess.DEVNULL,
+                        stderr=subprocess.DEVNULL,
+                    )
+                )
+            for port in ports:
+                await wait_for_port(port)
+            subscriber_ports = cycle(ports)
+            publisher_ports = cycle(ports)
+            await run_clients(
+                config,
+                stats,
+                lambda topic, ready: tcp_subscriber(
+                    next(subscriber_ports), topic, stats, ready
+                ),
+                lambda topic: tcp_publisher(
+                    next(publisher_ports), topic, config, stats
+                ),
+            )
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait()
+
+
+async def queue_subscriber(submit, topic: str, stats: Stats, ready: asyncio.Event):
+    response_queue = ResponseQueue()
+    await submit(response_queue, SubscribeRequest(topic))
+    await response_queue.get()
+    ready.set()
+    while 1:
+        response = await response_queue.get()
+        if isinstance(response, PublishResponse):
+            record(stats, response.message)
+        elif isinstance(response, BatchResponse):
+            for publish_response in response.responses:
+                record(stats, publish_response.message)
+
+
+async def queue_publisher(submit, topic: str, config, stats):
+    response_queue = ResponseQueue()
+    alias = Alias(topic)
+    while 1:
+        payload = make_payload(config.payload)
+        if config.batch > 1:
+            request = PublishBatchRequest([(topic, payload)] * config.batch)
+        elif config.alias:
+            request = AliasPublishRequest(alias, payload, not config.no_ack)
+        else:
+            request = PublishRequest(topic, payload, not config.no_ack)
+        await submit(response_queue, request)
+        stats.published += config.batch
+        if config.no_ack:
+            await asyncio.sleep(0)
+        else:
+            await response_queue.get()
+
+
+async def run_inprocess(config, stats: Stats):
+    request_queue = RequestQueue()
+    route_map = RouteMap()
+    router = asyncio.create_task(route(request_queue, route_map))
+
+    if config.direct:
+
+        async def submit(response_queue, request):
+            handle_request(route_map, response_queue, request)
+            # The response is already queued, yield as a remote client would
+            await asyncio.sleep(0)
+
+    else:
+
+        async def submit(response_queue, request):
+            await request_queue.put((response_queue, request))
+
+    try:
+        await run_clients(
+            config,
+            stats,
+            lambda topic, ready: queue_subscriber(submit, topic, stats, ready),
+            lambda topic: queue_publisher(submit, topic, config, stats),
+        )
+    finally:
+        router.cancel()
+
+
+async def run_clients(config, stats: Stats, subscriber, publisher):
+    subscribers = []
+    for topic in subscriber_topics(config):
+        ready = asyncio.Event()
+        subscribers.append(asyncio.create_task(subscriber(topic, ready)))
+        await ready.wait()
+    if config.nodes > 1:
+        # Let the interest reach the other nodes
+        await asyncio.sleep(0.5)
+
+    publishers = [
+        asyncio.create_task(publisher(f"load/{n}")) for n in range(config.publishers)
+    ]
+    await asyncio.sleep(config.duration)
+    for task in publishers:
+        task.cancel()
+    # Let in-flight messages arrive
+    await asyncio.sleep(0.5)
+    for task in subscribers:
+        task.cancel()
+    await asyncio.gather(*publishers, *subscribers, return_exceptions=True)
+
+
+def percentile(values: list[int], fraction: float) -> float:
+    if not values:
+        return 0
+    return values[min(int(len(values) * fraction), len(values) - 1)] / 1000
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=Path(__file__).parent,
+        ).stdout.strip()
+    except OSError:
+        return ""
+
+
+def report(config, stats: Stats) -> dict:
+    latencies = sorted(stats.latencies)
+    return {
+        "revision": git_revision(),
+        "config": vars(config),
+        "published": stats.published,
+        "delivered": len(latencies),
+        "publishes_per_second": stats.published / config.duration,
+        "deliveries_per_second": len(latencies) / config.duration,
+        "latency_us": {
+            "p50": percentile(latencies, 0.5),
+            "p99": percentile(latencies, 0.99),
+            "p999": percentile(latencies, 0.999),
+            "max": percentile(latencies, 1),
+        },
+    }
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--mode", choices=["process", "inprocess"], default="process")
+    parser.add_argument("--publishers", type=int, default=1)
+    parser.add_argument("--subscribers", type=int, default=1)
+    parser.add_argument(
+        "--wildcards", type=float, default=0, help="share of wildcard subscribers"
+    )
+    parser.add_argument(
+        "--payload", type=int, default=16, help="message size, 8 to 255 bytes"
+    )
+    parser.add_argument("--duration", type=float, default=5, help="seconds")
+    parser.add_argument("--no-ack", action="store_true", help="fire-and-forget")
+    parser.add_argument(
+        "--alias", action="store_true", help="publish by a registered topic alias"
+    )
+    parser.add_argument(
+        "--batch", type=int, default=1, help="messages per batch publish, 1 to 255"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1, help="router processes in process mode"
+    )
+    parser.add_argument(
+        "--nodes", type=int, default=1, help="federated routers in process mode"
+    )
+    parser.add_argument(
+        "--direct",
+        action="store_true",
+        help="route in the connection handler, skipping the request queue",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write results as JSON to this file")
+    config = parser.parse_args(args)
+    if not 8 <= config.payload <= 255:
+        parser.error("--payload must be between 8 and 255")
+    if not 1 <= config.batch <= 255:
+        parser.error("--batch must be between 1 and 255")
+    if config.batch > 1 and config.no_ack:
+        parser.error("batch publishes are always acknowledged")
+    if config.batch > 1 and config.alias:
+        parser.error("batch publishes do not use aliases")
+    if config.nodes > 1 and config.workers > 1:
+        parser.error("federated nodes are single workers")
+    return config
+
+
+def main():
+    config = parse_args()
+    random.seed(config.seed)
+    stats = Stats()
+    runner = run_process if config.mode == "process" else run_inprocess
+    asyncio.run(runner(config, stats))
+
+    result = report(config, stats)
+    print(json.dumps(result, indent=2))
+    if config.output:
+        Path(config.output).write_text(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 import asyncio
 import random
+import sys
 import time
 
 base_topic = "testing/with/a/long/test/topic/".split("/")
@@ -30,25 +31,32 @@ def get_topic():
 
 counter = 0
 
+# Fire-and-forget publishes, only errors are answered
+no_ack = "--no-ack" in sys.argv
+
 
 async def busrouter_publisher():
     global counter
     reader, writer = await asyncio.open_connection("127.0.0.1", 42069)
     topic = get_topic()
     print("TOPIC IS", topic)
+    command = b"&" if no_ack else b"@"
     while 1:
         writer.write(
-            b"@"
+            command
             + str_to_length_prefixed_bytes(topic)
             + str_to_length_prefixed_bytes("hello")
         )
         t = time.time()
         await writer.drain()
+        counter += 1
+        if no_ack:
+            await asyncio.sleep(0)
+            continue
         response = await reader.read(256)
         t2 = time.time()
         print("Response:", response)
         print("Got response in", t2 - t)
-        counter += 1
 
 
 multiplier = 1
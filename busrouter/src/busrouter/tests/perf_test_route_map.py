@@ -0,0 +1,182 @@
+"""
+Microbenchmarks for the subscription trie.
+
+Builds synthetic site/device/sensor/metric trees of increasing size and reports
+ops/sec for add_route, remove_route, remove_routes and match_route, and the peak
+memory used while building the tree.
+
+    python -m busrouter.tests.perf_test_route_map --sizes 1000 100000 1000000
+"""
+
+import argparse
+import json
+import random
+import time
+import tracemalloc
+from pathlib import Path
+
+from busrouter.router import (
+    RouteMap,
+    add_route,
+    match_route,
+    remove_route,
+    remove_routes,
+)
+
+MATCHES = 100_000
+HOT_TOPICS = 1000
+SUBSCRIPTIONS_PER_CONNECTION = 10
+
+
+def make_levels(size: int) -> list[list[str]]:
+    # The device level grows with the tree so exact filters keep spreading out,
+    # while the share of topics each wildcard filter matches stays the same
+    return [
+        [f"site{i}" for i in range(10)],
+        [f"device{i}" for i in range(max(size // 100, 10))],
+        [f"sensor{i}" for i in range(10)],
+        [f"metric{i}" for i in range(5)],
+    ]
+
+
+def get_filter(levels, plus: float, hash: float) -> str:
+    topic = [random.choice(levels[0])]
+    for segment in levels[1:]:
+        if random.random() < hash:
+            topic.append("#")
+            break
+        elif random.random() < plus:
+            topic.append("+")
+        else:
+            topic.append(random.choice(segment))
+    return "/".join(topic)
+
+
+def get_topic(levels) -> str:
+    return "/".join(random.choice(segment) for segment in levels)
+
+
+def timed(function, *args) -> float:
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def build(route_map: RouteMap, subscriptions: list[tuple[str, object]]):
+    for topic, queue in subscriptions:
+        add_route(route_map, topic, queue)
+
+
+def match_all(route_map: RouteMap, topics: list[str]):
+    for topic in topics:
+        match_route(route_map, topic)
+
+
+def remove_each(route_map: RouteMap, subscriptions: list[tuple[str, object]]):
+    for topic, queue in subscriptions:
+        remove_route(route_map, topic, queue)
+
+
+def remove_all(route_map: RouteMap, queues: list[object]):
+    for queue in queues:
+        remove_routes(route_map, queue)
+
+
+def benchmark(size: int, plus: float, hash: float) -> dict:
+    random.seed(size)
+    levels = make_levels(size)
+    queues = [object() for _ in range(max(size // SUBSCRIPTIONS_PER_CONNECTION, 1))]
+    subscriptions = list(
+        {(get_filter(levels, plus, hash), queues[i % len(queues)]) for i in range(size)}
+    )
+    topics = [get_topic(levels) for _ in range(min(size, MATCHES))]
+    hot_topics = [random.choice(topics[:HOT_TOPICS]) for _ in range(len(topics))]
+
+    tracemalloc.start()
+    build(RouteMap(), subscriptions)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    route_map = RouteMap()
+    add = timed(build, route_map, subscriptions)
+    match = timed(match_all, route_map, topics)
+    routes = sum(len(match_route(route_map, topic)) for topic in topics[:1000])
+
+    cached_map = RouteMap(cache_size=HOT_TOPICS)
+    build(cached_map, subscriptions)
+    match_cached = timed(match_all, cached_map, hot_topics)
+
+    half = len(subscriptions) // 2
+    remove = timed(remove_each, route_map, subscriptions[:half])
+    remove_queues = timed(remove_all, route_map, queues)
+    assert route_map.is_empty
+
+    return {
+        "size": size,
+        "subscriptions": len(subscriptions),
+        "routes_per_match": routes / min(len(topics), 1000),
+        "peak_memory_mib": peak / 2**20,
+        "ops_per_second": {
+            "add_route": len(subscriptions) / add,
+            "match_route": len(topics) / match,
+            "match_route_cached": len(hot_topics) / match_cached,
+            "remove_route": half / remove,
+            "remove_routes": len(queues) / remove_queues,
+        },
+    }
+
+
+def disconnect_storm(connections: int = 10_000):
+    """
+    Every connection drops at once, as after a network blip.
+    """
+    random.seed(0)
+    levels = make_levels(connections * SUBSCRIPTIONS_PER_CONNECTION)
+    route_map = RouteMap()
+    queues = [object() for _ in range(connections)]
+    for queue in queues:
+        for _ in range(SUBSCRIPTIONS_PER_CONNECTION):
+            add_route(route_map, get_filter(levels, 0.1, 0.05), queue)
+
+    elapsed = timed(remove_all, route_map, queues)
+    assert route_map.is_empty
+    print(
+        f"Disconnected {connections} connections with "
+        f"{SUBSCRIPTIONS_PER_CONNECTION} subscriptions each in {elapsed:.2f} s: "
+        f"{elapsed / connections * 1e6:.1f} us/connection"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000, 1_000_000]
+    )
+    parser.add_argument("--plus", type=float, default=0.1, help="'+' per segment")
+    parser.add_argument("--hash", type=float, default=0.05, help="'#' per segment")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    config = parser.parse_args()
+
+    results = []
+    print(
+        f"{'filters':>9} {'MiB':>7} {'routes':>7} {'add/s':>10} {'match/s':>10} "
+        f"{'cached/s':>10} {'remove/s':>10} {'dropall/s':>10}"
+    )
+    for size in config.sizes:
+        result = benchmark(size, config.plus, config.hash)
+        ops = result["ops_per_second"]
+        print(
+            f"{result['subscriptions']:>9} {result['peak_memory_mib']:>7.1f} "
+            f"{result['routes_per_match']:>7.1f} {ops['add_route']:>10.0f} "
+            f"{ops['match_route']:>10.0f} {ops['match_route_cached']:>10.0f} "
+            f"{ops['remove_route']:>10.0f} {ops['remove_routes']:>10.0f}"
+        )
+        results.append(result)
+    disconnect_storm()
+
+    if config.output:
+        Path(config.output).write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Benchmark a reconnect storm with and without sessions.
+
+Connects devices that each subscribe to a number of filters, drops every
+connection and reconnects all devices, either replaying their subscribe frames or
+resuming their session. Reports the time to handle the reconnects and the
+subscriptions held afterwards.
+
+    python -m busrouter.tests.perf_test_sessions --devices 10000 --subscriptions 10
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from pathlib import Path
+
+from busrouter.busrouter import DeviceProtocol
+from busrouter.router import RouteMap, str_to_length_prefixed_bytes
+from busrouter.sessions import Sessions
+
+
+class NullTransport(asyncio.Transport):
+    def write(self, data):
+        pass
+
+    def writelines(self, list_of_data):
+        pass
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        pass
+
+    def close(self):
+        pass
+
+
+def device_frames(device: int, subscriptions: int) -> bytes:
+    return b"".join(
+        b"+" + str_to_length_prefixed_bytes(f"device/{device}/{n}/#")
+        for n in range(subscriptions)
+    )
+
+
+async def storm(config, resume: bool) -> dict:
+    request_queue = asyncio.Queue()
+    route_map = RouteMap()
+    sessions = Sessions(request_queue, route_map)
+
+    def connect(data: bytes) -> DeviceProtocol:
+        protocol = DeviceProtocol(request_queue, route_map=route_map, sessions=sessions)
+        protocol.connection_made(NullTransport())
+        protocol.data_received(data)
+        return protocol
+
+    devices = range(config.devices)
+    subscribes = [device_frames(n, config.subscriptions) for n in devices]
+    tokens = [b"~" + str_to_length_prefixed_bytes(f"device-{n}") for n in devices]
+    protocols = [
+        connect(tokens[n] + subscribes[n] if resume else subscribes[n]) for n in devices
+    ]
+    for protocol in protocols:
+        protocol.connection_lost(None)
+
+    start = time.perf_counter()
+    protocols = [connect(tokens[n] if resume else subscribes[n]) for n in devices]
+    elapsed = time.perf_counter() - start
+    await asyncio.sleep(0)
+
+    result = {
+        "resume": resume,
+        "reconnect_seconds": elapsed,
+        "per_device_us": elapsed / config.devices * 1e6,
+        "subscriptions": sum(map(len, route_map.subscriptions.values())),
+        "upload_bytes": sum(map(len, tokens if resume else subscribes)),
+    }
+    for protocol in protocols:
+        protocol.connection_lost(None)
+    return result
+
+
+async def run(config) -> list[dict]:
+    results = []
+    for resume in (False, True):
+        result = await storm(config, resume)
+        print(
+            f"{'resume' if resume else 'replay':>6}: "
+            f"{result['reconnect_seconds'] * 1000:8.1f} ms, "
+            f"{result['per_device_us']:6.1f} us/device, "
+            f"{result['upload_bytes']:>9} bytes sent, "
+            f"{result['subscriptions']} subscriptions"
+        )
+        results.append(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--devices", type=int, default=10_000)
+    parser.add_argument("--subscriptions", type=int, default=10)
+    parser.add_argument("--output", help="write results as JSON to this file")
+    config = parser.parse_args()
+
+    results = asyncio.run(run(config))
+    if config.output:
+        Path(config.output).write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+Benchmark keepalive timers of idle connections.
+
+Opens idle device connections on mock transports whose devices answer every ping
+with a pong, and reports the memory per connection and the CPU time spent on the
+keepalive traffic. Also compares rescheduling a timer on the shared timer wheel
+with cancelling and recreating a loop timer, which each pong used to cost.
+
+    python -m busrouter.tests.perf_test_timers --connections 10000 50000
+"""
+
+import argparse
+import asyncio
+import json
+import time
+import tracemalloc
+from pathlib import Path
+
+from busrouter import settings
+from busrouter.busrouter import DeviceProtocol
+from busrouter.timers import Timer, TimerWheel
+
+RESCHEDULES = 200_000
+
+
+class IdleTransport(asyncio.Transport):
+    """
+    A transport of a device that only answers pings.
+    """
+
+    def __init__(self, protocol: DeviceProtocol):
+        super().__init__()
+        self.protocol = protocol
+        self.pings = 0
+        self.closed = False
+
+    def write(self, data):
+        self.pings += data.count(b"?")
+        asyncio.get_running_loop().call_soon(self.protocol.data_received, b"!")
+
+    def writelines(self, list_of_data):
+        self.write(b"".join(list_of_data))
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def is_closing(self):
+        return self.closed
+
+
+async def idle_connections(connections: int, duration: float) -> dict:
+    request_queue = asyncio.Queue()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    transports = []
+    for _ in range(connections):
+        protocol = DeviceProtocol(request_queue)
+        transport = IdleTransport(protocol)
+        protocol.connection_made(transport)
+        protocol.data_received(b"!")
+        transports.append(transport)
+    # Let the writer tasks start
+    await asyncio.sleep(0)
+    memory = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    start = time.process_time()
+    await asyncio.sleep(duration)
+    cpu = time.process_time() - start
+
+    for transport in transports:
+        transport.protocol.connection_lost(None)
+    await asyncio.sleep(0)
+    return {
+        "connections": connections,
+        "bytes_per_connection": memory / connections,
+        "cpu_share": cpu / duration,
+        "pings_per_second": sum(t.pings for t in transports) / duration,
+        "timed_out": sum(t.closed for t in transports),
+    }
+
+
+async def reschedule(timers: int = 10_000) -> dict:
+    loop = asyncio.get_running_loop()
+    rounds = RESCHEDULES // timers
+
+    wheel = TimerWheel(settings.TIMER_TICK)
+    wheel_timers = [Timer(lambda: None) for _ in range(timers)]
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for timer in wheel_timers:
+            wheel.schedule(timer, settings.PING_INTERVAL)
+    wheel_elapsed = time.perf_counter() - start
+    for timer in wheel_timers:
+        wheel.cancel(timer)
+
+    handles = [loop.call_later(settings.PING_INTERVAL, lambda: None)] * timers
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for index, handle in enumerate(handles):
+            handle.cancel()
+            handles[index] = loop.call_later(settings.PING_INTERVAL, lambda: None)
+    loop_elapsed = time.perf_counter() - start
+    for handle in handles:
+        handle.cancel()
+
+    return {
+        "timer_wheel_ns": wheel_elapsed / (rounds * timers) * 1e9,
+        "call_later_ns": loop_elapsed / (rounds * timers) * 1e9,
+    }
+
+
+async def run(config) -> dict:
+    settings.PING_INTERVAL = config.interval
+    settings.TIMEOUT = config.interval * 2
+    results = {"reschedule": await reschedule(), "idle": []}
+    print(
+        f"Reschedule: timer wheel {results['reschedule']['timer_wheel_ns']:.0f} ns, "
+        f"cancel + call_later {results['reschedule']['call_later_ns']:.0f} ns"
+    )
+
+    print(f"{'connections':>11} {'B/conn':>8} {'CPU %':>6} {'pings/s':>9} {'lost':>5}")
+    for connections in config.connections:
+        result = await idle_connections(connections, config.duration)
+        print(
+            f"{connections:>11} {result['bytes_per_connection']:>8.0f} "
+            f"{result['cpu_share'] * 100:>6.1f} {result['pings_per_second']:>9.0f} "
+            f"{result['timed_out']:>5}"
+        )
+        results["idle"].append(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--connections", type=int, nargs="+", default=[10_000, 50_000])
+    parser.add_argument("--interval", type=float, default=1, help="ping interval")
+    parser.add_argument("--duration", type=float, default=5, help="seconds")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    config = parser.parse_args()
+
+    results = asyncio.run(run(config))
+    if config.output:
+        Path(config.output).write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
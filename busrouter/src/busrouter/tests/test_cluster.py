@@ -0,0 +1,240 @@
+import asyncio
+import socket
+
+import pytest
+
+from busrouter.busrouter import DeviceProtocol
+from busrouter.cluster import Interest, link_peer, parse_responses
+from busrouter.router import (
+    OkResponse,
+    PublishRequest,
+    PublishResponse,
+    RequestQueue,
+    ResponseQueue,
+    RouteMap,
+    Stream,
+    StreamDataRequest,
+    StreamDataResponse,
+    StreamStartRequest,
+    StreamStartResponse,
+    SubscribeRequest,
+    UnsubscribeAllRequest,
+    add_route,
+    remove_route,
+    remove_routes,
+    route,
+)
+
+
+class MockLink:
+    def __init__(self):
+        self.sent = []
+
+    def send(self, frames):
+        self.sent.append(frames)
+
+
+@pytest.mark.asyncio
+async def test_interest():
+    route_map = RouteMap()
+    route_map.interest = Interest()
+    link = MockLink()
+    route_map.interest.links.append(link)
+    queue = ResponseQueue()
+    queue2 = ResponseQueue()
+    peer_queue = ResponseQueue(peer=True)
+
+    add_route(route_map, "a/+", queue)
+    add_route(route_map, "a/+", queue)
+    add_route(route_map, "a/+", queue2)
+    add_route(route_map, "b", peer_queue)
+    add_route(route_map, "c", queue)
+    assert route_map.interest.counts == {"a/+": 2, "c": 1}
+    await asyncio.sleep(0)
+    assert link.sent == [[b"[\x02\x03a/+\x01c"]]
+
+    remove_route(route_map, "a/+", queue)
+    remove_routes(route_map, queue2)
+    remove_routes(route_map, peer_queue)
+    assert route_map.interest.counts == {"c": 1}
+    await asyncio.sleep(0)
+    assert link.sent[1:] == [[b"]\x01\x03a/+"]]
+
+
+@pytest.mark.asyncio
+async def test_interest_changes_cancel_out():
+    interest = Interest()
+    link = MockLink()
+    interest.links.append(link)
+    queue = ResponseQueue()
+
+    interest.add("a", queue)
+    interest.remove("a", queue)
+    interest.add("b", queue)
+    await asyncio.sleep(0)
+    assert link.sent == [[b"[\x01\x01b"]]
+
+    interest.remove("b", queue)
+    interest.add("b", queue)
+    await asyncio.sleep(0)
+    assert link.sent == [[b"[\x01\x01b"]]
+
+
+def test_parse_responses():
+    data = b"[\x02\x00@\x01a\x02hi?[\x09\x00\x01k[\x09\x00"
+    requests, consumed, pinged = parse_responses(data)
+    assert [(r.topic, r.message) for r in requests] == [("a", b"hi")]
+    assert pinged
+    assert data[consumed:] == b"[\x09\x00"
+
+
+def test_parse_responses_extended():
+    long = PublishResponse("a", bytes(300), extended=True).frame
+    start = StreamStartResponse(7, "s", 5).frame
+    data = (
+        b"^\x01"
+        + long
+        + start
+        + StreamDataResponse(7, b"abc").frame
+        + StreamDataResponse(7, b"de").frame
+        + long[:100]
+    )
+    streams = {}
+    requests, consumed, _ = parse_responses(data, streams)
+
+    assert isinstance(requests[0], PublishRequest)
+    assert (requests[0].topic, requests[0].message) == ("a", bytes(300))
+    assert isinstance(requests[1], StreamStartRequest)
+    stream = requests[1].stream
+    assert (stream.topic, stream.length, stream.ack) == ("s", 5, False)
+    assert [(r.stream, r.chunk) for r in requests[2:]] == [
+        (stream, b"abc"),
+        (stream, b"de"),
+    ]
+    assert not streams
+    assert data[consumed:] == long[:100]
+
+    # An abort ends the stream too
+    requests, _, _ = parse_responses(start + StreamDataResponse(7, b"").frame, streams)
+    assert requests[1].chunk == b""
+    assert not streams
+
+
+class Worker:
+    def __init__(self, address):
+        self.address = address
+        self.request_queue = RequestQueue()
+        self.route_map = RouteMap()
+        self.route_map.interest = Interest()
+        self.tasks = []
+
+    async def start(self, peer_address):
+        loop = asyncio.get_running_loop()
+
+        def factory():
+            return DeviceProtocol(self.request_queue, peer=True)
+
+        if isinstance(self.address, str):
+            self.server = await loop.create_unix_server(factory, self.address)
+        else:
+            self.server = await loop.create_server(factory, *self.address)
+        router = route(self.request_queue, self.route_map)
+        self.tasks.append(asyncio.create_task(router))
+        self.tasks.append(
+            asyncio.create_task(
+                link_peer(peer_address, self.route_map.interest, self.request_queue)
+            )
+        )
+
+    async def stop(self):
+        self.server.close()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def request(self, response_queue, request):
+        await self.request_queue.put((response_queue, request))
+        return await response_queue.get()
+
+
+async def wait_for(condition):
+    async with asyncio.timeout(1):
+        while not condition():
+            await asyncio.sleep(0.01)
+
+
+def free_address() -> tuple[str, int]:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("transport", ["unix", "tcp"])
+async def test_forward_between_workers(tmp_path, transport):
+    if transport == "unix":
+        worker = Worker(str(tmp_path / "worker-0.sock"))
+        worker2 = Worker(str(tmp_path / "worker-1.sock"))
+    else:
+        worker = Worker(free_address())
+        worker2 = Worker(free_address())
+    publisher = ResponseQueue()
+    subscriber = ResponseQueue()
+    subscriber2 = ResponseQueue()
+
+    await worker.start(worker2.address)
+    await worker2.start(worker.address)
+    try:
+        await wait_for(lambda: worker.route_map.interest.links)
+        await wait_for(lambda: worker2.route_map.interest.links)
+
+        ok = await worker.request(subscriber, SubscribeRequest("a/#"))
+        assert isinstance(ok, OkResponse)
+        ok = await worker2.request(subscriber2, SubscribeRequest("a/+"))
+        assert isinstance(ok, OkResponse)
+        # Both workers have a local and a peer subscription once interest arrives
+        await wait_for(lambda: len(worker.route_map.subscriptions) == 2)
+        await wait_for(lambda: len(worker2.route_map.subscriptions) == 2)
+
+        ok = await worker.request(publisher, PublishRequest("a/b", b"hi"))
+        assert isinstance(ok, OkResponse)
+        response = await subscriber.get()
+        assert (response.topic, response.message) == ("a/b", b"hi")
+        response = await asyncio.wait_for(subscriber2.get(), 1)
+        assert isinstance(response, PublishResponse)
+        assert (response.topic, response.message) == ("a/b", b"hi")
+
+        # The forwarded publish is not forwarded back
+        await asyncio.sleep(0.05)
+        assert subscriber.empty()
+        assert subscriber2.empty()
+
+        # Links use the extended framing, long publishes and streams get across
+        subscriber2.extended = True
+        await worker.request_queue.put(
+            (publisher, PublishRequest("a/b", bytes(300), False))
+        )
+        response = await asyncio.wait_for(subscriber2.get(), 1)
+        assert (response.topic, response.message) == ("a/b", bytes(300))
+
+        stream = Stream("a/b", 5)
+        await worker.request_queue.put((publisher, StreamStartRequest(stream)))
+        await worker.request_queue.put((publisher, StreamDataRequest(stream, b"abc")))
+        ok = await worker.request(publisher, StreamDataRequest(stream, b"de"))
+        assert isinstance(ok, OkResponse)
+        frames = []
+        for _ in range(3):
+            response = await asyncio.wait_for(subscriber2.get(), 1)
+            frames.append(response.frame[2:])
+        assert frames == [b"\x03a/b\x05", b"\x03abc", b"\x02de"]
+        await asyncio.sleep(0.05)
+        assert subscriber.empty()
+        subscriber2.extended = False
+
+        await worker2.request_queue.put(
+            (subscriber2, UnsubscribeAllRequest(skip_response=True))
+        )
+        await wait_for(lambda: len(worker.route_map.subscriptions) == 1)
+    finally:
+        await worker.stop()
+        await worker2.stop()
@@ -0,0 +1,178 @@
+import httpx
+import pytest
+
+from busrouter.mapper import Forwarder, SetupError, follow, sync
+from busrouter.router import (
+    BatchResponse,
+    PublishResponse,
+    ResponseQueue,
+    RouteMap,
+    add_route,
+    publish,
+    publish_batch,
+)
+
+
+def received(queue: ResponseQueue) -> list[tuple[str, bytes]]:
+    messages = []
+    while not queue.empty():
+        response = queue.get_nowait()
+        if isinstance(response, BatchResponse):
+            messages.extend((r.topic, r.message) for r in response.responses)
+        else:
+            assert isinstance(response, PublishResponse)
+            messages.append((response.topic, response.message))
+    return messages
+
+
+def subscribe(route_map: RouteMap, topic: str) -> ResponseQueue:
+    queue = ResponseQueue()
+    add_route(route_map, topic, queue)
+    return queue
+
+
+def test_forward():
+    route_map = RouteMap()
+    forwarder = Forwarder(route_map)
+    forwarder.load([("in/+", "out"), ("in/a", "out"), ("in/a", "other")])
+    out = subscribe(route_map, "out")
+    other = subscribe(route_map, "other")
+
+    publish(route_map, "in/a", b"1")
+    publish(route_map, "in/b", b"2")
+    publish(route_map, "unrouted", b"3")
+
+    # Both sources match in/a, the sink gets it once
+    assert received(out) == [("out", b"1"), ("out", b"2")]
+    assert received(other) == [("other", b"1")]
+
+
+def test_forward_chain_and_loop():
+    route_map = RouteMap()
+    forwarder = Forwarder(route_map)
+    forwarder.load([("a", "b"), ("b", "c"), ("c", "a"), ("d", "d")])
+    queues = {topic: subscribe(route_map, topic) for topic in "abcd"}
+
+    publish(route_map, "a", b"x")
+    publish(route_map, "d", b"y")
+
+    assert received(queues["a"]) == [("a", b"x")]
+    assert received(queues["b"]) == [("b", b"x")]
+    assert received(queues["c"]) == [("c", b"x")]
+    assert received(queues["d"]) == [("d", b"y")]
+    assert forwarder.loops == 2
+    assert not forwarder.chain
+
+
+def test_forward_skips_peer_publishes():
+    route_map = RouteMap()
+    forwarder = Forwarder(route_map)
+    forwarder.load([("in", "out")])
+    out = subscribe(route_map, "out")
+
+    publish(route_map, "in", b"x", from_peer=True)
+    assert received(out) == []
+
+
+def test_forward_batch_and_long_messages():
+    route_map = RouteMap()
+    forwarder = Forwarder(route_map)
+    forwarder.load([("in/#", "out")])
+    out = subscribe(route_map, "out")
+
+    publish_batch(route_map, [("in/a", b"1"), ("in/b", b"2")])
+    publish(route_map, "in/c", bytes(200))
+    assert received(out) == [("out", b"1"), ("out", b"2"), ("out", bytes(200))]
+
+
+def test_reload_routes():
+    route_map = RouteMap()
+    forwarder = Forwarder(route_map)
+    forwarder.load([("in", "out"), ("bad/#/source", "out")])
+    assert route_map.subscriptions[forwarder] == {"in"}
+
+    forwarder.load([("in2", "out")])
+    assert route_map.subscriptions[forwarder] == {"in2"}
+    out = subscribe(route_map, "out")
+    publish(route_map, "in", b"old")
+    publish(route_map, "in2", b"new")
+    assert received(out) == [("out", b"new")]
+
+
+def test_load_applies_difference():
+    route_map = RouteMap()
+    forwarder = Forwarder(route_map)
+    assert forwarder.load([("a", "x"), ("b", "x"), ("c", "y")]) == (3, 0)
+    generation = route_map.generation
+    assert forwarder.load([("c", "y"), ("b", "x"), ("a", "x")]) == (0, 0)
+    assert route_map.generation == generation
+
+    assert forwarder.load([("a", "x"), ("c", "z"), ("d", "x"), ("d", "y")]) == (3, 2)
+    assert route_map.subscriptions[forwarder] == {"a", "c", "d"}
+    assert set(forwarder.sinks) == {"x", "y", "z"}
+    x = subscribe(route_map, "x")
+    z = subscribe(route_map, "z")
+    for topic in "abcd":
+        publish(route_map, topic, topic.encode())
+    assert received(x) == [("x", b"a"), ("x", b"d")]
+    assert received(z) == [("z", b"c")]
+
+    forwarder.load([])
+    assert forwarder not in route_map.subscriptions
+    assert not forwarder.sinks
+    assert not forwarder.sources
+
+
+@pytest.mark.asyncio
+async def test_sync():
+    routes = [{"source": "in", "sink": "out"}]
+
+    def handler(request):
+        return httpx.Response(200, json=routes)
+
+    route_map = RouteMap()
+    forwarder = Forwarder(route_map)
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+        await sync(forwarder, client)
+        assert forwarder.routes == {("in", "out")}
+
+        routes.append({"source": "in2", "sink": "out"})
+        await sync(forwarder, client)
+        assert forwarder.routes == {("in", "out"), ("in2", "out")}
+
+    def failing(request):
+        return httpx.Response(500)
+
+    async with httpx.AsyncClient(transport=httpx.MockTransport(failing)) as client:
+        with pytest.raises(SetupError):
+            await sync(forwarder, client)
+    assert len(forwarder.routes) == 2
+
+
+@pytest.mark.asyncio
+async def test_follow():
+    changes = [
+        {"revision": 4, "action": "added", "source": "in2", "sink": "out"},
+        {"revision": 5, "action": "removed", "source": "in", "sink": "out"},
+        {"revision": 6, "action": "removed", "source": "gone", "sink": "out"},
+    ]
+
+    def handler(request):
+        if "since" not in request.url.params:
+            headers = {"X-Route-Revision": "3"}
+            return httpx.Response(
+                200, json=[{"source": "in", "sink": "out"}], headers=headers
+            )
+        since = int(request.url.params["since"])
+        if since > 6:
+            return httpx.Response(410)
+        feed = [change for change in changes if change["revision"] > since]
+        return httpx.Response(200, json={"revision": 6, "changes": feed})
+
+    forwarder = Forwarder(RouteMap())
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+        assert await sync(forwarder, client) == 3
+        assert await follow(forwarder, client, 3) == 6
+        assert forwarder.routes == {("in2", "out")}
+        with pytest.raises(SetupError):
+            await follow(forwarder, client, 7)
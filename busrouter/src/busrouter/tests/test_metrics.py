@@ -0,0 +1,75 @@
+import asyncio
+from asyncio import CancelledError
+
+import pytest
+
+from busrouter import metrics
+from busrouter.router import (
+    OkResponse,
+    PublishRequest,
+    RequestQueue,
+    ResponseQueue,
+    SubscribeRequest,
+    route,
+)
+
+
+def test_histogram_samples():
+    histogram = metrics.Histogram("test_seconds", "Test histogram")
+    metrics.REGISTRY.remove(histogram)
+    histogram.observe(0.5e-6)
+    histogram.observe(3e-6)
+    histogram.observe(10)
+
+    samples = dict(histogram.samples())
+    assert samples['test_seconds_bucket{le="1e-06"}'] == 1
+    assert samples['test_seconds_bucket{le="2e-06"}'] == 1
+    assert samples['test_seconds_bucket{le="4e-06"}'] == 2
+    assert samples['test_seconds_bucket{le="+Inf"}'] == 3
+    assert samples["test_seconds_count"] == 3
+
+
+@pytest.mark.asyncio
+async def test_router_metrics(monkeypatch):
+    monkeypatch.setattr(metrics, "ENABLED", True)
+    publishes = metrics.PUBLISHES.value
+    queue_waits = metrics.QUEUE_WAIT_SECONDS.counts[:]
+
+    request_queue = RequestQueue()
+    pub_response_queue = ResponseQueue()
+    sub_response_queue = ResponseQueue()
+    router = asyncio.create_task(route(request_queue))
+
+    await request_queue.put((sub_response_queue, SubscribeRequest("topic")))
+    assert isinstance(await sub_response_queue.get(), OkResponse)
+    await request_queue.put((pub_response_queue, PublishRequest("topic", b"msg")))
+    assert isinstance(await pub_response_queue.get(), OkResponse)
+
+    assert metrics.PUBLISHES.value == publishes + 1
+    assert sum(metrics.QUEUE_WAIT_SECONDS.counts) == sum(queue_waits) + 2
+    assert dict(metrics.SUBSCRIPTIONS.samples()) == {"busrouter_subscriptions": 1}
+    assert dict(metrics.RESPONSE_QUEUE_DEPTH.samples()) == {
+        "busrouter_response_queue_depth": 1
+    }
+
+    router.cancel()
+    try:
+        await router
+    except CancelledError:
+        pass
+
+
+@pytest.mark.asyncio
+async def test_scrape():
+    server = await asyncio.start_server(metrics.handle_scrape, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+    response = await reader.read()
+    writer.close()
+    server.close()
+
+    assert response.startswith(b"HTTP/1.1 200 OK\r\n")
+    assert b"# TYPE busrouter_publishes_total counter\n" in response
+    assert b'busrouter_match_seconds_bucket{le="+Inf"}' in response
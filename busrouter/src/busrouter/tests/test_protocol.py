@@ -1,51 +1,396 @@
 import asyncio
-from datetime import datetime, timezone, timedelta
 
 import pytest
-from freezegun import freeze_time
 
 from busrouter import settings
-from busrouter.busrouter import handle_device_request
+from busrouter.busrouter import DeviceProtocol, parse_requests
+from busrouter.router import (
+    AliasPublishRequest,
+    BatchRequest,
+    HelloResponse,
+    InvalidRequest,
+    NokResponse,
+    OkResponse,
+    Overflow,
+    ParseError,
+    PublishBatchRequest,
+    PublishRequest,
+    PublishResponse,
+    RegisterRequest,
+    RouteMap,
+    StreamStartRequest,
+    SubscribeBulkRequest,
+    SubscribeRequest,
+    UnsubscribeAllRequest,
+    UnsubscribeBulkRequest,
+    UnsubscribeRequest,
+)
+
+
+class MockTransport(asyncio.Transport):
+    def __init__(self):
+        super().__init__()
+        self.written = []
+        self.closed = False
+
+    def write(self, data):
+        self.written.append(bytes(data))
+
+    def writelines(self, list_of_data):
+        self.written.append([bytes(data) for data in list_of_data])
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def is_closing(self):
+        return self.closed
+
+
+def connect(request_queue, route_map=None):
+    protocol = DeviceProtocol(request_queue, route_map=route_map)
+    transport = MockTransport()
+    protocol.connection_made(transport)
+    return protocol, transport
+
+
+def test_parse_requests():
+    data = b"+\x05hello-\x05hello@\x05hello\x02hi!@\x05hel"
+    requests, consumed, pong = parse_requests(data)
+
+    assert [type(request) for request in requests] == [
+        SubscribeRequest,
+        UnsubscribeRequest,
+        PublishRequest,
+    ]
+    assert requests[2].topic == "hello"
+    assert requests[2].message == b"hi"
+    assert pong
+    assert data[consumed:] == b"@\x05hel"
+
+
+def test_parse_requests_noack_and_invalid_topic():
+    requests, consumed, _ = parse_requests(b"&\x01a\x02hi@\x01\xff\x00")
+
+    assert isinstance(requests[0], PublishRequest)
+    assert not requests[0].ack
+    assert isinstance(requests[1], InvalidRequest)
+    assert consumed == 10
+
+
+def test_parse_requests_publish_batch():
+    frame = b"*\x02\x01a\x02hi\x01b\x00"
+    for size in range(len(frame)):
+        assert parse_requests(frame[:size])[:2] == ([], 0)
+
+    requests, consumed, _ = parse_requests(frame + b"*\x01\x01\xff\x00*\x00")
+    assert isinstance(requests[0], PublishBatchRequest)
+    assert requests[0].messages == [("a", b"hi"), ("b", b"")]
+    assert isinstance(requests[1], InvalidRequest)
+    assert requests[2].messages == []
+    assert consumed == len(frame) + 7
+
+
+def test_parse_requests_bulk():
+    data = b"[\x02\x01a\x03b/c]\x01\x01\xff[\x02\x01a"
+    requests, consumed, _ = parse_requests(data)
+
+    assert isinstance(requests[0], SubscribeBulkRequest)
+    assert requests[0].topics == ["a", "b/c"]
+    assert isinstance(requests[1], UnsubscribeBulkRequest)
+    assert requests[1].topics == [None]
+    assert data[consumed:] == b"[\x02\x01a"
+
+    requests, _, _ = parse_requests(b"[\x01\x80\x01" + b"t" * 128, extended=True)
+    assert requests[0].topics == ["t" * 128]
+
+
+def test_parse_requests_aliases(monkeypatch):
+    monkeypatch.setattr(settings, "MAX_ALIASES", 2)
+    aliases = []
+    requests, _, _ = parse_requests(
+        b"=\x05hello$\x00\x00\x02hi=\x01a%\x00\x01\x00=\x01b$\x00\x02\x00", aliases
+    )
+
+    assert [alias.topic for alias in aliases] == ["hello", "a"]
+    assert isinstance(requests[0], RegisterRequest)
+    assert requests[0].alias_id == 0
+    assert isinstance(requests[1], AliasPublishRequest)
+    assert requests[1].alias is aliases[0]
+    assert (requests[1].message, requests[1].ack) == (b"hi", True)
+    assert requests[2].alias_id == 1
+    assert requests[3].alias is aliases[1]
+    assert not requests[3].ack
+    assert isinstance(requests[4], InvalidRequest)
+    assert isinstance(requests[5], InvalidRequest)
+
+
+def test_parse_requests_extended(monkeypatch):
+    monkeypatch.setattr(settings, "STREAM_THRESHOLD", 1000)
+    topic = "t" * 200
+    data = b"+\xc8\x01" + topic.encode() + b"@\x01a\xac\x02" + bytes(300)
+    requests, consumed, _ = parse_requests(data + b"&\x01a\xe9\x07rest", extended=True)
+
+    assert requests[0].topic == topic
+    assert requests[1].message == bytes(300)
+    assert isinstance(requests[2], StreamStartRequest)
+    assert (requests[2].stream.topic, requests[2].stream.length) == ("a", 1001)
+    assert not requests[2].stream.ack
+    assert consumed == len(data) + 5
+
+    with pytest.raises(ParseError):
+        parse_requests(b"+\xe9\x07", extended=True)
+
+
+@pytest.mark.asyncio
+async def test_hello_switches_framing():
+    route_map = RouteMap()
+    protocol, _ = connect(asyncio.Queue(), route_map)
+    topic = "t" * 200
+
+    protocol.data_received(b"^\x01+\xc8\x01" + topic.encode())
+
+    response = protocol.response_queue.get_nowait()
+    assert isinstance(response, HelloResponse)
+    assert response.frame == b"^\x01"
+    assert isinstance(protocol.response_queue.get_nowait(), OkResponse)
+    assert route_map.subscriptions == {protocol.response_queue: {topic}}
+    protocol.connection_lost(None)
+
+
+@pytest.mark.asyncio
+async def test_many_hellos_in_one_chunk():
+    route_map = RouteMap()
+    protocol, transport = connect(asyncio.Queue(), route_map)
+
+    protocol.data_received(b"^\x01^\x00" * 3000 + b"+\x01a")
+
+    assert not protocol.extended
+    assert not transport.closed
+    assert route_map.subscriptions == {protocol.response_queue: {"a"}}
+    protocol.connection_lost(None)
+
+
+@pytest.mark.asyncio
+async def test_hello_without_framing_change_in_chunk():
+    for hello, extended in ((b"^\x00", False), (b"^\x01^\x01", True)):
+        route_map = RouteMap()
+        protocol, transport = connect(asyncio.Queue(), route_map)
+
+        protocol.data_received(hello + b"+\x01a")
+
+        assert protocol.extended == extended
+        assert protocol.buffer is None
+        assert route_map.subscriptions == {protocol.response_queue: {"a"}}
+        await asyncio.sleep(0)
+        assert transport.written[-1][-1] == OkResponse().frame
+        protocol.connection_lost(None)
+
+
+@pytest.mark.asyncio
+async def test_stream_large_publish(monkeypatch):
+    monkeypatch.setattr(settings, "STREAM_THRESHOLD", 1024)
+    route_map = RouteMap()
+    subscriber, _ = connect(asyncio.Queue(), route_map)
+    publisher, _ = connect(asyncio.Queue(), route_map)
+    subscriber.data_received(b"^\x01+\x05topic")
+    publisher.data_received(b"^\x01")
+    for protocol in (subscriber, publisher):
+        while not protocol.response_queue.empty():
+            protocol.response_queue.get_nowait()
+
+    size = 1 << 20
+    publisher.data_received(b"@\x05topic\x80\x80\x40" + bytes(1000))
+    for _ in range(size // 65536 - 1):
+        publisher.data_received(bytes(65536))
+        assert not publisher.buffer
+    publisher.data_received(bytes(65536 - 1000) + b"+\x01a")
+
+    start = subscriber.response_queue.get_nowait()
+    assert (start.topic, start.length) == ("topic", size)
+    received = 0
+    while not subscriber.response_queue.empty():
+        received += len(subscriber.response_queue.get_nowait().chunk)
+    assert received == size
+    assert isinstance(publisher.response_queue.get_nowait(), OkResponse)
+    # Parsing continued after the stream
+    assert isinstance(publisher.response_queue.get_nowait(), OkResponse)
+
+    # A stream cut short by the publisher is aborted
+    publisher.data_received(b"@\x05topic\x80\x80\x40" + bytes(10))
+    publisher.connection_lost(None)
+    subscriber.response_queue.get_nowait()
+    assert subscriber.response_queue.get_nowait().chunk == bytes(10)
+    assert subscriber.response_queue.get_nowait().chunk == b""
+    subscriber.connection_lost(None)
 
 
 @pytest.mark.asyncio
-async def test_ping_timeout():
-    reader = asyncio.StreamReader()
+async def test_data_received_in_chunks():
     request_queue = asyncio.Queue()
-    response_queue = asyncio.Queue()
-    now = datetime.now(timezone.utc)
-    with freeze_time(now) as frozen_datetime:
-        try:
-            async with asyncio.TaskGroup() as tg:
-                tg.create_task(
-                    handle_device_request(request_queue, response_queue, reader, tg)
-                )
-                frozen_datetime.tick(delta=timedelta(seconds=settings.TIMEOUT + 1))
-                await asyncio.sleep(0)
-        except* asyncio.TimeoutError:
-            pass
-        else:
-            pytest.fail("Expected to see a TimeoutError")
-
-
-@pytest.mark.asyncio
-async def test_pong():
-    reader = asyncio.StreamReader()
+    protocol, transport = connect(request_queue)
+
+    for byte in b"@\x05hello\x02hi":
+        protocol.data_received(bytes([byte]))
+    protocol.data_received(b"+\x01a+\x01b")
+
+    response_queue, request = request_queue.get_nowait()
+    assert response_queue is protocol.response_queue
+    assert isinstance(request, PublishRequest)
+    assert (request.topic, request.message) == ("hello", b"hi")
+
+    _, request = request_queue.get_nowait()
+    assert isinstance(request, BatchRequest)
+    assert [r.topic for r in request.requests] == ["a", "b"]
+
+    protocol.connection_lost(None)
+    _, request = request_queue.get_nowait()
+    assert isinstance(request, UnsubscribeAllRequest)
+
+
+@pytest.mark.asyncio
+async def test_direct_routing():
     request_queue = asyncio.Queue()
-    response_queue = asyncio.Queue()
-    now = datetime.now(timezone.utc)
-    with freeze_time(now, tick=True) as frozen_datetime:
-        await asyncio.sleep(0)
-        async with asyncio.TaskGroup() as tg:
-            task = tg.create_task(
-                handle_device_request(request_queue, response_queue, reader, tg)
-            )
-            frozen_datetime.move_to(
-                frozen_datetime + timedelta(seconds=settings.TIMEOUT - 5)
-            )
-            reader.feed_data(b"!")
-            await asyncio.sleep(0)
-
-            frozen_datetime.tick(delta=timedelta(seconds=2))
-            # await asyncio.sleep(0)
-            task.cancel()
+    route_map = RouteMap()
+    subscriber, _ = connect(request_queue, route_map)
+    publisher, _ = connect(request_queue, route_map)
+
+    subscriber.data_received(b"+\x05hello")
+    publisher.data_received(b"@\x05hello\x02hi")
+
+    assert request_queue.empty()
+    assert isinstance(subscriber.response_queue.get_nowait(), OkResponse)
+    assert subscriber.response_queue.get_nowait().frame == b"@\x05hello\x02hi"
+    assert isinstance(publisher.response_queue.get_nowait(), OkResponse)
+
+    subscriber.connection_lost(None)
+    publisher.connection_lost(None)
+    assert not route_map.subscriptions
+    assert request_queue.empty()
+
+
+@pytest.mark.asyncio
+async def test_bad_command():
+    protocol, transport = connect(asyncio.Queue())
+    protocol.data_received(b"x")
+    assert transport.closed
+    protocol.connection_lost(None)
+
+
+@pytest.mark.asyncio
+async def test_ping_timeout(monkeypatch):
+    monkeypatch.setattr(settings, "TIMER_TICK", 0.001)
+    monkeypatch.setattr(settings, "TIMEOUT", 0.01)
+    protocol, transport = connect(asyncio.Queue())
+    await asyncio.sleep(0.02)
+    assert transport.closed
+    protocol.connection_lost(None)
+
+
+@pytest.mark.asyncio
+async def test_pong(monkeypatch):
+    monkeypatch.setattr(settings, "TIMER_TICK", 0.001)
+    monkeypatch.setattr(settings, "TIMEOUT", 0.05)
+    monkeypatch.setattr(settings, "PING_INTERVAL", 0.01)
+    protocol, transport = connect(asyncio.Queue())
+    await asyncio.sleep(0.03)
+    protocol.data_received(b"!")
+    await asyncio.sleep(0.03)
+
+    assert not transport.closed
+    assert transport.written == [b"?"]
+    protocol.connection_lost(None)
+
+
+@pytest.mark.asyncio
+async def test_write_responses():
+    protocol, transport = connect(asyncio.Queue())
+    protocol.response_queue.offer(OkResponse())
+    await asyncio.sleep(0)
+    assert transport.written == [b"k"]
+    protocol.connection_lost(None)
+
+
+@pytest.mark.asyncio
+async def test_write_responses_coalesced():
+    protocol, transport = connect(asyncio.Queue())
+    response = PublishResponse("hello", b"hi")
+    protocol.response_queue.offer(response)
+    protocol.response_queue.offer(NokResponse())
+    protocol.response_queue.offer(response)
+    await asyncio.sleep(0)
+
+    assert response.frame == b"@\x05hello\x02hi"
+    assert transport.written == [[response.frame, b"E", response.frame]]
+    protocol.connection_lost(None)
+
+
+@pytest.mark.asyncio
+async def test_flush_waits_for_transport():
+    protocol, transport = connect(asyncio.Queue())
+    protocol.pause_writing()
+    protocol.response_queue.offer(OkResponse())
+    protocol.response_queue.offer(NokResponse())
+    await asyncio.sleep(0)
+    assert transport.written == []
+
+    protocol.resume_writing()
+    assert transport.written == [[b"k", b"E"]]
+    assert protocol.response_queue.responses is None
+    protocol.connection_lost(None)
+
+
+@pytest.mark.asyncio
+async def test_disconnect_slow_consumer():
+    protocol, transport = connect(asyncio.Queue())
+    response_queue = protocol.response_queue
+    response_queue.overflow = Overflow.DISCONNECT
+    response_queue.maxsize = 1
+    protocol.pause_writing()
+
+    assert response_queue.offer(OkResponse())
+    assert not response_queue.offer(OkResponse())
+    await asyncio.sleep(0)
+    assert transport.closed
+    protocol.connection_lost(None)
+
+
+def test_overflow_policy_per_connection():
+    protocol = DeviceProtocol(asyncio.Queue(), overflow=Overflow.DROP_NEWEST)
+    assert protocol.response_queue.overflow == Overflow.DROP_NEWEST
+    protocol = DeviceProtocol(asyncio.Queue())
+    assert protocol.response_queue.overflow == settings.RESPONSE_QUEUE_OVERFLOW
+
+
+def test_unknown_overflow_policy():
+    with pytest.raises(ValueError):
+        DeviceProtocol(asyncio.Queue(), overflow="drop-oldset")
+    with pytest.raises(ValueError):
+        settings.overflow("drop-oldset")
+    assert settings.overflow(Overflow.DISCONNECT) == Overflow.DISCONNECT
+
+
+@pytest.mark.asyncio
+async def test_buffers_allocated_lazily():
+    protocol, _ = connect(asyncio.Queue(), RouteMap())
+    assert protocol.buffer is None
+    assert protocol.aliases is None
+
+    protocol.data_received(b"+\x05hel")
+    assert protocol.buffer == b"+\x05hel"
+    protocol.data_received(b"lo")
+    assert protocol.buffer is None
+    assert protocol.aliases is None
+
+    protocol.data_received(b"=\x05hello")
+    assert [alias.topic for alias in protocol.aliases] == ["hello"]
+    protocol.data_received(b"=\x01a")
+    assert [alias.topic for alias in protocol.aliases] == ["hello", "a"]
+    protocol.connection_lost(None)
+
+
+def test_connection_is_slotted():
+    protocol = DeviceProtocol(asyncio.Queue())
+    assert not hasattr(protocol, "__dict__")
@@ -4,19 +4,47 @@ from asyncio import CancelledError, Queue
 import pytest
 
 from busrouter.router import (
+    Alias,
+    AliasPublishRequest,
+    BatchRequest,
+    BatchResponse,
+    BulkResponse,
+    InvalidRequest,
     NokResponse,
     OkResponse,
+    Overflow,
+    ParseError,
+    PublishBatchRequest,
     PublishRequest,
     PublishResponse,
-    RouteSegment,
+    RegisteredResponse,
+    RegisterRequest,
+    ResponseQueue,
+    RouteChangeError,
+    RouteMap,
+    Stream,
+    StreamDataResponse,
+    StreamStartResponse,
+    SubscribeBulkRequest,
     SubscribeRequest,
     UnsubscribeAllRequest,
+    UnsubscribeBulkRequest,
     UnsubscribeRequest,
     add_route,
+    add_routes,
+    discard_routes,
+    handle_batch,
     match_route,
+    publish,
+    publish_batch,
+    read_varint,
     remove_route,
     remove_routes,
+    resolve_alias,
     route,
+    start_stream,
+    stream_data,
+    varint,
 )
 
 
@@ -37,28 +65,28 @@ from busrouter.router import (
     ],
 )
 def test_match_route(sub, pub, matches):
-    route_map = RouteSegment()
+    route_map = RouteMap()
     queue = object()
     add_route(route_map, sub, queue)
     if matches:
-        assert match_route(route_map, pub) == [queue]
+        assert match_route(route_map, pub) == {queue}
     else:
-        assert match_route(route_map, pub) == []
+        assert match_route(route_map, pub) == set()
 
 
 def test_add_route():
-    route_map = RouteSegment()
+    route_map = RouteMap()
     queue = object()
     topic = "hello/world"
     add_route(route_map, topic, queue)
 
     assert "hello" in route_map
     assert "world" in route_map["hello"]
-    assert route_map["hello"]["world"].routes == [queue]
+    assert route_map["hello"]["world"].routes == {queue}
 
 
 def test_remove_route():
-    route_map = RouteSegment()
+    route_map = RouteMap()
     queue = object()
     queue2 = object()
     topic = "hello/world"
@@ -68,22 +96,115 @@ def test_remove_route():
     add_route(route_map, topic, queue2)
     add_route(route_map, topic2, queue2)
 
-    assert route_map["hello"]["world"].routes == [queue, queue2]
-    assert route_map["other"]["world"].routes == [queue, queue2]
+    assert route_map["hello"]["world"].routes == {queue, queue2}
+    assert route_map["other"]["world"].routes == {queue, queue2}
 
     remove_route(route_map, topic, queue)
-    assert route_map["hello"]["world"].routes == [queue2]
-    assert route_map["other"]["world"].routes == [queue, queue2]
+    assert route_map["hello"]["world"].routes == {queue2}
+    assert route_map["other"]["world"].routes == {queue, queue2}
 
     remove_routes(route_map, queue2)
-    assert route_map["hello"]["world"].routes == []
-    assert route_map["other"]["world"].routes == [queue]
+    assert "hello" not in route_map
+    assert route_map["other"]["world"].routes == {queue}
+
+
+def test_remove_route_prunes_nodes():
+    route_map = RouteMap()
+    queue = object()
+    add_route(route_map, "hello/big/world", queue)
+    add_route(route_map, "hello/small", queue)
+
+    remove_route(route_map, "hello/big/world", queue)
+    assert "big" not in route_map["hello"]
+    assert "small" in route_map["hello"]
+
+    remove_route(route_map, "hello/small", queue)
+    assert route_map.is_empty
+
+
+def test_remove_route_does_not_create_nodes():
+    route_map = RouteMap()
+    queue = object()
+    add_route(route_map, "hello", queue)
+
+    with pytest.raises(RouteChangeError):
+        remove_route(route_map, "hello/world", queue)
+    with pytest.raises(RouteChangeError):
+        remove_route(route_map, "other", queue)
+    assert "world" not in route_map["hello"]
+    assert "other" not in route_map
+
+
+def test_match_route_delivers_once():
+    route_map = RouteMap()
+    queue = object()
+    queue2 = object()
+    add_route(route_map, "hello/+/world", queue)
+    add_route(route_map, "hello/#", queue)
+    add_route(route_map, "hello/nice/world", queue)
+    add_route(route_map, "hello/nice/world", queue2)
+
+    assert match_route(route_map, "hello/nice/world") == {queue, queue2}
+
+
+def test_remove_routes_uses_index():
+    route_map = RouteMap()
+    queue = object()
+    queue2 = object()
+    add_route(route_map, "hello/world", queue)
+    add_route(route_map, "hello/+", queue)
+    add_route(route_map, "hello/world", queue2)
+    assert route_map.subscriptions == {
+        queue: {"hello/world", "hello/+"},
+        queue2: {"hello/world"},
+    }
+
+    remove_route(route_map, "hello/+", queue)
+    assert route_map.subscriptions[queue] == {"hello/world"}
+
+    remove_routes(route_map, queue)
+    assert queue not in route_map.subscriptions
+    assert route_map["hello"]["world"].routes == {queue2}
+
+    remove_routes(route_map, queue2)
+    assert route_map.subscriptions == {}
+    assert route_map.is_empty
+
+
+def test_match_cache():
+    route_map = RouteMap(cache_size=2)
+    queue = object()
+    queue2 = object()
+    add_route(route_map, "hello/+", queue)
+
+    assert match_route(route_map, "hello/world") == {queue}
+    assert match_route(route_map, "hello/world") == {queue}
+    assert (route_map.hits, route_map.misses) == (1, 1)
+
+    add_route(route_map, "hello/world", queue2)
+    assert match_route(route_map, "hello/world") == {queue, queue2}
+    remove_route(route_map, "hello/+", queue)
+    assert match_route(route_map, "hello/world") == {queue2}
+    remove_routes(route_map, queue2)
+    assert match_route(route_map, "hello/world") == set()
+    assert (route_map.hits, route_map.misses) == (1, 4)
+
+
+def test_match_cache_eviction():
+    route_map = RouteMap(cache_size=2)
+    add_route(route_map, "#", object())
+
+    match_route(route_map, "a")
+    match_route(route_map, "b")
+    match_route(route_map, "a")
+    match_route(route_map, "c")
+    assert list(route_map.cache) == ["a", "c"]
 
 
 @pytest.mark.asyncio
 async def test_subscribe_and_unsubscribe_request():
     request_queue = Queue()
-    response_queue = Queue()
+    response_queue = ResponseQueue()
     topic = "cool/topic"
     router = asyncio.create_task(route(request_queue))
     await request_queue.put((response_queue, SubscribeRequest(topic)))
@@ -104,7 +225,7 @@ async def test_subscribe_and_unsubscribe_request():
 @pytest.mark.asyncio
 async def test_unsubscribe_request_error():
     request_queue = Queue()
-    response_queue = Queue()
+    response_queue = ResponseQueue()
     topic = "cool/topic"
     router = asyncio.create_task(route(request_queue))
 
@@ -122,7 +243,7 @@ async def test_unsubscribe_request_error():
 @pytest.mark.asyncio
 async def test_unsubscribe_all_request():
     request_queue = Queue()
-    response_queue = Queue()
+    response_queue = ResponseQueue()
     router = asyncio.create_task(route(request_queue))
 
     await request_queue.put((response_queue, UnsubscribeAllRequest()))
@@ -139,8 +260,8 @@ async def test_unsubscribe_all_request():
 @pytest.mark.asyncio
 async def test_publish():
     request_queue = Queue()
-    pub_response_queue = Queue()
-    sub_response_queue = Queue()
+    pub_response_queue = ResponseQueue()
+    sub_response_queue = ResponseQueue()
     router = asyncio.create_task(route(request_queue))
     sub_topic = "pubtest/+/topic"
     pub_topic = "pubtest/something/topic"
@@ -162,3 +283,384 @@ async def test_publish():
         await router
     except CancelledError:
         pass
+
+
+@pytest.mark.parametrize(
+    "overflow,expected",
+    [
+        [Overflow.DROP_NEWEST, [b"1", b"2"]],
+        [Overflow.DROP_OLDEST, [b"2", b"3"]],
+        [Overflow.DISCONNECT, [b"1", b"2"]],
+    ],
+)
+def test_publish_overflow(overflow, expected):
+    route_map = RouteMap()
+    slow_queue = ResponseQueue(maxsize=2, overflow=overflow)
+    queue = ResponseQueue(maxsize=10)
+    add_route(route_map, "topic", slow_queue)
+    add_route(route_map, "topic", queue)
+
+    for message in (b"1", b"2", b"3"):
+        publish(route_map, "topic", message)
+
+    assert slow_queue.overflows == 1
+    assert [slow_queue.get_nowait().message for _ in range(2)] == expected
+    assert [queue.get_nowait().message for _ in range(3)] == [b"1", b"2", b"3"]
+    if overflow == Overflow.DISCONNECT:
+        assert slow_queue.disconnected
+        assert match_route(route_map, "topic") == {queue}
+    else:
+        assert match_route(route_map, "topic") == {slow_queue, queue}
+
+
+@pytest.mark.asyncio
+async def test_publish_noack():
+    request_queue = Queue()
+    pub_response_queue = ResponseQueue()
+    sub_response_queue = ResponseQueue()
+    router = asyncio.create_task(route(request_queue))
+
+    await request_queue.put((sub_response_queue, SubscribeRequest("topic")))
+    assert isinstance(await sub_response_queue.get(), OkResponse)
+    await request_queue.put(
+        (pub_response_queue, PublishRequest("topic", b"msg", ack=False))
+    )
+    await request_queue.put((pub_response_queue, InvalidRequest("bad topic")))
+
+    assert isinstance(await pub_response_queue.get(), NokResponse)
+    response = await sub_response_queue.get()
+    assert isinstance(response, PublishResponse)
+    assert pub_response_queue.empty()
+
+    router.cancel()
+    try:
+        await router
+    except CancelledError:
+        pass
+
+
+def test_publish_batch():
+    route_map = RouteMap()
+    queue_a = ResponseQueue()
+    queue_a2 = ResponseQueue()
+    queue_all = ResponseQueue()
+    queue_b = ResponseQueue()
+    add_route(route_map, "a", queue_a)
+    add_route(route_map, "a", queue_a2)
+    add_route(route_map, "#", queue_all)
+    add_route(route_map, "b", queue_b)
+
+    publish_batch(route_map, [("a", b"1"), ("b", b"2"), ("a", b"3")])
+
+    response = queue_a.get_nowait()
+    assert isinstance(response, BatchResponse)
+    assert response is queue_a2.get_nowait()
+    assert response.frame == b"@\x01a\x011@\x01a\x013"
+    responses = queue_all.get_nowait().responses
+    assert [response.message for response in responses] == [b"1", b"2", b"3"]
+    # Messages are encoded once even when delivered in different batches
+    assert queue_b.get_nowait() is responses[1]
+    for queue in (queue_a, queue_a2, queue_all, queue_b):
+        assert queue.empty()
+
+
+@pytest.mark.asyncio
+async def test_publish_batch_request():
+    request_queue = Queue()
+    pub_response_queue = ResponseQueue()
+    sub_response_queue = ResponseQueue()
+    router = asyncio.create_task(route(request_queue))
+
+    await request_queue.put((sub_response_queue, SubscribeRequest("a")))
+    assert isinstance(await sub_response_queue.get(), OkResponse)
+    await request_queue.put(
+        (pub_response_queue, PublishBatchRequest([("a", b"1"), ("a", b"2")]))
+    )
+    assert isinstance(await pub_response_queue.get(), OkResponse)
+    response = await sub_response_queue.get()
+    assert [r.message for r in response.responses] == [b"1", b"2"]
+    assert pub_response_queue.empty()
+
+    router.cancel()
+    try:
+        await router
+    except CancelledError:
+        pass
+
+
+def test_resolve_alias():
+    route_map = RouteMap()
+    queue = ResponseQueue()
+    queue2 = ResponseQueue()
+    alias = Alias("a/b")
+    add_route(route_map, "a/+", queue)
+
+    assert resolve_alias(route_map, alias) == {queue}
+    routes = alias.routes
+    assert resolve_alias(route_map, alias) is routes
+    add_route(route_map, "#", queue2)
+    assert resolve_alias(route_map, alias) == {queue, queue2}
+    remove_routes(route_map, queue)
+    assert resolve_alias(route_map, alias) == {queue2}
+
+
+@pytest.mark.asyncio
+async def test_alias_requests():
+    request_queue = Queue()
+    pub_response_queue = ResponseQueue()
+    sub_response_queue = ResponseQueue()
+    router = asyncio.create_task(route(request_queue))
+    alias = Alias("topic")
+
+    await request_queue.put((sub_response_queue, SubscribeRequest("topic")))
+    assert isinstance(await sub_response_queue.get(), OkResponse)
+    await request_queue.put((pub_response_queue, RegisterRequest(3)))
+    response = await pub_response_queue.get()
+    assert isinstance(response, RegisteredResponse)
+    assert response.frame == b"=\x00\x03"
+
+    await request_queue.put((pub_response_queue, AliasPublishRequest(alias, b"msg")))
+    assert isinstance(await pub_response_queue.get(), OkResponse)
+    response = await sub_response_queue.get()
+    assert (response.topic, response.message) == ("topic", b"msg")
+
+    router.cancel()
+    try:
+        await router
+    except CancelledError:
+        pass
+
+
+@pytest.mark.parametrize("value", [0, 127, 128, 300, 2**28 - 1])
+def test_varint(value):
+    encoded = varint(value)
+    assert read_varint(memoryview(encoded), 0) == (value, len(encoded))
+    assert read_varint(memoryview(encoded[:-1]), 0)[0] == -1
+
+
+def test_varint_too_long():
+    with pytest.raises(ParseError):
+        read_varint(memoryview(b"\xff\xff\xff\xff\x01"), 0)
+
+
+def test_publish_long_message():
+    route_map = RouteMap()
+    classic = ResponseQueue()
+    extended = ResponseQueue()
+    extended.extended = True
+    add_route(route_map, "topic", classic)
+    add_route(route_map, "topic", extended)
+
+    publish(route_map, "topic", bytes(200))
+    publish(route_map, "topic", bytes(300))
+
+    assert classic.get_nowait().frame == b"@\x05topic\xc8" + bytes(200)
+    assert classic.empty()
+    assert extended.get_nowait().frame == b"@\x05topic\xc8\x01" + bytes(200)
+    assert extended.get_nowait().frame == b"@\x05topic\xac\x02" + bytes(300)
+
+
+def _shape(node) -> dict:
+    return {key: (_shape(child), child.routes) for key, child in node.children.items()}
+
+
+def test_add_routes():
+    route_map = RouteMap()
+    queue = ResponseQueue()
+    add_route(route_map, "a/b", queue)
+    generation = route_map.generation
+    topics = ["a/b/c", "a/b", "x", "a/#/b", None, "a/+/c", "a/b/d", "a/b/c"]
+
+    results = add_routes(route_map, topics, queue)
+
+    assert results == [True, True, True, False, False, True, True, True]
+    assert route_map.subscriptions[queue] == {"a/b", "a/b/c", "a/b/d", "a/+/c", "x"}
+    assert route_map.generation == generation + 1
+    assert match_route(route_map, "a/b/c") == {queue}
+    assert match_route(route_map, "a/q/c") == {queue}
+
+    # The same trie as subscribing one by one
+    expected = RouteMap()
+    for topic in route_map.subscriptions[queue]:
+        add_route(expected, topic, queue)
+    assert _shape(route_map) == _shape(expected)
+
+
+def test_add_routes_nothing_new():
+    route_map = RouteMap()
+    queue = ResponseQueue()
+    assert add_routes(route_map, ["#/a", None], queue) == [False, False]
+    assert queue not in route_map.subscriptions
+    assert route_map.generation == 0
+
+
+def test_discard_routes():
+    route_map = RouteMap()
+    queue = ResponseQueue()
+    add_routes(route_map, ["a/b", "a/c", "d"], queue)
+
+    results = discard_routes(route_map, ["a/b", "x", "a/b", None], queue)
+    assert results == [True, False, False, False]
+    assert route_map.subscriptions[queue] == {"a/c", "d"}
+    assert discard_routes(route_map, ["a/c", "d"], queue) == [True, True]
+    assert queue not in route_map.subscriptions
+    assert not route_map.children
+    assert discard_routes(route_map, ["a/c"], queue) == [False]
+
+
+def test_discard_routes_like_one_at_a_time():
+    topics = ["a/b", "a", "a/b/c", "a/b", "a/b!", "a/b/c", "x", "a"]
+    bulk, single = RouteMap(), RouteMap()
+    queue = ResponseQueue()
+    for route_map in (bulk, single):
+        add_routes(route_map, ["a", "a/b", "a/b!", "a/b/c", "a/b/d", "e"], queue)
+
+    results = discard_routes(bulk, topics, queue)
+
+    assert results == [discard_routes(single, [topic], queue)[0] for topic in topics]
+    assert results == [True, True, True, False, True, False, False, False]
+    assert bulk.subscriptions[queue] == {"a/b/d", "e"}
+    assert list(bulk.children) == ["a", "e"]
+    assert list(bulk.children["a"].children) == ["b"]
+    assert list(bulk.children["a"].children["b"].children) == ["d"]
+    assert match_route(bulk, "a/b/c") == set()
+    assert match_route(bulk, "a/b/d") == {queue}
+
+
+def test_handle_bulk_requests():
+    route_map = RouteMap()
+    queue = ResponseQueue()
+    handle_batch(
+        route_map,
+        [
+            (queue, SubscribeBulkRequest(["a", "b/#/c", "b"])),
+            (queue, UnsubscribeBulkRequest(["a", "c"])),
+        ],
+    )
+    response = queue.get_nowait()
+    assert isinstance(response, BulkResponse)
+    assert response.results == [True, False, True]
+    assert response.frame == b"[\x03\x02"
+    assert queue.get_nowait().frame == b"[\x02\x02"
+    assert route_map.subscriptions[queue] == {"b"}
+
+
+def test_bulk_response_frame():
+    results = [True] * 9
+    results[8] = False
+    assert BulkResponse(results).frame == b"[\x09\x00\x01"
+    assert BulkResponse([]).frame == b"[\x00"
+
+
+def test_stream():
+    route_map = RouteMap()
+    publisher = ResponseQueue()
+    classic = ResponseQueue()
+    extended = ResponseQueue()
+    extended.extended = True
+    slow = ResponseQueue(maxsize=2)
+    slow.extended = True
+    for queue in (classic, extended, slow):
+        add_route(route_map, "topic", queue)
+
+    stream = Stream("topic", 6)
+    start_stream(route_map, stream)
+    stream_data(route_map, stream, b"abc", publisher)
+    assert publisher.empty()
+    stream_data(route_map, stream, b"def", publisher)
+
+    assert isinstance(publisher.get_nowait(), OkResponse)
+    assert classic.empty()
+    start = extended.get_nowait()
+    assert isinstance(start, StreamStartResponse)
+    assert start.frame == b"<\x01\x05topic\x06"
+    assert extended.get_nowait().frame == b">\x01\x03abc"
+    assert extended.get_nowait().frame == b">\x01\x03def"
+    # The slow subscriber was dropped from the stream and told so
+    assert slow.get_nowait().chunk == b"abc"
+    response = slow.get_nowait()
+    assert isinstance(response, StreamDataResponse)
+    assert response.chunk == b""
+    assert stream.routes == [extended]
+
+
+def test_stream_abort():
+    route_map = RouteMap()
+    publisher = ResponseQueue()
+    extended = ResponseQueue()
+    extended.extended = True
+    add_route(route_map, "topic", extended)
+
+    stream = Stream("topic", 6)
+    start_stream(route_map, stream)
+    stream_data(route_map, stream, b"abc", publisher)
+    stream_data(route_map, stream, b"", publisher)
+
+    assert publisher.empty()
+    assert [extended.get_nowait().frame for _ in range(3)][1:] == [
+        b">\x01\x03abc",
+        b">\x01\x00",
+    ]
+
+
+def test_handle_batch_coalesces_churn():
+    route_map = RouteMap()
+    queue = ResponseQueue()
+    churn = [SubscribeRequest("a"), UnsubscribeRequest("a"), SubscribeRequest("a")]
+    handle_batch(
+        route_map,
+        [(queue, BatchRequest(churn)), (queue, UnsubscribeRequest("b"))],
+    )
+
+    responses = [queue.get_nowait() for _ in range(4)]
+    assert [type(response) for response in responses] == [
+        OkResponse,
+        OkResponse,
+        OkResponse,
+        NokResponse,
+    ]
+    assert route_map.subscriptions == {queue: {"a"}}
+    assert route_map.generation == 1
+
+
+def test_handle_batch_keeps_order():
+    route_map = RouteMap()
+    pub_queue = ResponseQueue()
+    sub_queue = ResponseQueue()
+    handle_batch(
+        route_map,
+        [
+            (pub_queue, PublishRequest("a", b"1", ack=False)),
+            (sub_queue, SubscribeRequest("a")),
+            (pub_queue, PublishRequest("a", b"2", ack=False)),
+            (sub_queue, UnsubscribeRequest("a")),
+            (pub_queue, PublishRequest("a", b"3", ack=False)),
+        ],
+    )
+
+    assert isinstance(sub_queue.get_nowait(), OkResponse)
+    assert sub_queue.get_nowait().message == b"2"
+    assert isinstance(sub_queue.get_nowait(), OkResponse)
+    assert sub_queue.empty()
+    assert pub_queue.empty()
+    assert not route_map.subscriptions
+
+
+@pytest.mark.asyncio
+async def test_route_drains_queue():
+    request_queue = Queue()
+    sub_response_queue = ResponseQueue()
+    for topic in ("a", "b", "c"):
+        request_queue.put_nowait((sub_response_queue, SubscribeRequest(topic)))
+    router = asyncio.create_task(route(request_queue))
+
+    await asyncio.sleep(0)
+    assert request_queue.empty()
+    assert sub_response_queue.qsize() == 3
+    await asyncio.wait_for(request_queue.join(), 1)
+
+    router.cancel()
+    try:
+        await router
+    except CancelledError:
+        pass
@@ -0,0 +1,206 @@
+import asyncio
+
+import pytest
+
+from busrouter import settings
+from busrouter.busrouter import DeviceProtocol, parse_requests
+from busrouter.router import (
+    InvalidRequest,
+    NokResponse,
+    OkResponse,
+    PublishResponse,
+    RouteMap,
+    SessionRequest,
+    SubscribeRequest,
+    publish,
+    route,
+)
+from busrouter.sessions import Session, Sessions
+from busrouter.tests.test_protocol import MockTransport
+
+
+def connect(sessions, route_map, request_queue=None):
+    if request_queue is None:
+        request_queue = asyncio.Queue()
+    protocol = DeviceProtocol(request_queue, route_map=route_map, sessions=sessions)
+    transport = MockTransport()
+    protocol.connection_made(transport)
+    return protocol, transport
+
+
+def frames(protocol) -> list[bytes]:
+    result = []
+    while not protocol.response_queue.empty():
+        result.append(protocol.response_queue.get_nowait().frame)
+    return result
+
+
+def test_parse_session_request():
+    requests, consumed, _ = parse_requests(b"~\x03abc+\x01a")
+    assert len(requests) == 1
+    assert isinstance(requests[0], SessionRequest)
+    assert requests[0].token == "abc"
+    assert consumed == 5
+
+    requests, consumed, _ = parse_requests(b"+\x01a~\x00+\x01b")
+    assert isinstance(requests[0], SubscribeRequest)
+    assert isinstance(requests[1], InvalidRequest)
+    assert isinstance(requests[2], SubscribeRequest)
+    assert consumed == 8
+
+
+def test_session_buffers_while_detached():
+    session = Session("abc", buffer_size=2)
+    first = PublishResponse("a", b"1")
+    second = PublishResponse("a", b"2")
+    third = PublishResponse("a", b"3")
+
+    assert session.full()
+    assert not session.offer(OkResponse())
+    for response in (first, second, third):
+        assert session.offer(response)
+    assert list(session.buffer) == [second, third]
+    assert session.overflows == 1
+    assert session.qsize() == 2
+
+
+@pytest.mark.asyncio
+async def test_resume_session():
+    route_map = RouteMap()
+    sessions = Sessions(asyncio.Queue(), route_map)
+    protocol, _ = connect(sessions, route_map)
+
+    protocol.data_received(b"~\x03abc+\x01a")
+    assert frames(protocol) == [b"~\x00", b"k"]
+    session = sessions.sessions["abc"]
+    assert route_map.subscriptions == {session: {"a"}}
+
+    protocol.connection_lost(None)
+    assert route_map.subscriptions == {session: {"a"}}
+    publish(route_map, "a", b"missed")
+
+    protocol, _ = connect(sessions, route_map)
+    protocol.data_received(b"~\x03abc@\x01a\x04live")
+    assert frames(protocol) == [
+        b"~\x01",
+        b"@\x01a\x06missed",
+        b"@\x01a\x04live",
+        b"k",
+    ]
+    assert route_map.subscriptions == {session: {"a"}}
+    protocol.connection_lost(None)
+
+
+@pytest.mark.asyncio
+async def test_session_replies_in_order_when_queued():
+    request_queue = asyncio.Queue()
+    route_map = RouteMap()
+    sessions = Sessions(request_queue)
+    router = asyncio.create_task(route(request_queue, route_map))
+    protocol, transport = connect(sessions, None, request_queue)
+
+    protocol.data_received(b"+\x01a@\x01a\x01x~\x03abc+\x01b~\x03def")
+    await request_queue.join()
+    await asyncio.sleep(0)
+
+    assert transport.written == [
+        [b"k", b"@\x01a\x01x", b"k", b"~\x00", b"k", b"E"],
+    ]
+    session = sessions.sessions["abc"]
+    assert route_map.subscriptions == {
+        protocol.response_queue: {"a"},
+        session: {"b"},
+    }
+
+    # Lost before the router attached it, the session still expires
+    second, _ = connect(sessions, None, request_queue)
+    second.data_received(b"~\x03ghi")
+    second.connection_lost(None)
+    await request_queue.join()
+    assert sessions.sessions["ghi"].outbox is None
+    assert sessions.sessions["ghi"].timer.slot is not None
+
+    protocol.connection_lost(None)
+    router.cancel()
+    try:
+        await router
+    except asyncio.CancelledError:
+        pass
+
+
+@pytest.mark.asyncio
+async def test_session_expires(monkeypatch):
+    monkeypatch.setattr(settings, "TIMER_TICK", 0.001)
+    monkeypatch.setattr(settings, "SESSION_GRACE", 0.01)
+    route_map = RouteMap()
+    sessions = Sessions(asyncio.Queue(), route_map)
+    protocol, _ = connect(sessions, route_map)
+    protocol.data_received(b"~\x03abc+\x01a")
+    session = sessions.sessions["abc"]
+
+    protocol.connection_lost(None)
+    await asyncio.sleep(0.03)
+    assert not sessions.sessions
+    assert not route_map.subscriptions
+    assert session.disconnected
+    assert not session.offer(PublishResponse("a", b"late"))
+
+
+@pytest.mark.asyncio
+async def test_session_takeover():
+    route_map = RouteMap()
+    sessions = Sessions(asyncio.Queue(), route_map)
+    first, first_transport = connect(sessions, route_map)
+    second, _ = connect(sessions, route_map)
+    first.data_received(b"~\x03abc+\x01a")
+    frames(first)
+
+    second.data_received(b"~\x03abc")
+    assert frames(second) == [b"~\x01"]
+    await asyncio.sleep(0)
+    assert first_transport.closed
+
+    # Losing the old connection leaves the session with the new one
+    first.connection_lost(None)
+    publish(route_map, "a", b"hi")
+    assert frames(second) == [b"@\x01a\x02hi"]
+    second.connection_lost(None)
+
+
+@pytest.mark.asyncio
+async def test_session_refused():
+    route_map = RouteMap()
+    protocol, _ = connect(None, route_map)
+    protocol.data_received(b"~\x03abc~\x00")
+    assert isinstance(protocol.response_queue.get_nowait(), NokResponse)
+    assert isinstance(protocol.response_queue.get_nowait(), NokResponse)
+    protocol.connection_lost(None)
+
+
+@pytest.mark.asyncio
+async def test_invalid_session_request_in_chunk():
+    route_map = RouteMap()
+    sessions = Sessions(asyncio.Queue(), route_map)
+    protocol, _ = connect(sessions, route_map)
+
+    protocol.data_received(b"~\x00+\x01a")
+
+    assert frames(protocol) == [b"E", b"k"]
+    assert protocol.buffer is None
+    assert not sessions.sessions
+    assert route_map.subscriptions == {protocol.response_queue: {"a"}}
+    protocol.connection_lost(None)
+
+
+@pytest.mark.asyncio
+async def test_many_session_requests_in_one_chunk():
+    route_map = RouteMap()
+    sessions = Sessions(asyncio.Queue(), route_map)
+    protocol, transport = connect(sessions, route_map)
+
+    protocol.data_received(b"~\x01a" * 3000 + b"+\x01b")
+
+    assert not transport.closed
+    assert list(sessions.sessions) == ["a"]
+    assert route_map.subscriptions == {sessions.sessions["a"]: {"b"}}
+    protocol.connection_lost(None)
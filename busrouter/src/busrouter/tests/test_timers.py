@@ -0,0 +1,43 @@
+import asyncio
+
+import pytest
+
+from busrouter.timers import Timer, TimerWheel
+
+
+@pytest.mark.asyncio
+async def test_timer_wheel():
+    wheel = TimerWheel(0.005, size=8)
+    fired = []
+    first = Timer(lambda: fired.append("first"))
+    second = Timer(lambda: fired.append("second"))
+    cancelled = Timer(lambda: fired.append("cancelled"))
+
+    wheel.schedule(first, 0.01)
+    wheel.schedule(second, 0.1)  # more than one turn of the wheel
+    wheel.schedule(cancelled, 0.01)
+    wheel.cancel(cancelled)
+    await asyncio.sleep(0.05)
+    assert fired == ["first"]
+
+    # A fired timer can be scheduled again
+    wheel.schedule(first, 0.02)
+    await asyncio.sleep(0.1)
+    assert fired == ["first", "first", "second"]
+    assert wheel.count == 0
+    assert wheel.handle is None
+
+
+@pytest.mark.asyncio
+async def test_timer_wheel_reschedule():
+    wheel = TimerWheel(0.005)
+    fired = []
+    timer = Timer(lambda: fired.append(True))
+
+    for _ in range(5):
+        wheel.schedule(timer, 0.05)
+        await asyncio.sleep(0.02)
+    assert not fired
+    assert wheel.count == 1
+    await asyncio.sleep(0.08)
+    assert fired == [True]
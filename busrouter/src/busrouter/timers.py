@@ -0,0 +1,93 @@
+import asyncio
+import logging
+from math import ceil
+from typing import Callable, Optional
+from weakref import WeakKeyDictionary
+
+from busrouter import settings
+
+logger = logging.getLogger(__name__)
+
+
+class Timer:
+    __slots__ = ("callback", "expires", "slot")
+
+    def __init__(self, callback: Callable[[], None]):
+        self.callback = callback
+        self.expires = 0
+        self.slot: Optional[set["Timer"]] = None
+
+
+class TimerWheel:
+    """
+    A hashed timer wheel shared by all connections of an event loop.
+
+    Timers are kept in a ring of slots indexed by their expiry tick, so scheduling,
+    rescheduling and cancelling are O(1) set operations. A single loop callback
+    advances the wheel one slot per tick and only runs while timers are pending.
+    Timers fire within a tick of their deadline.
+    """
+
+    def __init__(self, tick: float, size: int = 512):
+        self.tick = tick
+        self.slots: list[set[Timer]] = [set() for _ in range(size)]
+        self.current = 0
+        self.count = 0
+        self.start = 0.0
+        self.handle: Optional[asyncio.TimerHandle] = None
+
+    def schedule(self, timer: Timer, delay: float):
+        if timer.slot is not None:
+            timer.slot.remove(timer)
+        else:
+            self.count += 1
+        timer.expires = self.current + max(1, ceil(delay / self.tick))
+        slot = timer.slot = self.slots[timer.expires % len(self.slots)]
+        slot.add(timer)
+        if self.handle is None:
+            loop = asyncio.get_running_loop()
+            self.start = loop.time() - self.current * self.tick
+            self.call_advance(loop)
+
+    def cancel(self, timer: Timer):
+        if timer.slot is not None:
+            timer.slot.remove(timer)
+            timer.slot = None
+            self.count -= 1
+
+    def advance(self):
+        self.current += 1
+        slot = self.slots[self.current % len(self.slots)]
+        expired = [timer for timer in slot if timer.expires <= self.current]
+        for timer in expired:
+            slot.remove(timer)
+            timer.slot = None
+        self.count -= len(expired)
+        for timer in expired:
+            try:
+                timer.callback()
+            except Exception:
+                logger.exception("Timer callback failed")
+
+        if self.count:
+            self.call_advance(asyncio.get_running_loop())
+        else:
+            self.handle = None
+
+    def call_advance(self, loop: asyncio.AbstractEventLoop):
+        when = self.start + (self.current + 1) * self.tick
+        self.handle = loop.call_at(when, self.advance)
+
+
+_wheels: WeakKeyDictionary[asyncio.AbstractEventLoop, TimerWheel] = WeakKeyDictionary()
+
+
+def get_wheel() -> TimerWheel:
+    """
+    Return the timer wheel of the running event loop.
+    """
+    loop = asyncio.get_running_loop()
+    wheel = _wheels.get(loop)
+    if wheel is None:
+        wheel = _wheels[loop] = TimerWheel(settings.TIMER_TICK)
+    return wheel